@@ -0,0 +1,56 @@
+"""
+Microbenchmarks for the Shopcart service
+
+Each module can be run on its own, for example:
+
+    python -m benchmarks.bench_serialization
+"""
+import timeit
+import tracemalloc
+
+
+def compare(title: str, candidates: dict, number: int = 1000, repeat: int = 5) -> dict:
+    """Times each candidate and prints the best time per call
+
+    The first candidate is the baseline the others are compared against.
+
+    Args:
+        title (str): heading printed above the results
+        candidates (dict): name -> zero argument callable
+        number (int): calls per timing run
+        repeat (int): timing runs, the fastest one is reported
+
+    Returns:
+        dict: name -> best seconds per call
+    """
+    results = {}
+    print(title)
+    for name, func in candidates.items():
+        results[name] = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    baseline = next(iter(results.values()))
+    for name, seconds in results.items():
+        print(f"  {name:<40} {seconds * 1e6:10.1f} us/call  {baseline / seconds:5.2f}x")
+    return results
+
+
+def peak_memory(title: str, candidates: dict) -> dict:
+    """Prints the peak memory allocated by one call of each candidate
+
+    Args:
+        title (str): heading printed above the results
+        candidates (dict): name -> zero argument callable
+
+    Returns:
+        dict: name -> peak bytes allocated
+    """
+    results = {}
+    print(title)
+    for name, func in candidates.items():
+        tracemalloc.start()
+        func()
+        results[name] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    baseline = next(iter(results.values()))
+    for name, peak in results.items():
+        print(f"  {name:<40} {peak / 1024:10.1f} KiB peak  {baseline / peak:5.2f}x")
+    return results
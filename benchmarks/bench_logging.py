@@ -0,0 +1,77 @@
+"""
+Logging overhead benchmark
+
+Compares the log calls a create request used to make (payload at INFO,
+written by the request thread) with the current setup (payload at DEBUG
+and truncated, written by a QueueListener thread). Logs go to a temporary
+file so the disk write is part of the cost. No database is needed.
+"""
+import logging
+import queue
+import tempfile
+from logging.handlers import QueueHandler, QueueListener
+from benchmarks import compare
+
+PAYLOAD = {
+    "name": "benchmark",
+    "items": [
+        {"item_id": str(i), "description": "x" * 40, "quantity": i, "price": i * 3, "shopcart_id": 1}
+        for i in range(50)
+    ],
+}
+
+
+def make_logger(name: str, handler: logging.Handler) -> logging.Logger:
+    """Returns a logger that only writes to handler"""
+    logger = logging.getLogger(name)
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def old_request(logger):
+    """The log calls of the create route before the change"""
+    logger.info("Request to create a Shopcart")
+    logger.info("Processing: %s", PAYLOAD)
+    logger.info(f"Creating {PAYLOAD['name']}")  # pylint: disable=logging-fstring-interpolation
+    logger.info("Shopcart id [%s] created!", 1)
+
+
+def new_request(logger):
+    """The log calls of the create route after the change"""
+    logger.info("Request to create a Shopcart")
+    logger.debug("Processing: %.*s", 500, PAYLOAD)
+    logger.info("Creating %s", "Shopcart")
+    logger.info("Shopcart id [%s] created!", 1)
+
+
+def main():
+    """Runs the benchmark"""
+    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s")
+    with tempfile.NamedTemporaryFile("w") as log_file:
+        file_handler = logging.FileHandler(log_file.name)
+        file_handler.setFormatter(formatter)
+        sync_logger = make_logger("bench.sync", file_handler)
+
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, file_handler)
+        listener.start()
+        async_logger = make_logger("bench.async", QueueHandler(log_queue))
+        try:
+            compare(
+                "Log calls per create request",
+                {
+                    "INFO payload, written inline": lambda: old_request(sync_logger),
+                    "DEBUG payload, written inline": lambda: new_request(sync_logger),
+                    "DEBUG payload, queue listener": lambda: new_request(async_logger),
+                },
+                number=2000,
+            )
+        finally:
+            listener.stop()
+            file_handler.close()
+
+
+if __name__ == "__main__":
+    main()
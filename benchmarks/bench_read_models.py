@@ -0,0 +1,63 @@
+"""
+Read model benchmark
+
+Compares loading a cart and its items through the ORM (Shopcart.find) with
+the Core based ShopcartView for a cart with 10,000 items. Needs the
+database in DATABASE_URI; the cart it creates is removed afterwards.
+"""
+from wsgi import app
+from benchmarks import compare, peak_memory
+from service.models import db, Shopcart, Item, ShopcartView, upgrade
+
+ITEM_COUNT = 10000
+
+
+def seed(size: int) -> int:
+    """Inserts a cart with size items in one statement and returns its id"""
+    shopcart = Shopcart(name="benchmark")
+    db.session.add(shopcart)
+    db.session.flush()
+    db.session.execute(
+        db.insert(Item),
+        [
+            {"shopcart_id": shopcart.id, "item_id": str(i), "description": f"item {i}", "quantity": 1, "price": i}
+            for i in range(size)
+        ],
+    )
+    db.session.commit()
+    return shopcart.id
+
+
+def load_orm(shopcart_id: int) -> list:
+    """The old read path: hydrate the cart and its items through the ORM"""
+    result = list(Shopcart.find(shopcart_id).items)
+    db.session.remove()
+    return result
+
+
+def load_view(shopcart_id: int) -> ShopcartView:
+    """The read model path"""
+    result = ShopcartView.find(shopcart_id)
+    db.session.remove()
+    return result
+
+
+def main():
+    """Runs the benchmark"""
+    with app.app_context():
+        upgrade()
+        shopcart_id = seed(ITEM_COUNT)
+        try:
+            candidates = {
+                "ORM Shopcart.find + items": lambda: load_orm(shopcart_id),
+                "ShopcartView.find": lambda: load_view(shopcart_id),
+            }
+            compare(f"Load a cart with {ITEM_COUNT} items", candidates, number=5, repeat=3)
+            peak_memory(f"Memory to load a cart with {ITEM_COUNT} items", candidates)
+        finally:
+            db.session.execute(db.delete(Shopcart).where(Shopcart.id == shopcart_id))
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    main()
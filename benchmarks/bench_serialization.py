@@ -0,0 +1,48 @@
+"""
+Serialization benchmark
+
+Compares the per-request CPU cost of the old response path
+(Shopcart.serialize() + marshal() + json.dumps) against the precompiled
+encoders in service.common.fast_json for carts of different sizes.
+No database is needed, the carts are built in memory.
+"""
+import json
+from flask_restx import marshal
+from wsgi import app
+from benchmarks import compare
+from service.common.fast_json import compile_encoder, dumps
+from service.models import Shopcart, Item
+from service.routes import shopcart_model
+
+
+def make_shopcart(size: int) -> Shopcart:
+    """Builds a transient shopcart holding size items"""
+    shopcart = Shopcart(id=1, name="benchmark")
+    shopcart.items = [
+        Item(id=i, shopcart_id=1, item_id=str(i), description=f"item {i}", quantity=i % 7 + 1, price=100 + i)
+        for i in range(size)
+    ]
+    return shopcart
+
+
+def main():
+    """Runs the benchmark"""
+    encode = compile_encoder(shopcart_model)
+    with app.app_context():
+        for size in (1, 10, 100, 1000):
+            shopcart = make_shopcart(size)
+            number = max(10, 10000 // size)
+            compare(
+                f"Shopcart with {size} items",
+                {
+                    "serialize + marshal + json.dumps": lambda s=shopcart: json.dumps(
+                        marshal(s.serialize(), shopcart_model)
+                    ),
+                    "fast_json encoder + dumps": lambda s=shopcart: dumps(encode(s)),
+                },
+                number=number,
+            )
+
+
+if __name__ == "__main__":
+    main()
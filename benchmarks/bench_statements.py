@@ -0,0 +1,61 @@
+"""
+Statement caching benchmark
+
+Compares building a new query on every call (the old model finders) with
+the cached statements used by PersistentBase._select_by() and the read
+models. Needs the database in DATABASE_URI; the cart it creates is removed
+afterwards.
+"""
+from wsgi import app
+from benchmarks import compare
+from service.models import db, Shopcart, Item, ItemView, upgrade
+
+
+def main():
+    """Runs the benchmark"""
+    with app.app_context():
+        upgrade()
+        shopcart = Shopcart(name="benchmark-statements")
+        shopcart.items = [Item(item_id="1", description="item", quantity=1, price=1)]
+        shopcart.create()
+        shopcart_id, item_id = shopcart.id, shopcart.items[0].id
+        try:
+            compare(
+                "Find an item in a shopcart",
+                {
+                    "Item.query.filter_by().first()": lambda: Item.query.filter_by(
+                        id=item_id, shopcart_id=shopcart_id
+                    ).first(),
+                    "Item.find_in_shopcart()": lambda: Item.find_in_shopcart(item_id, shopcart_id),
+                },
+                number=2000,
+            )
+            compare(
+                "Find shopcarts by name",
+                {
+                    "Shopcart.query.filter().all()": lambda: Shopcart.query.filter(
+                        Shopcart.name == "benchmark-statements"
+                    ).all(),
+                    "Shopcart.find_by_name()": lambda: Shopcart.find_by_name("benchmark-statements"),
+                },
+                number=2000,
+            )
+            table = Item.__table__
+            compare(
+                "Read an item row",
+                {
+                    "new select per call": lambda: db.session.execute(
+                        db.select(*table.c).where(table.c.id == item_id)
+                    ).first(),
+                    "ItemView.find()": lambda: ItemView.find(item_id),
+                },
+                number=2000,
+            )
+        finally:
+            db.session.rollback()
+            db.session.execute(db.delete(Shopcart).where(Shopcart.id == shopcart_id))
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    main()
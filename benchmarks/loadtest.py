@@ -0,0 +1,264 @@
+"""
+HTTP load test
+
+Replays shopper workflows against a running service and reports the
+throughput and the p50/p95/p99 latency of every kind of request:
+
+    gunicorn --workers=4 --bind 0.0.0.0:8080 wsgi:app
+    python -m benchmarks.loadtest --url http://localhost:8080 --users 50 --duration 60
+
+Each virtual user is a thread with its own keep-alive connection that
+picks a scenario by weight (--mix), runs it, waits --think seconds on
+average and starts again until --duration is over. Only the standard
+library is used, so it runs wherever the service does. Python threads
+share the GIL, so if the load generator itself runs out of CPU start
+several of them.
+"""
+import argparse
+import http.client
+import json
+import math
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+SHOPCARTS = "/api/shopcarts"
+
+
+######################################################################
+#  R E S U L T S
+######################################################################
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Returns the nearest-rank percentile of already sorted values"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+class Results:
+    """Latencies and failures per request name, shared by every user"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(lambda: defaultdict(int))
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, name: str, seconds: float, failure: str = None):
+        """Stores the outcome of one request"""
+        with self.lock:
+            self.latencies[name].append(seconds)
+            if failure:
+                self.failures[name][failure] += 1
+
+    def summary(self) -> dict:
+        """Returns the totals and the statistics of each request name"""
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        rows = {name: self._stats(values, self.failures[name], elapsed) for name, values in self.latencies.items()}
+        everything = [value for values in self.latencies.values() for value in values]
+        failures = defaultdict(int)
+        for by_reason in self.failures.values():
+            for reason, count in by_reason.items():
+                failures[reason] += count
+        return {"elapsed": elapsed, "total": self._stats(everything, failures, elapsed), "requests": rows}
+
+    @staticmethod
+    def _stats(values: list, failures: dict, elapsed: float) -> dict:
+        values = sorted(values)
+        return {
+            "requests": len(values),
+            "failures": sum(failures.values()),
+            "failure_reasons": dict(failures),
+            "throughput": len(values) / elapsed if elapsed else 0.0,
+            "mean_ms": sum(values) / len(values) * 1000 if values else 0.0,
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "max_ms": values[-1] * 1000 if values else 0.0,
+        }
+
+
+def print_summary(summary: dict):
+    """Prints the summary as a table"""
+    header = f"  {'request':<44} {'count':>8} {'fail':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+    print(header)
+    rows = sorted(summary["requests"].items()) + [("TOTAL", summary["total"])]
+    for name, stats in rows:
+        print(
+            f"  {name:<44} {stats['requests']:>8} {stats['failures']:>6} {stats['throughput']:>8.1f} "
+            f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f} {stats['max_ms']:>8.1f}"
+        )
+    if summary["total"]["failure_reasons"]:
+        print("  failures: " + ", ".join(f"{reason} x{count}" for reason, count in
+                                         sorted(summary["total"]["failure_reasons"].items())))
+
+
+######################################################################
+#  V I R T U A L   U S E R S
+######################################################################
+class RequestFailed(Exception):
+    """A request returned an unexpected status"""
+
+
+class Shopper:
+    """A virtual user with its own connection"""
+
+    def __init__(self, url: str, results: Results, rng: random.Random, max_items: int):
+        parts = urlsplit(url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.connection = connection_class(parts.hostname, parts.port, timeout=30)
+        self.prefix = parts.path.rstrip("/")
+        self.results = results
+        self.rng = rng
+        self.max_items = max_items
+        self.known_carts = []
+
+    def request(self, name: str, method: str, path: str, body=None, expected: int = 200):
+        """Sends a request, records its latency and returns the decoded JSON body"""
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, self.prefix + path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as error:
+            self.connection.close()  # reconnect on the next request
+            self.results.record(name, time.perf_counter() - start, type(error).__name__)
+            raise RequestFailed(name) from error
+        elapsed = time.perf_counter() - start
+        if response.status != expected:
+            self.results.record(name, elapsed, f"HTTP {response.status}")
+            raise RequestFailed(name)
+        self.results.record(name, elapsed)
+        return json.loads(data) if data else None
+
+    def item(self, shopcart_id: int) -> dict:
+        """Returns a random item for a cart"""
+        number = self.rng.randint(1, 1000)
+        return {
+            "shopcart_id": shopcart_id,
+            "item_id": str(number),
+            "description": f"product {number}",
+            "quantity": self.rng.randint(1, 5),
+            "price": self.rng.randint(100, 10000),
+        }
+
+    ######################################################################
+    #  S C E N A R I O S
+    ######################################################################
+    def shopper(self):
+        """Creates a cart, fills it, looks at it, totals it and clears it"""
+        cart = self.request("POST /shopcarts", "POST", SHOPCARTS, {"name": "loadtest-checkout", "items": []}, 201)
+        url = f"{SHOPCARTS}/{cart['id']}"
+        items = []
+        for _ in range(self.rng.randint(1, self.max_items)):
+            items.append(self.request("POST /shopcarts/{id}/items", "POST", f"{url}/items", self.item(cart["id"]), 201))
+        self.request("GET /shopcarts/{id}", "GET", url)
+        self.request("GET /shopcarts/{id}/items", "GET", f"{url}/items")
+        changed = dict(self.rng.choice(items), quantity=self.rng.randint(1, 5))
+        self.request("PUT /shopcarts/{id}/items/{item}", "PUT", f"{url}/items/{changed['id']}", changed)
+        self.request("GET /shopcarts/{id}/calculate_total_price", "GET", f"{url}/calculate_total_price")
+        self.request("PUT /shopcarts/{id}/clear", "PUT", f"{url}/clear")
+        self.request("DELETE /shopcarts/{id}", "DELETE", url, expected=204)
+
+    def abandoner(self):
+        """Creates a cart, adds a few items and leaves it behind for browsers"""
+        cart = self.request("POST /shopcarts", "POST", SHOPCARTS, {"name": "loadtest", "items": []}, 201)
+        for _ in range(self.rng.randint(1, self.max_items)):
+            self.request("POST /shopcarts/{id}/items", "POST", f"{SHOPCARTS}/{cart['id']}/items",
+                         self.item(cart["id"]), 201)
+        self.known_carts.append(cart["id"])
+
+    def browser(self):
+        """Reads a cart it knows about, looking carts up by name if it knows none"""
+        if not self.known_carts:
+            carts = self.request("GET /shopcarts?name", "GET", f"{SHOPCARTS}?name=loadtest")
+            self.known_carts = [cart["id"] for cart in carts[:50]]
+        if self.known_carts:
+            shopcart_id = self.rng.choice(self.known_carts)
+            self.request("GET /shopcarts/{id}", "GET", f"{SHOPCARTS}/{shopcart_id}")
+            self.request("GET /shopcarts/{id}/calculate_total_price", "GET",
+                         f"{SHOPCARTS}/{shopcart_id}/calculate_total_price")
+
+
+SCENARIOS = ("shopper", "abandoner", "browser")
+
+
+def parse_mix(text: str) -> dict:
+    """Parses "shopper=6,browser=3,abandoner=1" into scenario weights"""
+    mix = {}
+    for entry in text.split(","):
+        name, _, weight = entry.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}, choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def run_user(shopper: Shopper, mix: dict, deadline: float, think: float):
+    """Runs scenarios until the deadline"""
+    names, weights = list(mix), list(mix.values())
+    while time.perf_counter() < deadline:
+        scenario = shopper.rng.choices(names, weights)[0]
+        try:
+            getattr(shopper, scenario)()
+        except RequestFailed:
+            pass  # already recorded, start the next scenario
+        if think:
+            time.sleep(min(shopper.rng.expovariate(1 / think), max(deadline - time.perf_counter(), 0)))
+    shopper.connection.close()
+
+
+def run(args) -> dict:
+    """Starts the users, waits for them and returns the summary"""
+    results = Results()
+    deadline = time.perf_counter() + args.ramp_up + args.duration
+    threads = []
+    for number in range(args.users):
+        shopper = Shopper(args.url, results, random.Random(args.seed + number), args.max_items)
+        thread = threading.Thread(target=run_user, args=(shopper, args.mix, deadline, args.think), daemon=True)
+        thread.start()
+        threads.append(thread)
+        if args.ramp_up:
+            time.sleep(args.ramp_up / args.users)
+    for thread in threads:
+        thread.join()
+    results.finished = time.perf_counter()
+    return results.summary()
+
+
+def main(argv=None) -> int:
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.loadtest", description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--url", default="http://localhost:8080", help="base URL of the service")
+    parser.add_argument("--users", type=int, default=10, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run after the ramp up")
+    parser.add_argument("--ramp-up", type=float, default=0, help="seconds over which the users are started")
+    parser.add_argument("--think", type=float, default=0, help="mean pause between scenarios in seconds")
+    parser.add_argument("--mix", type=parse_mix, default="shopper=6,browser=3,abandoner=1",
+                        help="scenario weights, e.g. shopper=6,browser=3,abandoner=1")
+    parser.add_argument("--max-items", type=int, default=5, help="most items a user adds to a cart")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the first user")
+    parser.add_argument("--json", help="also write the summary to this file")
+    parser.add_argument("--max-failure-rate", type=float, default=0.01,
+                        help="exit with status 1 above this fraction of failed requests")
+    args = parser.parse_args(argv)
+
+    print(f"{args.users} users against {args.url} for {args.duration:g}s")
+    summary = run(args)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(summary, json_file, indent=2)
+    total = summary["total"]
+    return 1 if total["requests"] and total["failures"] / total["requests"] > args.max_failure_rate else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,310 @@
+"""
+Benchmark suite
+
+Times the model methods and every REST endpoint (through the Flask test
+client) for carts of 1, 10, 100 and 1000 items, saves the results and
+compares them with a stored baseline:
+
+    python -m benchmarks.suite run --save baseline
+    python -m benchmarks.suite run --compare baseline --threshold 10
+    python -m benchmarks.suite compare baseline latest
+
+Results are kept in BENCHMARK_DIR (default .benchmarks), every run is also
+saved as "latest". A comparison exits with status 1 when a case got slower
+than the baseline by more than the threshold (in percent). A run asked to
+compare with a baseline that has not been saved yet saves itself as that
+baseline instead. Only compare runs made on the same machine. The endpoint
+cases need the database in DATABASE_URI; the carts they create are named
+after the run, and only those are removed afterwards.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+import uuid
+from collections import namedtuple
+from datetime import datetime, timezone
+from wsgi import app
+from service.models import db, Shopcart, Item, upgrade
+
+SIZES = (1, 10, 100, 1000)
+RESULTS_DIR = os.getenv("BENCHMARK_DIR", ".benchmarks")
+SHOPCARTS = "/api/shopcarts"
+# unique to the run, so that removing its carts leaves everyone else's alone
+NAME_PREFIX = f"benchmark-{uuid.uuid4().hex[:8]}-"
+# Exit status when a run to compare with has not been saved (1 means a regression)
+MISSING_RESULTS = 3
+
+# setup (optional) runs untimed before every call and its result is passed to func
+Case = namedtuple("Case", "name size func setup", defaults=(None,))
+
+
+######################################################################
+#  T I M I N G
+######################################################################
+def measure(case: Case, repeat: int = 5, min_time: float = 0.2) -> dict:
+    """Times case and returns the best and median seconds per call"""
+    if case.setup is None:
+        timer = timeit.Timer(case.func)
+        number, _ = timer.autorange()
+        runs = [seconds / number for seconds in timer.repeat(repeat=repeat, number=number)]
+    else:
+        number, runs = 0, []
+        for _ in range(repeat):
+            elapsed, calls = 0.0, 0
+            while elapsed < min_time / repeat or calls < 3:
+                argument = case.setup()
+                start = time.perf_counter()
+                case.func(argument)
+                elapsed += time.perf_counter() - start
+                calls += 1
+            runs.append(elapsed / calls)
+            number = max(number, calls)
+    return {"min": min(runs), "median": statistics.median(runs), "number": number, "repeat": repeat}
+
+
+######################################################################
+#  M O D E L   C A S E S
+######################################################################
+def item_data(index: int, shopcart_id: int = 1) -> dict:
+    """Returns the JSON of one item"""
+    return {
+        "shopcart_id": shopcart_id,
+        "item_id": str(index),
+        "description": f"item {index}",
+        "quantity": index % 7 + 1,
+        "price": 100 + index,
+    }
+
+
+def make_shopcart(size: int) -> Shopcart:
+    """Builds a transient shopcart holding size items"""
+    shopcart = Shopcart(id=1, name=f"{NAME_PREFIX}{size}")
+    shopcart.items = [Item(id=i, **item_data(i)) for i in range(size)]
+    return shopcart
+
+
+def model_cases(size: int, shopcart_id: int) -> list:
+    """Returns the model benchmarks for a cart of size items"""
+    shopcart = make_shopcart(size)
+    data = shopcart.serialize()
+    items = [item_data(i) for i in range(size)]
+
+    def deserialize_items():
+        for entry in items:
+            Item().deserialize(entry)
+
+    return [
+        Case("Shopcart.serialize", size, shopcart.serialize),
+        Case("Shopcart.deserialize", size, lambda: Shopcart().deserialize(data)),
+        Case("Item.deserialize", size, deserialize_items),
+        Case("Shopcart.calculate_total_price", size, lambda: Shopcart.calculate_total_price(shopcart_id)),
+    ]
+
+
+######################################################################
+#  E N D P O I N T   C A S E S
+######################################################################
+def seed(size: int) -> tuple:
+    """Inserts a cart with size items and returns its id and its items' ids"""
+    shopcart = Shopcart(name=f"{NAME_PREFIX}{size}")
+    db.session.add(shopcart)
+    db.session.flush()
+    item_ids = db.session.scalars(
+        db.insert(Item).returning(Item.id),
+        [item_data(i, shopcart.id) for i in range(size)],
+    ).all()
+    db.session.commit()
+    return shopcart.id, item_ids
+
+
+def remove_extra_items(shopcart_id: int, item_ids: list):
+    """Deletes the items added to a seeded cart"""
+    db.session.execute(db.delete(Item).where(Item.shopcart_id == shopcart_id, Item.id.not_in(item_ids)))
+    db.session.commit()
+
+
+def add_item(shopcart_id: int) -> int:
+    """Adds an item to a cart and returns its id"""
+    item_id = db.session.scalar(db.insert(Item).returning(Item.id), [item_data(0, shopcart_id)])
+    db.session.commit()
+    return item_id
+
+
+def endpoint_cases(client, size: int, shopcart_id: int, item_ids: list) -> list:
+    """Returns the REST endpoint benchmarks for a cart of size items"""
+    cart_url = f"{SHOPCARTS}/{shopcart_id}"
+    item_url = f"{cart_url}/items/{item_ids[0]}"
+    cart_json = {"name": f"{NAME_PREFIX}{size}", "items": [item_data(i, shopcart_id) for i in range(size)]}
+
+    def check(response, expected):
+        assert response.status_code == expected, f"{response.status_code}: {response.get_data(as_text=True)}"
+
+    def seed_cart():
+        return seed(size)[0]
+
+    def reset_cart():
+        remove_extra_items(shopcart_id, item_ids)
+
+    return [
+        Case("GET /shopcarts?name", size,
+             lambda: check(client.get(SHOPCARTS, query_string={"name": cart_json["name"]}), 200)),
+        Case("POST /shopcarts", size, lambda: check(client.post(SHOPCARTS, json=cart_json), 201)),
+        Case("GET /shopcarts/{id}", size, lambda: check(client.get(cart_url), 200)),
+        # updating a cart appends the posted items, so the extra items are removed between calls
+        Case("PUT /shopcarts/{id}", size, lambda _: check(client.put(cart_url, json=cart_json), 200), reset_cart),
+        Case("DELETE /shopcarts/{id}", size,
+             lambda new_id: check(client.delete(f"{SHOPCARTS}/{new_id}"), 204), seed_cart),
+        Case("PUT /shopcarts/{id}/clear", size,
+             lambda new_id: check(client.put(f"{SHOPCARTS}/{new_id}/clear"), 200), seed_cart),
+        Case("GET /shopcarts/{id}/calculate_total_price", size,
+             lambda: check(client.get(f"{cart_url}/calculate_total_price"), 200)),
+        Case("GET /shopcarts/{id}/items", size, lambda: check(client.get(f"{cart_url}/items"), 200)),
+        Case("POST /shopcarts/{id}/items", size,
+             lambda _: check(client.post(f"{cart_url}/items", json=item_data(size, shopcart_id)), 201), reset_cart),
+        Case("GET /shopcarts/{id}/items/{item_id}", size, lambda: check(client.get(item_url), 200)),
+        Case("PUT /shopcarts/{id}/items/{item_id}", size,
+             lambda: check(client.put(item_url, json=item_data(0, shopcart_id)), 200)),
+        Case("DELETE /shopcarts/{id}/items/{item_id}", size,
+             lambda new_id: check(client.delete(f"{cart_url}/items/{new_id}"), 204), lambda: add_item(shopcart_id)),
+    ]
+
+
+def remove_benchmark_carts():
+    """Deletes every cart this run created"""
+    db.session.execute(db.delete(Shopcart).where(Shopcart.name.startswith(NAME_PREFIX)))
+    db.session.commit()
+
+
+######################################################################
+#  R U N   A N D   C O M P A R E
+######################################################################
+def run(sizes=SIZES, pattern: str = None, repeat: int = 5) -> dict:
+    """Runs the cases whose "name[size]" matches pattern and returns their timings"""
+    results = {}
+    matcher = re.compile(pattern) if pattern else None
+    # the request logs are not what is being measured
+    app.logger.setLevel(logging.ERROR)
+    logging.getLogger("flask.app").setLevel(logging.ERROR)
+    with app.app_context():
+        upgrade()
+        client = app.test_client()
+        try:
+            for size in sizes:
+                shopcart_id, item_ids = seed(size)
+                for case in model_cases(size, shopcart_id) + endpoint_cases(client, size, shopcart_id, item_ids):
+                    key = f"{case.name}[{case.size}]"
+                    if matcher and not matcher.search(key):
+                        continue
+                    results[key] = measure(case, repeat)
+                    print(f"  {key:<52} {results[key]['min'] * 1e6:12.1f} us/call")
+                    db.session.remove()
+        finally:
+            remove_benchmark_carts()
+    return results
+
+
+def result_path(name: str) -> str:
+    """Returns the file of a saved run (name may also be a path)"""
+    if name.endswith(".json") or os.sep in name:
+        return name
+    return os.path.join(RESULTS_DIR, f"{name}.json")
+
+
+def save(results: dict, name: str) -> str:
+    """Writes results with a description of where they were measured"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    path = result_path(name)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as result_file:
+        json.dump({
+            "created": datetime.now(timezone.utc).isoformat(),
+            "commit": commit,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }, result_file, indent=2, sort_keys=True)
+    return path
+
+
+def load(name: str) -> dict:
+    """Returns the results of a saved run"""
+    with open(result_path(name), encoding="utf-8") as result_file:
+        return json.load(result_file)["results"]
+
+
+def compare(baseline: dict, current: dict, threshold: float, stat: str = "min") -> list:
+    """Prints how each case changed and returns the ones that regressed"""
+    regressions = []
+    print(f"  {'case':<52} {'baseline':>12} {'current':>12} {'change':>8}")
+    for key, timing in current.items():
+        if key not in baseline:
+            print(f"  {key:<52} {'-':>12} {timing[stat] * 1e6:12.1f} {'new':>8}")
+            continue
+        before, after = baseline[key][stat], timing[stat]
+        change = (after - before) / before * 100
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"  {key:<52} {before * 1e6:12.1f} {after * 1e6:12.1f} {change:+7.1f}%{flag}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.suite", description=__doc__.split("\n\n", maxsplit=1)[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="comma separated cart sizes")
+    run_parser.add_argument("-k", "--filter", help="only run cases whose 'name[size]' matches this regex")
+    run_parser.add_argument("--repeat", type=int, default=5, help="timing runs per case")
+    run_parser.add_argument("--save", help="also save the results under this name")
+    run_parser.add_argument("--compare", help="compare with this saved run")
+    compare_parser = commands.add_parser("compare", help="compare two saved runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current", nargs="?", default="latest")
+    for sub in (run_parser, compare_parser):
+        sub.add_argument("--threshold", type=float, default=10.0, help="allowed slowdown in percent")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        missing = [name for name in (args.baseline, args.current) if not os.path.exists(result_path(name))]
+        if missing:
+            print(f"No saved run {missing[0]!r} in {result_path(missing[0])}; "
+                  f"run `python -m benchmarks.suite run --save {missing[0]}` first", file=sys.stderr)
+            return MISSING_RESULTS
+        baseline, current = load(args.baseline), load(args.current)
+    else:
+        current = run([int(size) for size in args.sizes.split(",")], args.filter, args.repeat)
+        save(current, "latest")
+        if args.save:
+            print(f"Saved {save(current, args.save)}")
+        if not args.compare:
+            return 0
+        if not os.path.exists(result_path(args.compare)):
+            # a fresh checkout: this run becomes the baseline the next runs are compared with
+            print(f"No saved run {args.compare!r} to compare with; saved this run as {save(current, args.compare)}")
+            return 0
+        baseline = load(args.compare)
+
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} case(s) slower than the baseline by more than {args.threshold:g}%")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
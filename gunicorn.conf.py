@@ -0,0 +1,19 @@
+"""
+Gunicorn settings, read from the working directory by the Procfile and the image
+
+Workers are threaded so that admission control has requests in flight to
+count: each handles WORKER_THREADS requests at once (see service/config.py).
+When a worker exits its metrics snapshot is folded into the totals of the
+exited workers (see service/common/metrics.py).
+"""
+from service import config
+from service.common import metrics
+
+worker_class = "gthread"  # pylint: disable=invalid-name
+threads = config.WORKER_THREADS
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Called in the master after a worker has exited"""
+    if config.METRICS_ENABLED and config.PROMETHEUS_MULTIPROC_DIR:
+        metrics.merge_exited_worker(metrics.REGISTRY, config.PROMETHEUS_MULTIPROC_DIR, worker.pid)
@@ -18,69 +18,116 @@ Package for the application models and service routes
 This module creates and configures the Flask app and sets up the logging
 and SQL database
 """
-import sys
+import json
 from flask import Flask
 from flask_restx import Api
 from service import config
 from service.common import log_handlers
+from service.common.startup import StartupTimer
 
 # Will be initialize when app is created
 api = None  # pylint: disable=invalid-name
 
 
+class ShopcartsApi(Api):
+    """An Api that serves a prebuilt OpenAPI spec when it is given one"""
+
+    spec = None
+
+    @property
+    def __schema__(self):
+        """The prebuilt spec, or the one flask-restx builds from the api models"""
+        if self.spec is not None:
+            return self.spec
+        return super().__schema__
+
+
 ############################################################
 # Initialize the Flask instance
 ############################################################
 def create_app():
     """Initialize the core application."""
-    # Create Flask application
-    app = Flask(__name__)
-    app.config.from_object(config)
+    # pylint: disable=import-outside-toplevel, too-many-locals
+    timer = StartupTimer()
+
+    with timer.phase("flask"):
+        # Create Flask application
+        app = Flask(__name__)
+        app.config.from_object(config)
+
+        # Turn off strict slashes because it violates best practices
+        app.url_map.strict_slashes = False
 
-    # Turn off strict slashes because it violates best practices
-    app.url_map.strict_slashes = False
+        # Profile requests on demand when PROFILE_TOKEN or PROFILE_SAMPLE_RATE is set
+        from service.common.profiling import init_profiling
 
-    # Initialize Plugins
-    # pylint: disable=import-outside-toplevel
-    from service.models import db
+        init_profiling(app)
 
-    db.init_app(app)
+        # Shed requests over the in-flight limits before they reach the app
+        from service.common.admission import init_admission
+
+        init_admission(app)
+
+    with timer.phase("database"):
+        # Initialize Plugins
+        from service.models import db
+        from service.common.metrics import init_metrics
+        from service.common.query_stats import init_query_stats
+        from service.common.slow_queries import init_slow_query_log
+        from service.common.tracing import init_tracing
+        from service.common.rate_limit import init_rate_limit
+
+        # Metrics must set the pool class before the engine is created
+        init_metrics(app)
+        init_query_stats(app)
+        init_slow_query_log(app)
+        init_tracing(app)
+        init_rate_limit(app)
+        db.init_app(app)
 
     ######################################################################
     # Configure Swagger before initializing it
     ######################################################################
-    global api
-    api = Api(
-        app,
-        version="1.0.0",
-        title="Shopcarts RESTX API Service",
-        description="This is a Shopcarts server.",
-        default="shopcarts",
-        default_label="Shopcarts operations",
-        doc="/apidocs",
-        prefix="/api",
-    )
+    with timer.phase("api"):
+        global api
+        docs_enabled = app.config["API_DOCS_ENABLED"]
+        api = ShopcartsApi(
+            version="1.0.0",
+            title="Shopcarts RESTX API Service",
+            description="This is a Shopcarts server.",
+            default="shopcarts",
+            default_label="Shopcarts operations",
+            doc="/apidocs" if docs_enabled else False,
+            prefix="/api",
+        )
+        api.init_app(app, add_specs=docs_enabled)
 
     with app.app_context():
-        # Dependencies require we import the routes AFTER the Flask app is created
-        # pylint: disable=wrong-import-position, wrong-import-order, unused-import
-        from service import routes, models  # noqa: F401 E402
-        from service.common import error_handlers, cli_commands  # noqa: F401, E402
+        with timer.phase("routes"):
+            # Dependencies require we import the routes AFTER the Flask app is created
+            # pylint: disable=wrong-import-position, wrong-import-order, unused-import
+            from service import routes, admin_routes, models  # noqa: F401 E402
+            from service.common import error_handlers, cli_commands  # noqa: F401, E402
+
+        # The schema is managed by "flask db-upgrade" so startup issues no DDL
+
+        # The OpenAPI spec is built on first use unless a prebuilt one is supplied
+        if app.config["OPENAPI_SPEC_FILE"]:
+            with timer.phase("openapi"):
+                with open(app.config["OPENAPI_SPEC_FILE"], encoding="utf-8") as spec_file:
+                    api.spec = json.load(spec_file)
 
-        try:
-            db.create_all()
-        except Exception as error:  # pylint: disable=broad-except
-            app.logger.critical("%s: Cannot continue", error)
-            # gunicorn requires exit code 4 to stop spawning workers when they die
-            sys.exit(4)
+        with timer.phase("logging"):
+            # Set up logging for production
+            log_handlers.init_logging(app, "gunicorn.error")
 
-        # Set up logging for production
-        log_handlers.init_logging(app, "gunicorn.error")
+        app.extensions["startup_timer"] = timer
 
         app.logger.info(70 * "*")
         app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
         app.logger.info(70 * "*")
 
+        app.logger.info(timer.report())
         app.logger.info("Service initialized!")
 
         return app
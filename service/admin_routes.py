@@ -0,0 +1,127 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Admin Routes
+
+Operational endpoints under /admin. They are not part of the Shopcarts
+API, are left out of the Swagger docs and require the admin token (see
+service/common/admin.py).
+"""
+
+import os
+from flask import Response, abort, request, send_from_directory
+from flask import current_app as app  # Import Flask application
+from service.models import db
+from service.common import status  # HTTP Status Codes
+from service.common.admin import admin_required
+from service.common import export, memory
+
+
+######################################################################
+# GET MEMORY REPORT
+######################################################################
+@app.route("/admin/memory")
+@admin_required
+def memory_report():
+    """Returns the memory statistics of this worker"""
+    limit = request.args.get("limit", 10, type=int)
+    return memory.memory_report(limit), status.HTTP_200_OK
+
+
+######################################################################
+# TAKE A MEMORY SNAPSHOT
+######################################################################
+@app.route("/admin/memory/snapshots", methods=["POST"])
+@admin_required
+def take_memory_snapshot():
+    """Starts tracemalloc if needed and stores a snapshot of the heap"""
+    snapshot_id = memory.snapshots.take(app.config["MEMORY_MAX_SNAPSHOTS"])
+    app.logger.info("Took memory snapshot %s", snapshot_id)
+    return {"id": snapshot_id}, status.HTTP_201_CREATED
+
+
+######################################################################
+# COMPARE TWO MEMORY SNAPSHOTS
+######################################################################
+@app.route("/admin/memory/snapshots/<int:old_id>/diff/<int:new_id>")
+@admin_required
+def diff_memory_snapshots(old_id, new_id):
+    """Returns the allocation sites that changed the most between two snapshots"""
+    old, new = memory.snapshots.get(old_id), memory.snapshots.get(new_id)
+    if old is None or new is None:
+        abort(status.HTTP_404_NOT_FOUND, f"No such memory snapshot: {old_id if old is None else new_id}")
+    limit = request.args.get("limit", 10, type=int)
+    return {"old": old_id, "new": new_id, "diff": memory.diff_allocations(old, new, limit)}, status.HTTP_200_OK
+
+
+######################################################################
+# DELETE ALL MEMORY SNAPSHOTS
+######################################################################
+@app.route("/admin/memory/snapshots", methods=["DELETE"])
+@admin_required
+def clear_memory_snapshots():
+    """Drops the snapshots and stops tracemalloc"""
+    memory.snapshots.clear()
+    return "", status.HTTP_204_NO_CONTENT
+
+
+######################################################################
+# STREAM AN EXPORT OF ALL CARTS
+######################################################################
+@app.route("/admin/export")
+@admin_required
+def export_carts():
+    """Streams every cart as NDJSON (default) or CSV
+
+    min_id and max_id limit the export to a range of cart ids so that
+    clients can fetch parts of it in parallel.
+    """
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        abort(status.HTTP_400_BAD_REQUEST, f"Unsupported export format {fmt!r}, choose ndjson or csv")
+    first_id = request.args.get("min_id", type=int)
+    last_id = request.args.get("max_id", type=int)
+    batch_size = max(request.args.get("batch_size", 1000, type=int), 1)
+    app.logger.info("Exporting carts as %s (ids %s to %s)", fmt, first_id, last_id)
+    # the generator opens its own connection, so the stream outlives the request's session
+    chunks = export.export_carts(db.engine, fmt, first_id, last_id, batch_size)
+    return Response(chunks, mimetype=export.MEDIA_TYPES[fmt], headers={
+        "Content-Disposition": f"attachment; filename=shopcarts.{fmt}",
+    })
+
+
+######################################################################
+# LIST THE SAVED PROFILES
+######################################################################
+@app.route("/admin/profiles")
+@admin_required
+def list_profiles():
+    """Returns the names of the request profiles in PROFILE_DIR, newest first"""
+    directory = app.config["PROFILE_DIR"]
+    names = os.listdir(directory) if os.path.isdir(directory) else []
+    # the names start with the time of the request
+    return {"profiles": sorted(names, reverse=True)}, status.HTTP_200_OK
+
+
+######################################################################
+# DOWNLOAD A PROFILE
+######################################################################
+@app.route("/admin/profiles/<name>")
+@admin_required
+def download_profile(name):
+    """Returns a profile by the name it was given in X-Profile-File"""
+    return send_from_directory(app.config["PROFILE_DIR"], name, as_attachment=True)
@@ -0,0 +1,42 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Admin Endpoint Guard
+
+Admin endpoints are only served when ADMIN_TOKEN is set, and only to
+requests that send it as "Authorization: Bearer <ADMIN_TOKEN>".
+"""
+import hmac
+from functools import wraps
+from flask import abort, current_app, request
+from . import status
+
+
+def admin_required(func):
+    """Rejects requests that do not carry the admin token"""
+
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        token = current_app.config.get("ADMIN_TOKEN")
+        if not token:
+            abort(status.HTTP_404_NOT_FOUND)
+        scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(credentials.encode(), token.encode()):
+            abort(status.HTTP_401_UNAUTHORIZED)
+        return func(*args, **kwargs)
+
+    return decorated
@@ -0,0 +1,132 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Admission Control
+
+WSGI middleware that caps how many requests a worker handles at once,
+in total and separately for reads (GET, HEAD, OPTIONS) and writes. A
+request over a cap is answered at once with 503 and Retry-After instead
+of waiting behind the others, so latency stays bounded during a spike
+and clients back off. The probe and metrics endpoints are never shed.
+
+The number of requests in flight and the number shed are exported as
+Prometheus metrics.
+"""
+import json
+import threading
+from . import status
+from .metrics import REGISTRY, Counter, Gauge
+
+READ_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+IN_FLIGHT = Gauge(
+    REGISTRY, "shopcarts_requests_in_flight", "Requests being handled by route class", ("route_class",)
+)
+SHED = Counter(
+    REGISTRY, "shopcarts_requests_shed_total", "Requests rejected by admission control", ("route_class",)
+)
+
+
+class AdmissionController:
+    """Counts requests in flight and admits them while under the limits
+
+    A limit of 0 means no limit.
+    """
+
+    def __init__(self, max_in_flight: int = 0, max_reads: int = 0, max_writes: int = 0):
+        self.limits = {"total": max_in_flight, "read": max_reads, "write": max_writes}
+        self.in_flight = {"total": 0, "read": 0, "write": 0}
+        self.lock = threading.Lock()
+
+    def _full(self, name: str) -> bool:
+        limit = self.limits[name]
+        return 0 < limit <= self.in_flight[name]
+
+    def try_acquire(self, route_class: str) -> bool:
+        """Admits a request of route_class if there is room for it"""
+        with self.lock:
+            if self._full("total") or self._full(route_class):
+                return False
+            self.in_flight["total"] += 1
+            self.in_flight[route_class] += 1
+            count = self.in_flight[route_class]
+        IN_FLIGHT.set(count, route_class=route_class)
+        return True
+
+    def release(self, route_class: str):
+        """Marks an admitted request as finished"""
+        with self.lock:
+            self.in_flight["total"] -= 1
+            self.in_flight[route_class] -= 1
+            count = self.in_flight[route_class]
+        IN_FLIGHT.set(count, route_class=route_class)
+
+
+class AdmissionMiddleware:
+    """Rejects requests over the controller's limits with 503"""
+
+    def __init__(self, wsgi_app, controller: AdmissionController, retry_after: int = 1, exempt_paths=()):
+        self.wsgi_app = wsgi_app
+        self.controller = controller
+        self.retry_after = str(retry_after)
+        self.exempt_paths = frozenset(exempt_paths)
+
+    def reject(self, start_response, route_class: str):
+        """Answers with 503 without touching the app"""
+        SHED.inc(route_class=route_class)
+        body = json.dumps({
+            "status_code": status.HTTP_503_SERVICE_UNAVAILABLE,
+            "error": "Service Unavailable",
+            "message": f"Too many {route_class} requests in progress, retry later",
+        }).encode("utf-8")
+        start_response("503 SERVICE UNAVAILABLE", [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body))),
+            ("Retry-After", self.retry_after),
+        ])
+        return [body]
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") in self.exempt_paths:
+            return self.wsgi_app(environ, start_response)
+        route_class = "read" if environ.get("REQUEST_METHOD", "GET") in READ_METHODS else "write"
+        if not self.controller.try_acquire(route_class):
+            return self.reject(start_response, route_class)
+        # Flask has run the view and built the body by the time wsgi_app
+        # returns; only streamed bodies are produced later, and long-lived
+        # streams must not hold a slot anyway
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            self.controller.release(route_class)
+
+
+def init_admission(app):
+    """Wraps the app in admission control when any limit is set"""
+    controller = AdmissionController(
+        app.config["ADMISSION_MAX_IN_FLIGHT"],
+        app.config["ADMISSION_MAX_READS"],
+        app.config["ADMISSION_MAX_WRITES"],
+    )
+    if not any(controller.limits.values()):
+        return
+    app.wsgi_app = AdmissionMiddleware(
+        app.wsgi_app,
+        controller,
+        retry_after=app.config["ADMISSION_RETRY_AFTER"],
+        exempt_paths=app.config["ADMISSION_EXEMPT_PATHS"],
+    )
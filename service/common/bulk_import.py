@@ -0,0 +1,273 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Bulk Import
+
+Loads carts and items from NDJSON or CSV in the formats written by the
+bulk export. The input is streamed and handled a batch at a time: rows
+are validated with the same rules as Item.deserialize(), the valid ones
+are copied into temporary staging tables with COPY FROM and merged into
+the shopcart and item tables in one transaction per batch. Rows that
+fail validation are written to a rejects file and do not stop the import.
+
+Carts keep their source id only as a key that groups their rows, even
+across batches, and get new ids from the shopcart sequence. Databases
+other than PostgreSQL are loaded with multi-row INSERTs instead.
+"""
+import csv
+import json
+import time
+from collections import namedtuple
+from sqlalchemy import text
+from service.models import Shopcart, Item, DataValidationError
+
+FORMATS = ("ndjson", "csv")
+INT_RANGE = range(-2**31, 2**31)
+ITEM_FIELDS = ("item_id", "description", "quantity", "price")
+
+# a cart and one of its items (None for a cart without items) as read from the input
+Row = namedtuple("Row", "line key name item record error", defaults=(None,))
+
+_STAGING = (
+    "DROP TABLE IF EXISTS import_cart, import_item, import_key_map",
+    "CREATE TEMP TABLE import_cart (source_key text PRIMARY KEY, name varchar(64) NOT NULL) ON COMMIT DELETE ROWS",
+    "CREATE TEMP TABLE import_item (source_key text NOT NULL, item_id varchar(16) NOT NULL, "
+    "description varchar(64) NOT NULL, quantity integer NOT NULL, price integer NOT NULL) ON COMMIT DELETE ROWS",
+    # lives for the whole import so a cart's rows can span batches
+    "CREATE TEMP TABLE import_key_map (source_key text PRIMARY KEY, shopcart_id integer NOT NULL)",
+)
+_MERGE_CARTS = """
+WITH new_carts AS (
+    INSERT INTO import_key_map (source_key, shopcart_id)
+    SELECT s.source_key, nextval(pg_get_serial_sequence('shopcart', 'id'))
+    FROM import_cart s LEFT JOIN import_key_map m USING (source_key)
+    WHERE m.source_key IS NULL
+    RETURNING source_key, shopcart_id
+)
+INSERT INTO shopcart (id, name)
+SELECT n.shopcart_id, s.name FROM new_carts n JOIN import_cart s USING (source_key)
+"""
+_MERGE_ITEMS = """
+INSERT INTO item (shopcart_id, item_id, description, quantity, price)
+SELECT m.shopcart_id, i.item_id, i.description, i.quantity, i.price
+FROM import_item i JOIN import_key_map m USING (source_key)
+"""
+
+
+######################################################################
+#  R E A D E R S
+######################################################################
+def ndjson_rows(lines):
+    """Yields a Row for every item of every cart in NDJSON lines"""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            cart = json.loads(line)
+            items = cart.get("items") or [None]
+            if not isinstance(items, list):
+                raise ValueError("items is not a list")
+        except (ValueError, AttributeError) as error:
+            yield Row(number, None, None, None, line.rstrip("\n"), f"Invalid JSON cart: {error}")
+            continue
+        key = cart.get("id", f"line-{number}")
+        for item in items:
+            record = {"id": key, "name": cart.get("name"), "items": [item] if item is not None else []}
+            yield Row(number, key, cart.get("name"), item, record)
+
+
+def csv_rows(lines):
+    """Yields a Row for every line of a CSV export"""
+    reader = csv.DictReader(lines)
+    for record in reader:
+        item = {field: record.get(field) for field in ITEM_FIELDS}
+        if not any(item.values()):
+            item = None  # a cart without items
+        yield Row(reader.line_num, record.get("shopcart_id") or None, record.get("shopcart_name"), item, record)
+
+
+READERS = {"ndjson": ndjson_rows, "csv": csv_rows}
+
+
+######################################################################
+#  V A L I D A T I O N
+######################################################################
+def _check_text(value, what: str, length: int):
+    if not isinstance(value, str) or not value:
+        raise DataValidationError(f"Invalid {what}: must be a non-empty string")
+    if len(value) > length:
+        raise DataValidationError(f"Invalid {what}: longer than {length} characters")
+
+
+def validate_row(row: Row) -> tuple:
+    """Checks a row with the API's rules and the columns' limits
+
+    Returns:
+        tuple: (key, name, (item_id, description, quantity, price) or None)
+
+    Raises:
+        DataValidationError: when the row cannot be imported
+    """
+    if row.error:
+        raise DataValidationError(row.error)
+    if row.key is None:
+        raise DataValidationError("Invalid Shopcart: missing id")
+    _check_text(row.name, "Shopcart name", Shopcart.__table__.c.name.type.length)
+    if row.item is None:
+        return str(row.key), row.name, None
+    if not isinstance(row.item, dict):
+        raise DataValidationError("Invalid Item: not an object")
+    item = Item().deserialize(dict(row.item, shopcart_id=row.key))
+    for field in ("item_id", "description"):
+        _check_text(getattr(item, field), f"Item {field}", Item.__table__.c[field].type.length)
+    for field in ("quantity", "price"):
+        if getattr(item, field) not in INT_RANGE:
+            raise DataValidationError(f"Invalid Item {field}: out of range")
+    return str(row.key), row.name, (item.item_id, item.description, item.quantity, item.price)
+
+
+######################################################################
+#  L O A D E R S
+######################################################################
+class Importer:
+    """Validates rows and merges them into the database a batch at a time
+
+    Args:
+        connection: a SQLAlchemy Connection
+        rejects: optional text file that rejected rows are written to as NDJSON
+        batch_size: rows per batch and transaction
+    """
+
+    def __init__(self, connection, rejects=None, batch_size: int = 5000):
+        self.connection = connection
+        self.rejects = rejects
+        self.batch_size = batch_size
+        self.copy = connection.dialect.name == "postgresql"
+        self.key_map = {}  # source key -> shopcart id, when not using COPY
+        self.carts, self.items = {}, []
+        self.totals = {"rows": 0, "shopcarts": 0, "items": 0, "rejects": 0, "seconds": 0.0}
+
+    def reject(self, row: Row, error: Exception):
+        """Records a row that failed validation"""
+        self.totals["rejects"] += 1
+        if self.rejects is not None:
+            self.rejects.write(json.dumps({"line": row.line, "error": str(error), "record": row.record}) + "\n")
+
+    def add(self, row: Row):
+        """Validates a row and queues it for the current batch"""
+        self.totals["rows"] += 1
+        try:
+            key, name, item = validate_row(row)
+        except DataValidationError as error:
+            self.reject(row, error)
+            return
+        self.carts.setdefault(key, name)
+        if item is not None:
+            self.items.append((key, *item))
+
+    def _copy_batch(self):
+        cursor = self.connection.connection.cursor()
+        try:
+            with cursor.copy("COPY import_cart (source_key, name) FROM STDIN") as copy:
+                for cart in self.carts.items():
+                    copy.write_row(cart)
+            with cursor.copy("COPY import_item (source_key, item_id, description, quantity, price) FROM STDIN") as copy:
+                for item in self.items:
+                    copy.write_row(item)
+        finally:
+            cursor.close()
+        self.totals["shopcarts"] += self.connection.execute(text(_MERGE_CARTS)).rowcount
+        self.totals["items"] += self.connection.execute(text(_MERGE_ITEMS)).rowcount
+
+    def _insert_batch(self):
+        new = [(key, name) for key, name in self.carts.items() if key not in self.key_map]
+        if new:
+            ids = self.connection.execute(
+                Shopcart.__table__.insert().returning(Shopcart.__table__.c.id, sort_by_parameter_order=True),
+                [{"name": name} for _, name in new],
+            ).scalars().all()
+            self.key_map.update(zip((key for key, _ in new), ids))
+            self.totals["shopcarts"] += len(ids)
+        if self.items:
+            self.connection.execute(Item.__table__.insert(), [
+                {"shopcart_id": self.key_map[key], "item_id": item_id, "description": description,
+                 "quantity": quantity, "price": price}
+                for key, item_id, description, quantity, price in self.items
+            ])
+            self.totals["items"] += len(self.items)
+
+    def flush(self):
+        """Loads and commits the queued rows"""
+        if self.carts:
+            if self.copy:
+                self._copy_batch()
+            else:
+                self._insert_batch()
+        self.connection.commit()
+        self.carts, self.items = {}, []
+
+    def run(self, rows, progress=None) -> dict:
+        """Imports every row and returns the totals
+
+        Args:
+            rows: Rows from one of the READERS
+            progress: optional callable that is passed the totals after each batch
+        """
+        start = time.perf_counter()
+        if self.copy:
+            for statement in _STAGING:
+                self.connection.execute(text(statement))
+        try:
+            for row in rows:
+                self.add(row)
+                if len(self.carts) + len(self.items) >= self.batch_size:
+                    self.flush()
+                    self.totals["seconds"] = round(time.perf_counter() - start, 3)
+                    if progress:
+                        progress(self.totals)
+            self.flush()
+        finally:
+            if self.copy:
+                self.connection.rollback()
+                self.connection.execute(text(_STAGING[0]))
+                self.connection.commit()
+        if self.copy and self.totals["shopcarts"]:
+            # give the planner statistics for the new data
+            self.connection.execute(text("ANALYZE shopcart, item"))
+            self.connection.commit()
+        self.totals["seconds"] = round(time.perf_counter() - start, 3)
+        return self.totals
+
+
+def import_carts(connection, lines, fmt: str, rejects=None, batch_size: int = 5000, progress=None) -> dict:
+    """Imports the carts in lines of NDJSON or CSV and returns the totals
+
+    Args:
+        connection: a SQLAlchemy Connection
+        lines: an iterable of text lines, such as an open file
+        fmt: "ndjson" or "csv"
+        rejects: optional text file for the rows that failed validation
+        batch_size: rows per batch and transaction
+        progress: optional callable that is passed the totals after each batch
+
+    Returns:
+        dict: the number of rows read, carts and items created, rejects and seconds taken
+    """
+    # pylint: disable=too-many-arguments
+    if fmt not in READERS:
+        raise ValueError(f"Unknown import format {fmt!r}")
+    return Importer(connection, rejects, batch_size).run(READERS[fmt](lines), progress)
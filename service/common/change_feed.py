@@ -0,0 +1,148 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Change Feed
+
+The dispatcher takes the events that writes appended to outbox_event
+and publishes them a batch at a time by giving each one the next
+position of the feed. Only one dispatcher numbers events at a time, so
+positions grow in the order events are published: a consumer that reads
+the events after the last position it has seen never misses one, even
+when transactions commit out of the order of their ids.
+
+Consumers read the feed with GET /api/events?after=<position>, which
+waits a while for new events when there are none (long polling). The
+newest published event is never pruned, so positions keep growing even
+after the feed has been quiet for longer than the retention period.
+"""
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import bindparam, func, select, text
+from service.models import outbox_event
+
+# Arbitrary key for pg_advisory_xact_lock so dispatchers take turns
+DISPATCH_LOCK_ID = 20_241_115
+
+_PENDING = select(outbox_event.c.id).where(outbox_event.c.position.is_(None)).order_by(outbox_event.c.id)
+_LAST_POSITION = select(func.coalesce(func.max(outbox_event.c.position), 0))
+_PUBLISH = (
+    outbox_event.update()
+    .where(outbox_event.c.id == bindparam("event_id"))
+    .values(position=bindparam("event_position"), dispatched_at=func.now())
+)
+
+
+def dispatch_batch(connection, batch_size: int) -> int:
+    """Publishes up to batch_size pending events in one transaction
+
+    Returns:
+        int: the number of events published
+    """
+    with connection.begin():
+        if connection.dialect.name == "postgresql":
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": DISPATCH_LOCK_ID})
+        ids = connection.execute(_PENDING.limit(batch_size)).scalars().all()
+        if not ids:
+            return 0
+        last = last_position(connection)
+        connection.execute(_PUBLISH, [
+            {"event_id": event_id, "event_position": last + number} for number, event_id in enumerate(ids, 1)
+        ])
+    return len(ids)
+
+
+def prune(connection, retention_days: float, now: datetime = None) -> int:
+    """Deletes the events published more than retention_days ago, but the newest, and returns how many"""
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=retention_days)
+    with connection.begin():
+        return connection.execute(
+            outbox_event.delete()
+            .where(outbox_event.c.dispatched_at < cutoff)
+            .where(outbox_event.c.position < _LAST_POSITION.scalar_subquery())
+        ).rowcount
+
+
+def dispatch_events(connection, batch_size: int = 500, interval: float = 1.0, retention_days: float = None,
+                    once: bool = False, progress=None) -> dict:
+    """Publishes pending events until stopped, or until there are none left when once is set
+
+    Args:
+        connection: a SQLAlchemy Connection outside of a transaction
+        batch_size: events per batch and transaction
+        interval: seconds to sleep when there is nothing to publish
+        retention_days: also delete events published longer ago than this, at most once an hour
+        once: return as soon as every pending event is published
+        progress: optional callable that is passed the totals after each batch
+
+    Returns:
+        dict: the number of events published and pruned and the batches run
+    """
+    # pylint: disable=too-many-arguments
+    totals = {"events": 0, "batches": 0, "pruned": 0}
+    pruned_at = None
+    while True:
+        if retention_days is not None and (pruned_at is None or time.monotonic() - pruned_at > 3600):
+            totals["pruned"] += prune(connection, retention_days)
+            pruned_at = time.monotonic()
+        published = dispatch_batch(connection, batch_size)
+        if published:
+            totals["events"] += published
+            totals["batches"] += 1
+            if progress:
+                progress(totals)
+        if published < batch_size:
+            if once:
+                return totals
+            time.sleep(interval)
+
+
+def last_position(connection) -> int:
+    """Returns the position of the newest published event (0 when there is none)"""
+    return connection.execute(_LAST_POSITION).scalar()
+
+
+def read_feed(connection, after: int, limit: int, shopcart_id: int = None) -> list:
+    """Returns up to limit published events after position, of one cart or all, as dictionaries"""
+    statement = select(outbox_event).where(outbox_event.c.position > after)
+    if shopcart_id is not None:
+        statement = statement.where(outbox_event.c.shopcart_id == shopcart_id)
+    rows = connection.execute(statement.order_by(outbox_event.c.position).limit(limit))
+    return [
+        {
+            "position": row.position,
+            "type": row.event_type,
+            "shopcart_id": row.shopcart_id,
+            "data": row.payload,
+            "created_at": row.created_at.isoformat(),
+        }
+        for row in rows
+    ]
+
+
+def wait_for_events(engine, after: int, limit: int, wait: float, poll_interval: float) -> list:
+    """Reads the feed, polling every poll_interval for up to wait seconds until there are events
+
+    A connection is only checked out of the pool while the feed is read.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        with engine.connect() as connection:
+            events = read_feed(connection, after, limit)
+        remaining = deadline - time.monotonic()
+        if events or remaining <= 0:
+            return events
+        time.sleep(min(poll_interval, remaining))
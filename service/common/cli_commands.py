@@ -16,8 +16,15 @@
 """
 Flask CLI Command Extensions
 """
+import json
+import click
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from service import api
+from service.models import db, upgrade
+from service.common import export, memory
+from service.common import change_feed, partitions, purge
+from service.common.bulk_import import FORMATS as IMPORT_FORMATS, import_carts as load_carts
+from service.common.seed_data import DISTRIBUTIONS, DataGenerator, seed_data as load_seed_data, truncate
 
 
 ######################################################################
@@ -32,5 +39,320 @@ def db_create():
     production. ;-)
     """
     db.drop_all()
-    db.create_all()
     db.session.commit()
+    upgrade()
+
+
+######################################################################
+# Command to apply pending schema migrations
+# Usage:
+#   flask db-upgrade [--target VERSION]
+######################################################################
+@app.cli.command("db-upgrade")
+@click.option("--target", type=int, default=None, help="Version to migrate to (default: latest)")
+def db_upgrade(target):
+    """
+    Applies any pending schema migrations. This is safe to run on every
+    deploy and should be run before the service is started.
+    """
+    applied = upgrade(target)
+    if applied:
+        click.echo(f"Applied migrations: {', '.join(str(version) for version in applied)}")
+    else:
+        click.echo("Database schema is up to date")
+
+
+######################################################################
+# Command to write a prebuilt OpenAPI spec for OPENAPI_SPEC_FILE
+# Usage:
+#   flask openapi-spec [--output FILE]
+######################################################################
+@app.cli.command("openapi-spec")
+@click.option("--output", type=click.File("w"), default="-", help="File to write the spec to (default: stdout)")
+def openapi_spec(output):
+    """
+    Builds the Swagger/OpenAPI spec from the api models and writes it as
+    JSON so it can be served as a prebuilt spec
+    """
+    with app.test_request_context():
+        output.write(json.dumps(api.__schema__, indent=2))
+    output.write("\n")
+
+
+######################################################################
+# Command to report memory use, optionally around a request
+# Usage:
+#   flask memory-report [--path /api/shopcarts] [--repeat N] [--top N]
+######################################################################
+@app.cli.command("memory-report")
+@click.option("--path", default=None, help="Request to measure, e.g. /api/shopcarts")
+@click.option("--repeat", type=int, default=1, help="How many times to send the request")
+@click.option("--top", type=int, default=10, help="Number of allocation sites to show")
+def memory_report(path, repeat, top):
+    """
+    Prints the memory statistics of this process as JSON. With --path the
+    request is sent through the app and the allocations it left behind
+    are reported as a diff of tracemalloc snapshots.
+    """
+    report = {}
+    if path:
+        before = memory.snapshots.take()
+        client = app.test_client()
+        statuses = [client.get(path).status_code for _ in range(repeat)]
+        after = memory.snapshots.take()
+        report["request"] = {"path": path, "repeat": repeat, "statuses": sorted(set(statuses))}
+        report["diff"] = memory.diff_allocations(memory.snapshots.get(before), memory.snapshots.get(after), top)
+    report.update(memory.memory_report(top))
+    if path:
+        memory.snapshots.clear()
+    click.echo(json.dumps(report, indent=2))
+
+
+######################################################################
+# Command to bulk load synthetic carts and items
+# Usage:
+#   flask seed-data [--carts N] [--max-items N] [--seed N] [--truncate]
+######################################################################
+@app.cli.command("seed-data")
+@click.option("--carts", type=int, default=10000, help="Number of carts to create")
+@click.option("--max-items", type=int, default=50, help="Largest number of items in a cart")
+@click.option("--distribution", type=click.Choice(DISTRIBUTIONS), default="zipf", help="Distribution of cart sizes")
+@click.option("--size-skew", type=float, default=1.1, help="Zipf exponent of the cart sizes")
+@click.option("--products", type=int, default=5000, help="Number of distinct products")
+@click.option("--product-skew", type=float, default=1.0, help="Zipf exponent of product popularity (0 = no hot items)")
+@click.option("--seed", type=int, default=42, help="Random seed, the same seed loads the same data")
+@click.option("--batch-size", type=int, default=10000, help="Carts per batch and transaction")
+@click.option("--truncate", "clear", is_flag=True, help="Delete every cart and item first")
+def seed_data(carts, max_items, distribution, size_skew, products, product_skew, seed, batch_size, clear):
+    """
+    Bulk loads synthetic carts and items for benchmarks and load tests.
+    Cart sizes and product popularity are Zipf skewed and the data is
+    deterministic for a given seed. PostgreSQL is loaded with COPY.
+    """
+    # pylint: disable=too-many-arguments
+    generator = DataGenerator(seed, max_items, size_skew, distribution, products, product_skew)
+    with db.engine.connect() as connection:
+        if clear:
+            truncate(connection)
+        totals = load_seed_data(
+            connection, generator, carts, batch_size,
+            progress=lambda t: click.echo(f"  {t['shopcarts']} carts, {t['items']} items", err=True),
+        )
+    rate = (totals["shopcarts"] + totals["items"]) / totals["seconds"] if totals["seconds"] else 0
+    click.echo(
+        f"Seeded {totals['shopcarts']} shopcarts and {totals['items']} items "
+        f"in {totals['seconds']:.1f}s ({rate:,.0f} rows/s)"
+    )
+
+
+######################################################################
+# Command to export every cart and item
+# Usage:
+#   flask export-carts [--format ndjson|csv|parquet] [--output FILE] [--parallel N]
+######################################################################
+@app.cli.command("export-carts")
+@click.option("--format", "fmt", type=click.Choice(("ndjson", "csv", "parquet")), default="ndjson",
+              help="Output format (parquet needs pyarrow)")
+@click.option("--output", default="-", help="File to write to (default: stdout)")
+@click.option("--min-id", type=int, default=None, help="Only export carts with this id or higher")
+@click.option("--max-id", type=int, default=None, help="Only export carts with this id or lower")
+@click.option("--parallel", type=int, default=1, help="Export this many id ranges at once, to OUTPUT.N.EXT files")
+@click.option("--batch-size", type=int, default=1000, help="Rows fetched from the server-side cursor at a time")
+def export_carts(fmt, output, min_id, max_id, parallel, batch_size):
+    """
+    Exports every cart and its items for analytics in constant memory,
+    using COPY TO for CSV on PostgreSQL and a server-side cursor otherwise
+    """
+    # pylint: disable=too-many-arguments
+    if fmt not in export.FORMATS:
+        raise click.UsageError("Parquet export needs pyarrow to be installed")
+    if output == "-" and (fmt == "parquet" or parallel > 1):
+        raise click.UsageError("--output is required for parquet and parallel exports")
+    if parallel > 1:
+        if min_id is not None or max_id is not None:
+            raise click.UsageError("--min-id and --max-id cannot be combined with --parallel")
+        for path, size in export.write_parallel(db.engine, fmt, output, parallel, batch_size).items():
+            click.echo(f"Wrote {path} ({size:,} bytes)", err=True)
+        return
+    if output == "-":
+        for chunk in export.export_carts(db.engine, fmt, min_id, max_id, batch_size):
+            click.echo(chunk, nl=False)
+        return
+    size = export.write_export(db.engine, fmt, output, min_id, max_id, batch_size)
+    click.echo(f"Wrote {output} ({size:,} {'rows' if fmt == 'parquet' else 'bytes'})", err=True)
+
+
+######################################################################
+# Command to bulk import carts and items
+# Usage:
+#   flask import-carts FILE [--format ndjson|csv] [--rejects FILE] [--batch-size N]
+######################################################################
+@app.cli.command("import-carts")
+@click.argument("source", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "fmt", type=click.Choice(IMPORT_FORMATS), default=None,
+              help="Input format (default: from the file extension, else ndjson)")
+@click.option("--rejects", type=click.File("w", encoding="utf-8", lazy=True), default="rejects.ndjson",
+              help="File the rejected rows are written to as NDJSON")
+@click.option("--batch-size", type=int, default=5000, help="Rows per batch and transaction")
+def import_carts(source, fmt, rejects, batch_size):
+    """
+    Bulk imports carts and items from NDJSON or CSV (as written by
+    export-carts). Rows are validated like the API validates them, loaded
+    with COPY into staging tables and merged a batch at a time. Invalid
+    rows are written to the rejects file.
+    """
+    fmt = fmt or ("csv" if source.name.endswith(".csv") else "ndjson")
+    with db.engine.connect() as connection:
+        totals = load_carts(
+            connection, source, fmt, rejects, batch_size,
+            progress=lambda t: click.echo(f"  {t['rows']} rows, {t['rejects']} rejected", err=True),
+        )
+    rate = totals["rows"] / totals["seconds"] if totals["seconds"] else 0
+    click.echo(
+        f"Imported {totals['shopcarts']} shopcarts and {totals['items']} items from {totals['rows']} rows "
+        f"in {totals['seconds']:.1f}s ({rate:,.0f} rows/s)"
+    )
+    if totals["rejects"]:
+        click.echo(f"Rejected {totals['rejects']} rows, see {rejects.name}", err=True)
+
+
+######################################################################
+# Command to archive and delete abandoned carts
+# Usage:
+#   flask purge-carts [--ttl-days N] [--batch-size N] [--max-batches N] [--dry-run]
+######################################################################
+@app.cli.command("purge-carts")
+@click.option("--ttl-days", type=float, default=None, help="Days without updates before a cart is purged "
+              "(default: CART_TTL_DAYS)")
+@click.option("--batch-size", type=int, default=None, help="Carts per transaction (default: PURGE_BATCH_SIZE)")
+@click.option("--pause", type=float, default=0.0, help="Seconds to sleep between batches")
+@click.option("--max-batches", type=int, default=None, help="Stop after this many batches, a later run carries on")
+@click.option("--no-archive", "no_archive", is_flag=True, help="Delete without copying to shopcart_archive")
+@click.option("--dry-run", is_flag=True, help="Only count the carts that would be purged")
+def purge_carts(ttl_days, batch_size, pause, max_batches, no_archive, dry_run):
+    """
+    Archives and deletes the carts that have not been updated for the
+    TTL, in small batched transactions. It is safe to stop and run again.
+    """
+    # pylint: disable=too-many-arguments
+    ttl_days = app.config["CART_TTL_DAYS"] if ttl_days is None else ttl_days
+    cutoff = purge.cutoff_for(ttl_days)
+    with db.engine.connect() as connection:
+        if dry_run:
+            count = purge.count_stale(connection, cutoff)
+            connection.rollback()
+            click.echo(f"{count} shopcarts were last updated before {cutoff.isoformat()}")
+            return
+        totals = purge.purge_carts(
+            connection, cutoff, batch_size or app.config["PURGE_BATCH_SIZE"], not no_archive, pause, max_batches,
+            progress=lambda t: click.echo(f"  {t['shopcarts']} carts, {t['items']} items", err=True),
+        )
+    click.echo(
+        f"Purged {totals['shopcarts']} shopcarts and {totals['items']} items last updated before "
+        f"{cutoff.isoformat()} in {totals['batches']} batches ({totals['seconds']:.1f}s)"
+    )
+
+
+######################################################################
+# Commands to manage the optional partitioning of shopcart and item
+# Usage:
+#   flask partition-tables --layout month|hash|none [--count N] [--capacity N]
+#   flask list-partitions
+#   flask roll-partitions
+#   flask drop-partitions --before YYYY-MM [--detach-only]
+######################################################################
+@app.cli.command("partition-tables")
+@click.option("--layout", type=click.Choice(partitions.LAYOUTS), required=True,
+              help="Monthly ranges of cart ids, hash of the cart id, or plain tables")
+@click.option("--count", type=int, default=8, help="Number of partitions of the hash layout")
+@click.option("--capacity", type=int, default=partitions.DEFAULT_CAPACITY, help="Cart ids per monthly partition")
+def partition_tables(layout, count, capacity):
+    """
+    Rebuilds the shopcart and item tables with a partition layout (or
+    back to plain tables), keeping their rows. Both tables are locked
+    while the rows are copied, so run it during a maintenance window.
+    """
+    with db.engine.connect() as connection:
+        try:
+            partitions.convert(connection, layout, count, capacity)
+        except partitions.PartitionError as error:
+            raise click.ClickException(str(error)) from error
+    click.echo(f"The shopcart and item tables now have the {layout} layout")
+
+
+@app.cli.command("list-partitions")
+def list_partitions():
+    """Lists the partitions of the shopcart table (item has the same ones)"""
+    with db.engine.connect() as connection:
+        try:
+            layout = partitions.current_layout(connection)
+        except partitions.PartitionError as error:
+            raise click.ClickException(str(error)) from error
+        click.echo(f"Layout: {layout}")
+        for partition in partitions.list_partitions(connection):
+            if partition.remainder is not None:
+                click.echo(f"  {partition.name}  remainder {partition.remainder}")
+            elif partition.end is None:
+                click.echo(f"  {partition.name}  ids past the newest range")
+            else:
+                click.echo(f"  {partition.name}  ids {partition.start or 'MINVALUE'} to {partition.end - 1}")
+
+
+@app.cli.command("roll-partitions")
+@click.option("--capacity", type=int, default=None, help="Cart ids in the new partition (default: as the newest)")
+@click.option("--headroom", type=float, default=0.1, help="Open a new partition when less than this share is left")
+def roll_partitions(capacity, headroom):
+    """
+    Opens this month's partition if it does not exist yet, or a new one
+    when the newest is almost full. Run it every day.
+    """
+    with db.engine.connect() as connection:
+        try:
+            name = partitions.roll_partition(connection, capacity, headroom)
+        except partitions.PartitionError as error:
+            raise click.ClickException(str(error)) from error
+    click.echo(f"Opened partition {name}" if name else "The newest partition is current")
+
+
+@app.cli.command("drop-partitions")
+@click.option("--before", required=True, help="Drop the monthly partitions older than this month (YYYY-MM)")
+@click.option("--detach-only", is_flag=True, help="Detach them but keep them as ordinary tables")
+def drop_partitions(before, detach_only):
+    """
+    Removes the carts and items of old months by detaching and dropping
+    their partitions, which is much cheaper than deleting the rows
+    """
+    with db.engine.connect() as connection:
+        try:
+            removed = partitions.drop_partitions(connection, before, detach_only)
+        except partitions.PartitionError as error:
+            raise click.ClickException(str(error)) from error
+    verb = "Detached" if detach_only else "Dropped"
+    click.echo(f"{verb} {len(removed)} partitions{': ' + ', '.join(removed) if removed else ''}")
+
+
+######################################################################
+# Command to publish the outbox events to the change feed
+# Usage:
+#   flask dispatch-events [--batch-size 500] [--interval 1] [--once]
+######################################################################
+@app.cli.command("dispatch-events")
+@click.option("--batch-size", type=int, default=None, help="Events per transaction (default: EVENTS_BATCH_SIZE)")
+@click.option("--interval", type=float, default=1.0, help="Seconds to sleep when there is nothing to publish")
+@click.option("--retention-days", type=float, default=None,
+              help="Delete events published longer ago than this (default: EVENTS_RETENTION_DAYS)")
+@click.option("--once", is_flag=True, help="Stop when every pending event is published")
+def dispatch_events(batch_size, interval, retention_days, once):
+    """
+    Publishes the events that writes append to the outbox to /api/events,
+    a batch at a time. Runs until it is stopped unless --once is given.
+    """
+    batch_size = batch_size or app.config["EVENTS_BATCH_SIZE"]
+    if retention_days is None:
+        retention_days = app.config["EVENTS_RETENTION_DAYS"]
+    with db.engine.connect() as connection:
+        totals = change_feed.dispatch_events(
+            connection, batch_size, interval, retention_days, once,
+            progress=lambda totals: app.logger.info("Published %d events", totals["events"]),
+        )
+    click.echo(f"Published {totals['events']} events in {totals['batches']} batches, pruned {totals['pruned']}")
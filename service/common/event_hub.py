@@ -0,0 +1,234 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Event Hub
+
+Fans the change feed out to the Server-Sent Events streams of a worker.
+One background thread reads the feed while anyone is subscribed, however
+many streams are open, and hands each event to the subscriptions of its
+cart. An idle subscription is a small object and a thread blocked on an
+Event, and costs the database nothing.
+
+A client that falls too far behind is disconnected. Browsers reconnect
+on their own with the Last-Event-ID header, and the stream replays the
+events of the cart it missed from the feed. When more than REPLAY_LIMIT
+were missed the stream sends a "reset" event instead, whose id is the
+head of the feed, and the client fetches the cart again.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from sqlalchemy.exc import SQLAlchemyError
+from service.common import change_feed
+
+logger = logging.getLogger("flask.app")
+
+# Tells EventSource clients how long to wait before reconnecting, in ms
+RETRY_MILLISECONDS = 3000
+REPLAY_LIMIT = 1000
+
+
+class Subscription:
+    """The events of one cart waiting to be sent to one client"""
+
+    __slots__ = ("shopcart_id", "limit", "start", "position", "events", "ready", "closed")
+
+    def __init__(self, shopcart_id: int, limit: int, position: int = 0):
+        self.shopcart_id = shopcart_id
+        self.limit = limit
+        self.start = position  # the head of the feed when the subscription was made
+        self.position = position  # of the last event of the feed this subscription has been offered
+        self.events = deque()
+        self.ready = threading.Event()
+        self.closed = False
+
+    def put(self, event: dict):
+        """Queues an event, or closes the subscription when its client is too far behind"""
+        if event["position"] <= self.position:
+            return
+        if len(self.events) >= self.limit:
+            self.closed = True
+        else:
+            self.events.append(event)
+        self.ready.set()
+
+    def get(self, timeout: float):
+        """Waits up to timeout seconds and returns the queued events, or None once closed"""
+        self.ready.wait(timeout)
+        self.ready.clear()
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return None if self.closed and not events else events
+
+
+def format_event(event: dict) -> str:
+    """Returns an event as a Server-Sent Events message"""
+    return f"id: {event['position']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+class EventHub:
+    """Reads the change feed for the subscribed carts of this worker
+
+    Args:
+        engine: the SQLAlchemy Engine to read the feed with
+        poll_interval: seconds between reads of the feed
+        max_subscribers: most subscriptions at once (0 means no limit)
+        buffer: most events queued for a client before it is disconnected
+    """
+
+    def __init__(self, engine, poll_interval: float = 0.5, max_subscribers: int = 0, buffer: int = 100):
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self.max_subscribers = max_subscribers
+        self.buffer = buffer
+        self.subscriptions = {}  # shopcart id -> set of Subscriptions
+        self.count = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def subscribe(self, shopcart_id: int):
+        """Returns a new Subscription to a cart's events, or None when the hub is full
+
+        The subscription gets every event published after it was made, however
+        long the hub's thread takes to read the feed.
+        """
+        if 0 < self.max_subscribers <= self.count:
+            return None
+        with self.engine.connect() as connection:
+            position = change_feed.last_position(connection)
+        with self.lock:
+            if 0 < self.max_subscribers <= self.count:
+                return None
+            subscription = Subscription(shopcart_id, self.buffer, position)
+            self.subscriptions.setdefault(shopcart_id, set()).add(subscription)
+            self.count += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="event-hub", daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Removes a subscription"""
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.shopcart_id, set())
+            if subscription in subscriptions:
+                subscriptions.discard(subscription)
+                self.count -= 1
+            if not subscriptions:
+                self.subscriptions.pop(subscription.shopcart_id, None)
+
+    def stop(self, timeout: float = 5.0):
+        """Closes every subscription and waits for the thread to finish"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+            for subscriptions in self.subscriptions.values():
+                for subscription in subscriptions:
+                    subscription.closed = True
+                    subscription.ready.set()
+            self.subscriptions, self.count = {}, 0
+        self.wakeup.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def poll(self) -> int:
+        """Reads the new events of the feed once and hands them out
+
+        The feed is read from the oldest position a subscription has been
+        offered, and each subscription skips the events it has already had.
+
+        Returns:
+            int: the number of events read
+        """
+        with self.lock:
+            positions = [subscription.position for subscriptions in self.subscriptions.values()
+                         for subscription in subscriptions]
+        if not positions:
+            return 0
+        with self.engine.connect() as connection:
+            events = change_feed.read_feed(connection, min(positions), REPLAY_LIMIT)
+        if events:
+            with self.lock:
+                for event in events:
+                    for subscription in self.subscriptions.get(event["shopcart_id"], ()):
+                        subscription.put(event)
+                last = events[-1]["position"]
+                for subscriptions in self.subscriptions.values():
+                    for subscription in subscriptions:
+                        subscription.position = max(subscription.position, last)
+        return len(events)
+
+    def run(self):
+        """Polls the feed while there are subscriptions and sleeps while there are none, until stopped"""
+        while self.thread is threading.current_thread():
+            if not self.count:
+                self.wakeup.clear()
+                # a subscribe() since the check above has already counted itself
+                if not self.count:
+                    self.wakeup.wait()
+                continue
+            try:
+                if self.poll() == REPLAY_LIMIT:
+                    continue
+            except SQLAlchemyError as error:
+                logger.warning("Could not read the change feed: %s", error)
+            time.sleep(self.poll_interval)
+
+    def replay(self, subscription: Subscription, last_position: int) -> list:
+        """Returns the events of the cart after last_position, or a reset when there are too many"""
+        with self.engine.connect() as connection:
+            missed = change_feed.read_feed(connection, last_position, REPLAY_LIMIT + 1, subscription.shopcart_id)
+        if len(missed) > REPLAY_LIMIT:
+            # the client starts again from the cart as it is now
+            return [{"position": subscription.start, "type": "reset", "data": {"id": subscription.shopcart_id}}]
+        return missed
+
+    def stream(self, subscription: Subscription, last_position: int = None, heartbeat: float = 15.0):
+        """Yields the Server-Sent Events of a subscription until its client goes away
+
+        Args:
+            subscription: from subscribe(), removed from the hub when the stream ends
+            last_position: the Last-Event-ID the client reconnected with, if any
+            heartbeat: seconds of quiet after which a comment is sent to keep the stream open
+        """
+        try:
+            yield f"retry: {RETRY_MILLISECONDS}\n\n"
+            sent = last_position or 0
+            if last_position is not None:
+                for event in self.replay(subscription, last_position):
+                    yield format_event(event)
+                    sent = event["position"]
+            while True:
+                events = subscription.get(heartbeat)
+                if events is None:
+                    return
+                if not events:
+                    yield ": keep-alive\n\n"
+                for event in events:
+                    # the replay may already have sent it
+                    if event["position"] <= sent:
+                        continue
+                    yield format_event(event)
+                    sent = event["position"]
+                    if event["type"] == "shopcart.deleted":
+                        return
+        finally:
+            self.unsubscribe(subscription)
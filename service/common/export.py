@@ -0,0 +1,217 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Bulk Export
+
+Streams every cart and its items in constant memory. Rows come from a
+server-side cursor in batches, and CSV exports from PostgreSQL are
+produced by COPY TO STDOUT without going through Python rows at all.
+
+NDJSON writes one cart per line, encoded with the API's cart model.
+CSV and Parquet write one row per item with the cart's id and name (a
+cart without items has a single row with empty item columns). Parquet
+needs pyarrow to be installed.
+
+An export can be limited to a range of cart ids, which is how it is
+split into parts that run in parallel.
+"""
+import csv
+import io
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func, select
+from service.models import Shopcart, Item
+from .fast_json import compile_encoder, dumps
+
+try:
+    import pyarrow
+    from pyarrow import parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None  # pylint: disable=invalid-name
+
+COLUMNS = ("shopcart_id", "shopcart_name", "id", "item_id", "description", "quantity", "price")
+CHUNK_SIZE = 64 * 1024
+FORMATS = ("ndjson", "csv") + (("parquet",) if pyarrow is not None else ())
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+def export_statement(first_id: int = None, last_id: int = None):
+    """Returns the SELECT of one row per item, ordered by cart"""
+    shopcart, item = Shopcart.__table__, Item.__table__
+    statement = (
+        select(
+            shopcart.c.id.label("shopcart_id"),
+            shopcart.c.name.label("shopcart_name"),
+            item.c.id,
+            item.c.item_id,
+            item.c.description,
+            item.c.quantity,
+            item.c.price,
+        )
+        .select_from(shopcart.outerjoin(item))
+        .order_by(shopcart.c.id, item.c.id)
+    )
+    if first_id is not None:
+        statement = statement.where(shopcart.c.id >= first_id)
+    if last_id is not None:
+        statement = statement.where(shopcart.c.id <= last_id)
+    return statement
+
+
+def id_ranges(connection, parts: int, first_id: int = None, last_id: int = None) -> list:
+    """Splits the cart ids into at most parts (first_id, last_id) ranges of equal width"""
+    low, high = connection.execute(select(func.min(Shopcart.id), func.max(Shopcart.id))).one()
+    if low is None:
+        return [(first_id, last_id)]
+    low = max(low, first_id) if first_id is not None else low
+    high = min(high, last_id) if last_id is not None else high
+    width = max(-(-(high - low + 1) // parts), 1)
+    return [(start, min(start + width - 1, high)) for start in range(low, high + 1, width)] or [(low, high)]
+
+
+######################################################################
+#  W R I T E R S
+######################################################################
+def _buffered(pieces, size: int = CHUNK_SIZE):
+    """Joins small byte strings into chunks of about size bytes"""
+    buffer, length = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield b"".join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def cart_encoder():
+    """Returns an encoder that shapes a cart like the API's ShopcartModel"""
+    # the api models live with the routes, which are loaded with the app
+    from service.routes import shopcart_model  # pylint: disable=import-outside-toplevel
+
+    return compile_encoder(shopcart_model)
+
+
+def _ndjson_lines(rows, encode):
+    for shopcart_id, cart_rows in itertools.groupby(rows, key=lambda row: row.shopcart_id):
+        first = next(cart_rows)
+        items = [row for row in itertools.chain((first,), cart_rows) if row.id is not None]
+        yield dumps(encode({"id": shopcart_id, "name": first.shopcart_name, "items": items})) + b"\n"
+
+
+def _csv_lines(rows):
+    text = io.StringIO()
+    writer = csv.writer(text, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow(row)
+        if text.tell() >= CHUNK_SIZE:
+            yield text.getvalue().encode("utf-8")
+            text.seek(0)
+            text.truncate()
+    yield text.getvalue().encode("utf-8")
+
+
+def _copy_csv(connection, statement):
+    """Has PostgreSQL write the CSV itself with COPY TO STDOUT"""
+    query = statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+    cursor = connection.connection.cursor()
+    try:
+        with cursor.copy(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)") as copy:
+            yield from _buffered(bytes(block) for block in copy)
+    finally:
+        cursor.close()
+
+
+def export_carts(engine, fmt: str, first_id: int = None, last_id: int = None, batch_size: int = 1000):
+    """Yields the carts with ids between first_id and last_id as chunks of NDJSON or CSV
+
+    The rows are read through a server-side cursor batch_size at a time,
+    so memory use does not grow with the number of carts.
+    """
+    if fmt not in ("ndjson", "csv"):
+        raise ValueError(f"Cannot stream {fmt!r}, choose ndjson or csv")
+    statement = export_statement(first_id, last_id)
+    with engine.connect() as connection:
+        if fmt == "csv" and connection.dialect.name == "postgresql":
+            yield from _copy_csv(connection, statement)
+            return
+        rows = connection.execution_options(yield_per=batch_size).execute(statement)
+        if fmt == "ndjson":
+            yield from _buffered(_ndjson_lines(rows, cart_encoder()))
+        else:
+            yield from _csv_lines(rows)
+
+
+def write_parquet(engine, path: str, first_id: int = None, last_id: int = None,
+                  batch_size: int = 10000) -> int:  # pragma: no cover
+    """Writes the carts to a Parquet file, one row group per batch, and returns the number of rows"""
+    if pyarrow is None:
+        raise RuntimeError("Parquet export needs pyarrow to be installed")
+    schema = pyarrow.schema([
+        ("shopcart_id", pyarrow.int32()),
+        ("shopcart_name", pyarrow.string()),
+        ("id", pyarrow.int32()),
+        ("item_id", pyarrow.string()),
+        ("description", pyarrow.string()),
+        ("quantity", pyarrow.int32()),
+        ("price", pyarrow.int32()),
+    ])
+    count = 0
+    with engine.connect() as connection, parquet.ParquetWriter(path, schema) as writer:
+        result = connection.execution_options(yield_per=batch_size).execute(export_statement(first_id, last_id))
+        for rows in result.partitions():
+            writer.write_table(pyarrow.Table.from_pylist([dict(zip(COLUMNS, row)) for row in rows], schema=schema))
+            count += len(rows)
+    return count
+
+
+def write_export(engine, fmt: str, path: str, first_id: int = None, last_id: int = None,
+                 batch_size: int = 1000) -> int:
+    """Writes one export file and returns its size in bytes (rows for Parquet)"""
+    # pylint: disable=too-many-arguments
+    if fmt == "parquet":
+        return write_parquet(engine, path, first_id, last_id, batch_size)  # pragma: no cover
+    size = 0
+    with open(path, "wb") as export_file:
+        for chunk in export_carts(engine, fmt, first_id, last_id, batch_size):
+            export_file.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def part_path(path: str, number: int) -> str:
+    """Returns the name of part number of an export to path ("carts.csv" -> "carts.0.csv")"""
+    stem, dot, extension = path.rpartition(".")
+    return f"{stem}.{number}.{extension}" if dot and "/" not in extension else f"{path}.{number}"
+
+
+def write_parallel(engine, fmt: str, path: str, parts: int, batch_size: int = 1000) -> dict:
+    """Exports ranges of cart ids to separate files at the same time
+
+    Returns:
+        dict: the size written to each file
+    """
+    with engine.connect() as connection:
+        ranges = id_ranges(connection, parts)
+    paths = [part_path(path, number) for number in range(len(ranges))]
+    with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+        sizes = pool.map(
+            lambda job: write_export(engine, fmt, job[0], job[1][0], job[1][1], batch_size), zip(paths, ranges)
+        )
+        return dict(zip(paths, sizes))
@@ -0,0 +1,103 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Readiness Checks
+
+A worker is ready when the database answers "SELECT 1" within
+READINESS_MAX_DB_SECONDS and fewer than READINESS_MAX_POOL_SATURATION of
+its pooled connections are checked out. The database check runs at most
+once every READINESS_CACHE_SECONDS; probes in between (and probes that
+arrive while a check is running) get the last result, so a burst of
+probes never adds load to a struggling database.
+"""
+import threading
+import time
+from sqlalchemy.pool import QueuePool
+from service.models import db
+
+_lock = threading.Lock()
+_last_check = {"at": None, "result": None}
+
+
+def pool_status(pool) -> dict:
+    """Reports how many of the pool's connections are in use"""
+    if not isinstance(pool, QueuePool):
+        return {"class": type(pool).__name__, "saturation": 0.0}
+    size = pool.size()
+    max_overflow = max(getattr(pool, "_max_overflow", 0), 0)
+    checked_out = pool.checkedout()
+    capacity = size + max_overflow
+    return {
+        "size": size,
+        "max_overflow": max_overflow,
+        "checked_out": checked_out,
+        "idle": pool.checkedin(),
+        "saturation": round(checked_out / capacity, 3) if capacity else 0.0,
+    }
+
+
+def check_database() -> dict:
+    """Runs SELECT 1 and returns whether it worked and how long it took"""
+    start = time.perf_counter()
+    try:
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql("SELECT 1")
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        return {"ok": False, "error": f"{type(error).__name__}: {error}".strip(),
+                "latency_ms": round((time.perf_counter() - start) * 1000, 2)}
+    return {"ok": True, "latency_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+
+def cached_database_check(max_age: float) -> dict:
+    """Returns the last database check, running a new one if it is older than max_age"""
+    now = time.monotonic()
+    last = _last_check["result"]
+    if last is not None and now - _last_check["at"] < max_age:
+        return last
+    if not _lock.acquire(blocking=last is None):
+        return last  # another thread is checking right now
+    try:
+        result = check_database()
+        result["checked_at"] = time.time()
+        _last_check.update(at=time.monotonic(), result=result)
+        return result
+    finally:
+        _lock.release()
+
+
+def readiness(config) -> tuple:
+    """Returns (ready, report) for this worker"""
+    pool = pool_status(db.engine.pool)
+    report = {"pool": pool}
+    if pool["saturation"] >= config["READINESS_MAX_POOL_SATURATION"]:
+        report["reason"] = "connection pool saturated"
+        return False, report
+
+    database = cached_database_check(config["READINESS_CACHE_SECONDS"])
+    report["database"] = database
+    if not database["ok"]:
+        report["reason"] = "database unavailable"
+        return False, report
+    if database["latency_ms"] > config["READINESS_MAX_DB_SECONDS"] * 1000:
+        report["reason"] = "database too slow"
+        return False, report
+    return True, report
+
+
+def reset():
+    """Forgets the cached database check"""
+    _last_check.update(at=None, result=None)
@@ -19,18 +19,117 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+Log records are handed to a QueueListener thread that formats and writes
+them, so request threads only pay for putting a record on a queue. Logs
+can be written as text or as one JSON object per line, and the INFO
+messages of busy routes can be sampled with LOG_SAMPLE_RATES.
 """
+import atexit
+import copy
+import json
 import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from flask import has_request_context, request
+from .metrics import resource_name
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line of JSON"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class RecordQueueHandler(QueueHandler):
+    """A QueueHandler that keeps the traceback of a record apart from its message
+
+    QueueHandler folds the traceback into the message before queueing a
+    record. This keeps it in exc_text instead, which the formatters on the
+    other side of the queue write where they want it.
+    """
+
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
+class RouteSampler(logging.Filter):
+    """Keeps the INFO and DEBUG messages of only a sample of requests
+
+    Args:
+        rates (dict): flask-restx Resource name -> fraction of requests to log
+
+    The choice is made once per request so a sampled request keeps all of
+    its messages. Warnings and errors are always logged.
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not has_request_context():
+            return True
+        keep = request.environ.get("shopcarts.log_sampled")
+        if keep is None:
+            rate = self.rates.get(resource_name(), 1.0)
+            keep = request.environ["shopcarts.log_sampled"] = random.random() < rate
+        return keep
+
+
+def stop_logging(app):
+    """Writes out the queued records and stops the app's log listener"""
+    listener = app.extensions.pop("log_listener", None)
+    if listener:
+        listener.stop()
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
+    handlers = list(gunicorn_logger.handlers)
     app.logger.setLevel(gunicorn_logger.level)
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    if app.config.get("LOG_FORMAT") == "json":
+        formatter = JsonFormatter(datefmt=DATE_FORMAT)
+    else:
+        formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", DATE_FORMAT)
+    for handler in handlers:
         handler.setFormatter(formatter)
+
+    # Write from a background thread instead of the request thread
+    stop_logging(app)
+    if app.config.get("LOG_ASYNC", True) and handlers:
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        app.extensions["log_listener"] = listener
+        atexit.register(stop_logging, app)
+        handlers = [RecordQueueHandler(log_queue)]
+    app.logger.handlers = handlers
+
+    for log_filter in [f for f in app.logger.filters if isinstance(f, RouteSampler)]:
+        app.logger.removeFilter(log_filter)
+    if app.config.get("LOG_SAMPLE_RATES"):
+        app.logger.addFilter(RouteSampler(app.config["LOG_SAMPLE_RATES"]))
     app.logger.info("Logging handler established")
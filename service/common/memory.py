@@ -0,0 +1,160 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Memory Instrumentation
+
+Reports the memory used by this process: resident set size, the top
+allocation sites from tracemalloc, the identity map size of every live
+SQLAlchemy session and how many Shopcart and Item instances are alive.
+
+tracemalloc slows every allocation down, so it only runs after the first
+snapshot is taken and stops again when the snapshots are cleared. Only
+the newest MEMORY_MAX_SNAPSHOTS snapshots are kept.
+"""
+import gc
+import os
+import resource
+import threading
+import tracemalloc
+from collections import deque
+from sqlalchemy.orm import Session
+from service.models import Shopcart, Item
+
+TRACEMALLOC_FRAMES = 10
+MAX_SNAPSHOTS = 10
+
+
+######################################################################
+#  P R O C E S S   M E M O R Y
+######################################################################
+def rss_bytes() -> int:
+    """Returns the resident set size of this process"""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:  # pragma: no cover
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    """Returns the largest resident set size this process has had"""
+    # ru_maxrss is in kilobytes on Linux; the kernel updates it lazily, so
+    # it can trail the current RSS by a few pages
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def live_model_counts() -> dict:
+    """Counts the Shopcart and Item instances that are still referenced"""
+    counts = {Shopcart.__name__: 0, Item.__name__: 0}
+    for obj in gc.get_objects():
+        if isinstance(obj, (Shopcart, Item)):
+            counts[type(obj).__name__] += 1
+    return counts
+
+
+def identity_map_sizes() -> list:
+    """Returns the number of objects in the identity map of each live Session"""
+    return sorted((len(obj.identity_map) for obj in gc.get_objects() if isinstance(obj, Session)), reverse=True)
+
+
+######################################################################
+#  T R A C E M A L L O C   S N A P S H O T S
+######################################################################
+def _site(frame) -> str:
+    return f"{frame.filename}:{frame.lineno}"
+
+
+def top_allocations(snapshot, limit: int = 10) -> list:
+    """Returns the lines that hold the most memory in snapshot"""
+    return [
+        {"site": _site(stat.traceback[0]), "size": stat.size, "count": stat.count}
+        for stat in snapshot.statistics("lineno")[:limit]
+    ]
+
+
+def diff_allocations(old, new, limit: int = 10) -> list:
+    """Returns the lines whose memory grew (or shrank) the most from old to new"""
+    return [
+        {
+            "site": _site(stat.traceback[0]),
+            "size": stat.size,
+            "size_diff": stat.size_diff,
+            "count_diff": stat.count_diff,
+        }
+        for stat in new.compare_to(old, "lineno")[:limit]
+    ]
+
+
+class SnapshotStore:
+    """Numbered tracemalloc snapshots kept for later comparison"""
+
+    def __init__(self):
+        self.snapshots = deque(maxlen=MAX_SNAPSHOTS)  # of (id, snapshot), oldest first
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def ids(self) -> list:
+        """Returns the ids of the stored snapshots"""
+        return [snapshot_id for snapshot_id, _ in self.snapshots]
+
+    def take(self, keep: int = MAX_SNAPSHOTS) -> int:
+        """Starts tracemalloc if needed and stores a snapshot of the heap, dropping all but the newest keep"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),)
+        )
+        with self.lock:
+            snapshot_id = self.next_id
+            self.next_id += 1
+            if self.snapshots.maxlen != keep:
+                self.snapshots = deque(self.snapshots, maxlen=keep)
+            self.snapshots.append((snapshot_id, snapshot))
+        return snapshot_id
+
+    def get(self, snapshot_id: int):
+        """Returns a stored snapshot (None if there is no such snapshot)"""
+        return next((snapshot for stored_id, snapshot in self.snapshots if stored_id == snapshot_id), None)
+
+    def clear(self):
+        """Drops every snapshot and stops tracemalloc"""
+        with self.lock:
+            self.snapshots.clear()
+        tracemalloc.stop()
+
+
+snapshots = SnapshotStore()
+
+
+def memory_report(limit: int = 10) -> dict:
+    """Returns the memory statistics of this process"""
+    rss = rss_bytes()
+    report = {
+        "pid": os.getpid(),
+        "rss_bytes": rss,
+        "peak_rss_bytes": max(peak_rss_bytes(), rss),
+        "live_objects": live_model_counts(),
+        "identity_maps": identity_map_sizes(),
+        "tracemalloc": tracemalloc.is_tracing(),
+        "snapshots": snapshots.ids(),
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report["traced_bytes"] = current
+        report["traced_peak_bytes"] = peak
+        report["top_allocations"] = top_allocations(tracemalloc.take_snapshot(), limit)
+    return report
@@ -0,0 +1,458 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Prometheus Metrics
+
+A small metrics registry that renders the Prometheus text exposition
+format for /metrics. It records request counts and latencies per
+flask-restx resource, SQL query counts and durations, SQLAlchemy statement
+cache hits and connection pool checkouts.
+
+Every gunicorn worker has its own registry. When PROMETHEUS_MULTIPROC_DIR
+is set each worker writes a snapshot of its registry to that directory at
+most every METRICS_FLUSH_SECONDS (and when it exits) and /metrics adds up
+the snapshots of all of the workers. When a worker exits, gunicorn's
+child_exit hook (see gunicorn.conf.py) folds its counters and histograms
+into one file for all exited workers and removes its snapshot, so the
+directory does not grow with every restarted worker.
+"""
+import atexit
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+import weakref
+from flask import current_app, g, request
+from sqlalchemy.pool import QueuePool
+from . import statement_timing
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# the counters and histograms of the workers that have exited
+EXITED_FILE = "metrics-exited.json"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+######################################################################
+#  R E G I S T R Y
+######################################################################
+class Registry:
+    """A set of metrics plus the collectors that refresh gauges"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Adds a metric to the registry"""
+        self.metrics[metric.name] = metric
+        return metric
+
+    def collect(self):
+        """Runs every collector so the gauges are current"""
+        for collector in self.collectors:
+            collector()
+
+    def snapshot(self) -> dict:
+        """Returns the values of every metric as JSON friendly lists"""
+        with self.lock:
+            return {
+                name: [[list(labels), value] for labels, value in metric.values.items()]
+                for name, metric in self.metrics.items()
+            }
+
+    def render(self, snapshot: dict = None) -> str:
+        """Renders a snapshot (default: the current values) as Prometheus text"""
+        snapshot = self.snapshot() if snapshot is None else snapshot
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for labels, value in snapshot.get(name, []):
+                lines.extend(metric.samples(dict(zip(metric.labelnames, labels)), value))
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: dict) -> str:
+    """Formats labels as {name="value",...} with Prometheus escaping"""
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    """Base class for a metric with a fixed set of label names"""
+
+    kind = "untyped"
+
+    def __init__(self, registry: Registry, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = registry.lock
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def get(self, **labels):
+        """Returns the current value for the labels (None if never set)"""
+        return self.values.get(self._key(labels))
+
+    def merge(self, total, value):
+        """Combines the values of two processes"""
+        return value if total is None else total + value
+
+    def samples(self, labels: dict, value) -> list:
+        """Returns the exposition lines for one set of labels"""
+        return [f"{self.name}{_format_labels(labels)} {float(value)!r}"]
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        """Adds amount to the counter"""
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that is set to the current state"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        """Sets the gauge"""
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Counts observations into buckets and keeps their sum"""
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        """Records one observation"""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # one count per bucket plus +Inf, followed by the sum
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def merge(self, total, value):
+        return list(value) if total is None else [a + b for a, b in zip(total, value)]
+
+    def samples(self, labels: dict, value) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), value[:-1]):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': le})} {float(cumulative)!r}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {float(value[-1])!r}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {float(cumulative)!r}")
+        return lines
+
+
+######################################################################
+#  M U L T I P R O C E S S   S N A P S H O T S
+######################################################################
+def _pid_alive(pid: int) -> bool:
+    """Returns True if a process with pid is running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # pragma: no cover
+        return True
+    return True
+
+
+_process = {"pid": None, "path": None}
+
+
+def snapshot_path(directory: str) -> str:
+    """Returns the snapshot file of this process
+
+    The name is unique to the process, not only to its pid, so a worker
+    that gets the pid of an exited one never overwrites its snapshot.
+    """
+    if _process["pid"] != os.getpid():
+        _process.update(pid=os.getpid(), path=f"metrics-{os.getpid()}-{time.time_ns():x}.json")
+    return os.path.join(directory, _process["path"])
+
+
+def _load(path: str) -> dict:
+    """Returns a snapshot file, None if it is missing or being written"""
+    try:
+        with open(path, encoding="utf-8") as snapshot_file:
+            return json.load(snapshot_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _dump(path: str, snapshot: dict):
+    """Replaces a snapshot file atomically"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(temp_path, path)
+
+
+def _add(registry: Registry, merged: dict, metrics: dict, gauges: bool = True):
+    """Adds the metrics of a snapshot to merged ({name: {labels: value}})"""
+    for name, rows in metrics.items():
+        metric = registry.metrics.get(name)
+        if metric is None or (metric.kind == "gauge" and not gauges):
+            continue
+        values = merged.setdefault(name, {})
+        for labels, value in rows:
+            key = tuple(labels)
+            values[key] = metric.merge(values.get(key), value)
+
+
+def _rows(merged: dict) -> dict:
+    return {name: [[list(key), value] for key, value in values.items()] for name, values in merged.items()}
+
+
+def write_snapshot(registry: Registry, directory: str) -> None:
+    """Atomically writes this process' metrics to directory"""
+    registry.collect()
+    _dump(snapshot_path(directory), {"pid": os.getpid(), "metrics": registry.snapshot()})
+
+
+def merge_snapshots(registry: Registry, directory: str) -> dict:
+    """Adds up the snapshots of every process in directory
+
+    Counters and histograms of workers that have exited are kept so the
+    totals never go backwards; gauges only count live workers.
+    """
+    merged = {}
+    exited = _load(os.path.join(directory, EXITED_FILE)) or {"merged": [], "metrics": {}}
+    _add(registry, merged, exited["metrics"], gauges=False)
+    # snapshots already in the exited totals are skipped until child_exit removes them
+    skipped = set(exited["merged"]) | {EXITED_FILE}
+    for path in sorted(glob.glob(os.path.join(directory, "metrics-*.json"))):
+        snapshot = None if os.path.basename(path) in skipped else _load(path)
+        if snapshot is not None:
+            _add(registry, merged, snapshot["metrics"], gauges=_pid_alive(snapshot["pid"]))
+    return _rows(merged)
+
+
+def merge_exited_worker(registry: Registry, directory: str, pid: int) -> None:
+    """Folds the snapshot of a worker that has exited into EXITED_FILE and removes it
+
+    Call it from the parent process once the worker has been reaped
+    (gunicorn's child_exit hook), before its pid can be reused.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, f"metrics-{pid}-*.json")))
+    if not paths:
+        return
+    exited_path = os.path.join(directory, EXITED_FILE)
+    exited = _load(exited_path) or {"merged": [], "metrics": {}}
+    merged = {}
+    _add(registry, merged, exited["metrics"], gauges=False)
+    for path in paths:
+        snapshot = _load(path)
+        if snapshot is not None:
+            _add(registry, merged, snapshot["metrics"], gauges=False)
+    # the names merged before are gone by now, so only the latest are kept
+    names = [os.path.basename(path) for path in paths]
+    _dump(exited_path, {"pid": None, "merged": names, "metrics": _rows(merged)})
+    for path in paths + glob.glob(os.path.join(directory, f"metrics-{pid}-*.json.tmp")):
+        os.remove(path)
+
+
+######################################################################
+#  S E R V I C E   M E T R I C S
+######################################################################
+REGISTRY = Registry()
+
+HTTP_REQUESTS = Counter(
+    REGISTRY, "shopcarts_http_requests_total", "HTTP requests by resource, method and status",
+    ("resource", "method", "status"),
+)
+HTTP_LATENCY = Histogram(
+    REGISTRY, "shopcarts_http_request_duration_seconds", "HTTP request latency by resource and method",
+    ("resource", "method"),
+)
+DB_QUERIES = Counter(REGISTRY, "shopcarts_db_queries_total", "SQL statements executed by operation", ("operation",))
+DB_QUERY_LATENCY = Histogram(
+    REGISTRY, "shopcarts_db_query_duration_seconds", "SQL statement execution time by operation", ("operation",)
+)
+DB_STATEMENT_CACHE = Counter(
+    REGISTRY, "shopcarts_db_statement_cache_total", "SQLAlchemy compiled statement cache lookups by result",
+    ("result",),
+)
+DB_POOL_CHECKOUT = Histogram(
+    REGISTRY, "shopcarts_db_pool_checkout_seconds", "Time spent waiting to check a connection out of the pool"
+)
+DB_POOL_CONNECTIONS = Gauge(
+    REGISTRY, "shopcarts_db_pool_connections", "Connections in the pool by state", ("state",)
+)
+
+# CacheStats names from SQLAlchemy mapped to short label values
+_CACHE_RESULTS = {
+    "CACHE_HIT": "hit",
+    "CACHE_MISS": "miss",
+    "CACHING_DISABLED": "disabled",
+    "NO_CACHE_KEY": "no_key",
+    "NO_DIALECT_SUPPORT": "unsupported",
+}
+
+_pools = weakref.WeakSet()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long every checkout takes"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _pools.add(self)
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            DB_POOL_CHECKOUT.observe(time.perf_counter() - start)
+
+
+def _collect_pool_stats():
+    """Sets the pool gauges from every TimedQueuePool in this process"""
+    states = {"checked_out": 0, "idle": 0, "overflow": 0}
+    for pool in list(_pools):
+        states["checked_out"] += pool.checkedout()
+        states["idle"] += pool.checkedin()
+        states["overflow"] += max(pool.overflow(), 0)
+    for state, value in states.items():
+        DB_POOL_CONNECTIONS.set(value, state=state)
+
+
+REGISTRY.collectors.append(_collect_pool_stats)
+
+
+def statement_operation(statement: str) -> str:
+    """Returns the SQL verb of a statement (SELECT, INSERT, ...)"""
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else "UNKNOWN"
+
+
+def _record_statement(conn, statement, parameters, context, executemany, elapsed):
+    # pylint: disable=unused-argument, too-many-arguments
+    operation = statement_operation(statement)
+    DB_QUERIES.inc(operation=operation)
+    DB_QUERY_LATENCY.observe(elapsed, operation=operation)
+    cache_hit = getattr(context, "cache_hit", None)
+    if cache_hit is not None:
+        DB_STATEMENT_CACHE.inc(result=_CACHE_RESULTS.get(getattr(cache_hit, "name", ""), "unknown"))
+
+
+######################################################################
+#  F L A S K   I N T E G R A T I O N
+######################################################################
+def resource_name() -> str:
+    """Returns the flask-restx Resource (or view) handling this request"""
+    view = current_app.view_functions.get(request.endpoint) if request.endpoint else None
+    if view is None:
+        return "unmatched"
+    view_class = getattr(view, "view_class", None)
+    return view_class.__name__ if view_class else request.endpoint
+
+
+def _start_request_timer():
+    g.metrics_start = time.perf_counter()
+
+
+def _record_request(response):
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        resource = resource_name()
+        HTTP_REQUESTS.inc(resource=resource, method=request.method, status=response.status_code)
+        HTTP_LATENCY.observe(time.perf_counter() - start, resource=resource, method=request.method)
+        _maybe_flush()
+    return response
+
+
+_flush_state = {"last": 0.0}
+
+
+def _maybe_flush():
+    """Writes this worker's snapshot if the flush interval has passed"""
+    directory = current_app.config.get("PROMETHEUS_MULTIPROC_DIR")
+    if not directory:
+        return
+    now = time.monotonic()
+    if now - _flush_state["last"] >= current_app.config.get("METRICS_FLUSH_SECONDS", 5):
+        _flush_state["last"] = now
+        write_snapshot(REGISTRY, directory)
+
+
+def render_metrics() -> str:
+    """Returns the metrics of this service (all workers) as Prometheus text"""
+    directory = current_app.config.get("PROMETHEUS_MULTIPROC_DIR")
+    if not directory:
+        REGISTRY.collect()
+        return REGISTRY.render()
+    write_snapshot(REGISTRY, directory)
+    return REGISTRY.render(merge_snapshots(REGISTRY, directory))
+
+
+def init_metrics(app):
+    """Instruments the app, its database engine and connection pool
+
+    This must run before db.init_app() so the pool class can be set.
+    """
+    if not app.config.get("METRICS_ENABLED", True):
+        return
+
+    if app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgresql"):
+        options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        options.setdefault("poolclass", TimedQueuePool)
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    statement_timing.add_callbacks(_record_statement)
+
+    app.before_request(_start_request_timer)
+    app.after_request(_record_request)
+
+    directory = app.config.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        atexit.register(write_snapshot, REGISTRY, directory)
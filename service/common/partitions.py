@@ -0,0 +1,305 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Table Partitioning
+
+Optional PostgreSQL declarative partitioning of the shopcart and item
+tables. PostgreSQL requires the partition key to be part of every
+primary key and of the key a foreign key points at, so shopcart is
+partitioned on id and item on shopcart_id with the same bounds: a cart
+and its items always live in partitions of the same name.
+
+Two layouts are supported:
+
+- "month": ranges of cart ids, one per month. Ids come from a sequence,
+  so they grow with creation time. roll_partition() opens the range of
+  a new month and moves the sequence into it, and carts created in old
+  months are removed by detaching and dropping their partitions instead
+  of deleting row by row. Carts past the newest range go to a DEFAULT
+  partition rather than failing, and the next roll moves them into the
+  range it opens.
+- "hash": a fixed number of partitions by hash of the cart id, which
+  keeps every index a fraction of the size of the whole table.
+
+convert() rebuilds the tables in the requested layout (or back to plain
+tables) in one transaction. It holds an exclusive lock on both tables
+while the rows are copied, so run it during a maintenance window.
+"""
+import logging
+import re
+from collections import namedtuple
+from datetime import datetime, timezone
+from sqlalchemy import text
+
+LAYOUTS = ("none", "month", "hash")
+LOCK_TIMEOUT = "10s"
+DEFAULT_CAPACITY = 10_000_000
+TABLES = ("shopcart", "item")
+
+# start and end are the cart id range of a "month" partition, remainder the hash bucket of a "hash" one
+# (the DEFAULT partition of the "month" layout has neither)
+Partition = namedtuple("Partition", "name month start end remainder")
+
+_RANGE = re.compile(r"FOR VALUES FROM \((\S+)\) TO \((\S+)\)")
+_HASH = re.compile(r"remainder (\d+)", re.IGNORECASE)
+_MONTH = re.compile(r"_p(\d{4})_(\d{2})")
+_PARTITION_KEYS = {"shopcart": "id", "item": "shopcart_id"}
+_PRIMARY_KEYS = {"shopcart": "id", "item": "id"}
+
+logger = logging.getLogger("flask.app")
+
+
+class PartitionError(Exception):
+    """The partition layout does not allow the requested change"""
+
+
+def month_label(now: datetime = None) -> str:
+    """Returns the "YYYY_MM" suffix of the month of now"""
+    return f"{(now or datetime.now(timezone.utc)):%Y_%m}"
+
+
+def _check_postgres(connection):
+    if connection.dialect.name != "postgresql":
+        raise PartitionError("Partitioning needs PostgreSQL")
+
+
+def current_layout(connection) -> str:
+    """Returns how the shopcart table is partitioned ("none", "month" or "hash")"""
+    _check_postgres(connection)
+    strategy = connection.execute(text(
+        "SELECT partstrat FROM pg_partitioned_table WHERE partrelid = to_regclass('shopcart')"
+    )).scalar()
+    return {"r": "month", "h": "hash"}.get(strategy, "none")
+
+
+def list_partitions(connection) -> list:
+    """Returns the partitions of shopcart ordered by their bounds"""
+    rows = connection.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass('shopcart')"
+    ))
+    partitions = []
+    for name, bound in rows:
+        found = _RANGE.search(bound)
+        month = _MONTH.search(name)
+        hashed = _HASH.search(bound)
+        partitions.append(Partition(
+            name,
+            f"{month.group(1)}-{month.group(2)}" if month else None,
+            int(found.group(1)) if found and found.group(1) != "MINVALUE" else None,
+            int(found.group(2)) if found else None,
+            int(hashed.group(1)) if hashed else None,
+        ))
+    return sorted(partitions, key=lambda p: (p.remainder or 0, p.end or 0))
+
+
+def next_id(connection) -> int:
+    """Returns the id the next cart will get"""
+    sequence = connection.execute(text("SELECT pg_get_serial_sequence('shopcart', 'id')")).scalar()
+    return connection.execute(text(
+        f"SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END FROM {sequence}"
+    )).scalar()
+
+
+######################################################################
+#  C O N V E R S I O N
+######################################################################
+def _table_ddl(table: str, layout: str) -> list:
+    """Returns the statements that create <table>_new in layout, shaped like table"""
+    key = _PARTITION_KEYS[table] if layout != "none" else _PRIMARY_KEYS[table]
+    primary_key = key if key == _PRIMARY_KEYS[table] else f"{key}, {_PRIMARY_KEYS[table]}"
+    partition_by = {"month": f" PARTITION BY RANGE ({key})", "hash": f" PARTITION BY HASH ({key})"}.get(layout, "")
+    statements = [
+        f"CREATE TABLE {table}_new (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS){partition_by}",
+        f"ALTER TABLE {table}_new ADD CONSTRAINT {table}_new_pkey PRIMARY KEY ({primary_key})",
+    ]
+    if table == "item":
+        statements.append(
+            "ALTER TABLE item_new ADD CONSTRAINT item_new_shopcart_id_fkey "
+            "FOREIGN KEY (shopcart_id) REFERENCES shopcart_new (id) ON DELETE CASCADE"
+        )
+    return statements
+
+
+def _partition_ddl(layout: str, count: int, start: int, capacity: int, now: datetime) -> list:
+    """Returns the statements that create the first partitions of both tables"""
+    statements = []
+    for table in TABLES:
+        if layout == "hash":
+            statements += [
+                f"CREATE TABLE {table}_h{number} PARTITION OF {table}_new "
+                f"FOR VALUES WITH (MODULUS {count}, REMAINDER {number})"
+                for number in range(count)
+            ]
+        elif layout == "month":
+            # the carts made so far and those of this month share the first partition
+            statements += [
+                f"CREATE TABLE {table}_p{month_label(now)} PARTITION OF {table}_new "
+                f"FOR VALUES FROM (MINVALUE) TO ({start + capacity})",
+                f"CREATE TABLE {table}_pdefault PARTITION OF {table}_new DEFAULT",
+            ]
+    return statements
+
+
+def convert(connection, layout: str, count: int = 8, capacity: int = DEFAULT_CAPACITY, now: datetime = None):
+    """Rebuilds shopcart and item with the given layout, keeping their rows
+
+    Args:
+        connection: a SQLAlchemy Connection outside of a transaction
+        layout: "month", "hash" or "none" for plain tables
+        count: number of partitions of the "hash" layout
+        capacity: number of cart ids in each "month" partition
+        now: the current time, which names the first "month" partition
+    """
+    # pylint: disable=too-many-arguments
+    if layout not in LAYOUTS:
+        raise PartitionError(f"Unknown layout {layout!r}, choose from {', '.join(LAYOUTS)}")
+    with connection.begin():
+        if current_layout(connection) == layout:
+            raise PartitionError(f"The tables already have the {layout} layout")
+        connection.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+        connection.execute(text("LOCK TABLE shopcart, item IN ACCESS EXCLUSIVE MODE"))
+        indexes = connection.execute(text(
+            "SELECT replace(indexdef, ' ON ONLY ', ' ON ') FROM pg_indexes i WHERE tablename IN ('shopcart', 'item') "
+            "AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conname = i.indexname)"
+        )).scalars().all()
+        triggers = connection.execute(text(
+            "SELECT pg_get_triggerdef(oid) FROM pg_trigger "
+            "WHERE tgrelid IN (to_regclass('shopcart'), to_regclass('item')) AND NOT tgisinternal AND tgparentid = 0"
+        )).scalars().all()
+        sequences = {
+            table: connection.execute(text(f"SELECT pg_get_serial_sequence('{table}', 'id')")).scalar()
+            for table in TABLES
+        }
+        statements = _table_ddl("shopcart", layout) + _table_ddl("item", layout)
+        statements += _partition_ddl(layout, count, next_id(connection), capacity, now)
+        statements += [
+            "INSERT INTO shopcart_new SELECT * FROM shopcart",
+            "INSERT INTO item_new SELECT * FROM item",
+        ]
+        # keep the id sequences when the old tables are dropped
+        statements += [f"ALTER SEQUENCE {sequences[table]} OWNED BY {table}_new.id" for table in TABLES]
+        statements += ["DROP TABLE item", "DROP TABLE shopcart"]
+        for table in TABLES:
+            statements += [
+                f"ALTER TABLE {table}_new RENAME TO {table}",
+                f"ALTER TABLE {table} RENAME CONSTRAINT {table}_new_pkey TO {table}_pkey",
+            ]
+        statements.append("ALTER TABLE item RENAME CONSTRAINT item_new_shopcart_id_fkey TO item_shopcart_id_fkey")
+        for statement in statements + indexes + triggers:
+            connection.execute(text(statement))
+        connection.execute(text("ANALYZE shopcart, item"))
+
+
+######################################################################
+#  M O N T H L Y   P A R T I T I O N S
+######################################################################
+def _month_partitions(connection) -> list:
+    if current_layout(connection) != "month":
+        raise PartitionError("The tables do not have the month layout")
+    return [partition for partition in list_partitions(connection) if partition.end is not None]
+
+
+def roll_partition(connection, capacity: int = None, headroom: float = 0.1, now: datetime = None) -> str:
+    """Opens the partition of a new month, or a new one when the newest is almost full
+
+    New carts go to the new partition at once, because the id sequence is
+    moved to its first id. Run it every day: it does nothing unless the
+    month has changed or less than headroom of the newest range is left.
+    Carts that overflowed into the DEFAULT partition are moved into the
+    new range, which grows to hold them.
+
+    Returns:
+        str: the name of the new partition, None if none was needed
+    """
+    with connection.begin():
+        connection.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+        newest = _month_partitions(connection)[-1]
+        label = month_label(now)
+        width = newest.end - newest.start if newest.start is not None else capacity or DEFAULT_CAPACITY
+        capacity = capacity or width
+        if newest.month == label.replace("_", "-") and newest.end - next_id(connection) > width * headroom:
+            return None
+        name = f"p{label}"
+        existing = {partition.name for partition in list_partitions(connection)}
+        suffix = 2
+        while f"shopcart_{name}" in existing:
+            name, suffix = f"p{label}_{suffix}", suffix + 1
+        start = newest.end
+        overflow = connection.execute(text("SELECT max(id) FROM shopcart_pdefault WHERE id >= :start"),
+                                      {"start": start}).scalar()
+        end = max(start + capacity, (overflow or 0) + 1)
+        if overflow is None:
+            for table in TABLES:
+                connection.execute(text(
+                    f"CREATE TABLE {table}_{name} PARTITION OF {table} FOR VALUES FROM ({start}) TO ({end})"
+                ))
+        else:
+            logger.warning("Carts up to id %d were past the newest partition, moving them to %s", overflow, name)
+            _move_overflow(connection, name, start, end)
+        connection.execute(text("SELECT setval(pg_get_serial_sequence('shopcart', 'id'), :next, false)"),
+                           {"next": max(start, next_id(connection))})
+    return f"shopcart_{name}"
+
+
+def _move_overflow(connection, name: str, start: int, end: int):
+    """Moves the rows of the DEFAULT partitions from start on into new partitions called name"""
+    for table in TABLES:
+        connection.execute(text(f"CREATE TABLE {table}_{name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    # items first, so that no row of item refers to the carts while they are moved
+    for table in ("item", "shopcart"):
+        key = _PARTITION_KEYS[table]
+        connection.execute(text(
+            f"WITH moved AS (DELETE FROM {table}_pdefault WHERE {key} >= {start} RETURNING *) "
+            f"INSERT INTO {table}_{name} SELECT * FROM moved"
+        ))
+    # carts first, so that the foreign key of item finds them
+    for table in TABLES:
+        connection.execute(text(
+            f"ALTER TABLE {table} ATTACH PARTITION {table}_{name} FOR VALUES FROM ({start}) TO ({end})"
+        ))
+
+
+def drop_partitions(connection, before: str, detach_only: bool = False) -> list:
+    """Detaches, and unless detach_only drops, the month partitions older than before ("YYYY-MM")
+
+    The partition new carts go to is never dropped, nor is the DEFAULT
+    partition. Detached partitions are ordinary tables that can still be
+    exported or archived.
+
+    Returns:
+        list: the names of the shopcart partitions removed
+    """
+    try:
+        before = f"{datetime.strptime(before, '%Y-%m'):%Y-%m}"
+    except ValueError as error:
+        raise PartitionError(f"Invalid month {before!r}, use YYYY-MM") from error
+    removed = []
+    with connection.begin():
+        connection.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+        partitions = _month_partitions(connection)
+        for partition in partitions[:-1]:
+            if partition.month is None or partition.month >= before:
+                continue
+            suffix = partition.name[len("shopcart"):]
+            # items first, so that no row of item refers to the detached carts
+            for table in ("item", "shopcart"):
+                connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {table}{suffix}"))
+                if not detach_only:
+                    connection.execute(text(f"DROP TABLE {table}{suffix}"))
+            removed.append(partition.name)
+    return removed
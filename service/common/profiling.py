@@ -0,0 +1,262 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Profiling
+
+WSGI middleware that profiles a single request when it carries an
+X-Profile header matching PROFILE_TOKEN, or at random for a
+PROFILE_SAMPLE_RATE fraction of requests. The profile is written to
+PROFILE_DIR and its file name is returned in the X-Profile-File header;
+fetch it from /admin/profiles/<name> with the admin token.
+
+From Python 3.12 on cProfile hooks the whole interpreter, so only one
+request of a worker is profiled at a time. A request that would be
+profiled while another one is gets X-Profile-Skipped instead.
+
+Profiles are saved as cProfile pstats files (load them with pstats or
+snakeviz), or with "X-Profile-Format: speedscope" as a speedscope
+evented profile that shows the full call timeline.
+"""
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+logger = logging.getLogger("flask.app")
+
+FORMATS = ("pstats", "speedscope")
+
+_UNSAFE = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+######################################################################
+#  S P E E D S C O P E   P R O F I L E R
+######################################################################
+class SpeedscopeProfiler:
+    """Records every function call and return as a speedscope evented profile
+
+    See https://www.speedscope.app/file-format-schema.json
+    """
+
+    def __init__(self):
+        self.frames = []
+        self.frame_index = {}
+        self.events = []
+        self.stack = []
+        self.start = 0.0
+        self.end = 0.0
+
+    def _frame(self, name: str, file: str = None, line: int = None) -> int:
+        key = (name, file, line)
+        index = self.frame_index.get(key)
+        if index is None:
+            index = self.frame_index[key] = len(self.frames)
+            frame = {"name": name}
+            if file:
+                frame.update(file=file, line=line)
+            self.frames.append(frame)
+        return index
+
+    def _hook(self, frame, event, arg):
+        now = time.perf_counter() - self.start
+        if event == "call":
+            code = frame.f_code
+            self._open(self._frame(code.co_qualname, code.co_filename, code.co_firstlineno), now)
+        elif event == "c_call":
+            self._open(self._frame(getattr(arg, "__qualname__", repr(arg))), now)
+        elif self.stack:  # return, c_return, c_exception
+            self.events.append({"type": "C", "frame": self.stack.pop(), "at": now})
+
+    def _open(self, index: int, now: float):
+        self.stack.append(index)
+        self.events.append({"type": "O", "frame": index, "at": now})
+
+    def enable(self):
+        """Starts recording calls on this thread"""
+        self.start = time.perf_counter()
+        sys.setprofile(self._hook)
+
+    def disable(self):
+        """Stops recording and closes the frames that are still open"""
+        sys.setprofile(None)
+        self.end = time.perf_counter() - self.start
+        while self.stack:
+            self.events.append({"type": "C", "frame": self.stack.pop(), "at": self.end})
+
+    def dump(self, path: str, name: str):
+        """Writes the profile as speedscope JSON"""
+        document = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": self.frames},
+            "profiles": [{
+                "type": "evented",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": self.end,
+                "events": self.events,
+            }],
+            "exporter": "shopcarts",
+        }
+        with open(path, "w", encoding="utf-8") as profile_file:
+            json.dump(document, profile_file)
+
+
+######################################################################
+#  M I D D L E W A R E
+######################################################################
+class ProfilerMiddleware:
+    """Profiles requests that ask for it with a token or are sampled
+
+    Args:
+        wsgi_app: the WSGI application to wrap
+        directory: where profiles are written
+        token: secret a request must send in X-Profile (None disables it)
+        sample_rate: fraction of all requests to profile (0 disables it)
+        default_format: "pstats" or "speedscope" for sampled requests
+    """
+
+    def __init__(self, wsgi_app, directory: str, token: str = None, sample_rate: float = 0.0,
+                 default_format: str = "pstats"):
+        # pylint: disable=too-many-arguments
+        self.wsgi_app = wsgi_app
+        self.directory = directory
+        self.token = token
+        self.sample_rate = sample_rate
+        self.default_format = default_format
+        self.lock = threading.Lock()
+
+    def should_profile(self, environ) -> bool:
+        """Returns True if this request is to be profiled"""
+        # event streams never end, so neither would their profile
+        if environ.get("PATH_INFO", "").endswith("/stream"):
+            return False
+        header = environ.get("HTTP_X_PROFILE")
+        if header is not None and self.token and hmac.compare_digest(header.encode(), self.token.encode()):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def profile_name(self, environ, profile_format: str) -> str:
+        """Builds a unique, safe file name for the request's profile"""
+        path = _UNSAFE.sub("_", environ.get("PATH_INFO", "").strip("/").replace("/", ".")) or "root"
+        extension = "speedscope.json" if profile_format == "speedscope" else "prof"
+        return f"{time.time():.6f}-{os.getpid()}-{environ.get('REQUEST_METHOD', 'GET')}-{path}.{extension}"
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+        if not self.lock.acquire(blocking=False):
+            logger.info("Not profiling %s %s, another request is being profiled",
+                        environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"))
+
+            def skipped_start_response(status, headers, exc_info=None):
+                headers.append(("X-Profile-Skipped", "another request is being profiled"))
+                return start_response(status, headers, exc_info)
+
+            return self.wsgi_app(environ, skipped_start_response)
+        return self.profile(environ, start_response)
+
+    def profile(self, environ, start_response):
+        """Serves a request under the profiler, which holds the lock until its profile is saved"""
+        profile_format = environ.get("HTTP_X_PROFILE_FORMAT", self.default_format)
+        if profile_format not in FORMATS:
+            profile_format = self.default_format
+        name = self.profile_name(environ, profile_format)
+        sized = []
+
+        def profiled_start_response(status, headers, exc_info=None):
+            headers.append(("X-Profile-File", name))
+            sized.append(any(key.lower() == "content-length" for key, _ in headers))
+            return start_response(status, headers, exc_info)
+
+        profiler = SpeedscopeProfiler() if profile_format == "speedscope" else cProfile.Profile()
+
+        def finish():
+            try:
+                profiler.disable()
+                self.save(profiler, environ, profile_format, name)
+            finally:
+                self.lock.release()
+
+        profiler.enable()
+        try:
+            response = self.wsgi_app(environ, profiled_start_response)
+            if sized and not sized[-1]:
+                # a streamed body (an export) is profiled until the server closes it
+                return ProfiledBody(response, finish)
+            try:
+                # consume the body here so lazily built responses are included
+                body = list(response)
+            finally:
+                if hasattr(response, "close"):
+                    response.close()
+        except Exception:
+            profiler.disable()
+            self.lock.release()
+            raise
+        finish()
+        return body
+
+    def save(self, profiler, environ, profile_format: str, name: str):
+        """Writes a finished profile to the profile directory"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        if profile_format == "speedscope":
+            profiler.dump(path, f"{environ.get('REQUEST_METHOD')} {environ.get('PATH_INFO')}")
+        else:
+            profiler.dump_stats(path)
+        logger.info("Profiled %s %s to %s", environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"), path)
+
+
+class ProfiledBody:
+    """Passes a streamed body through and finishes its profile when it is closed"""
+
+    def __init__(self, body, finish):
+        self.body = body
+        self.finish = finish
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        """Closes the body, then stops the profiler and saves the profile"""
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.finish()
+
+
+def init_profiling(app):
+    """Wraps the app in the profiler when a token or sample rate is set"""
+    token = app.config["PROFILE_TOKEN"]
+    sample_rate = app.config["PROFILE_SAMPLE_RATE"]
+    if not token and not sample_rate:
+        return
+    app.wsgi_app = ProfilerMiddleware(
+        app.wsgi_app,
+        directory=app.config["PROFILE_DIR"],
+        token=token,
+        sample_rate=sample_rate,
+        default_format=app.config["PROFILE_FORMAT"],
+    )
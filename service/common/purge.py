@@ -0,0 +1,133 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Abandoned Cart Purge
+
+Carts that have not been updated for CART_TTL_DAYS are abandoned. The
+purge copies each of them, with its items as JSON, into the
+shopcart_archive table and deletes it, a small batch per transaction so
+that row locks are only held briefly. Rows locked by a request are
+skipped and picked up by the next run.
+
+Every batch is committed on its own, so a purge that is stopped can be
+started again and carries on with the carts that are left.
+"""
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects import postgresql
+from service.models import db, Shopcart, Item
+
+shopcart_archive = db.Table(
+    "shopcart_archive",
+    db.Column("id", db.Integer, primary_key=True, autoincrement=False),
+    db.Column("name", db.String(64), nullable=False),
+    db.Column("created_at", db.DateTime(timezone=True), nullable=False),
+    db.Column("updated_at", db.DateTime(timezone=True), nullable=False),
+    db.Column("archived_at", db.DateTime(timezone=True), nullable=False, server_default=db.func.now()),
+    db.Column("items", db.JSON().with_variant(postgresql.JSONB(), "postgresql"), nullable=False),
+)
+
+_ITEM_COLUMNS = ("id", "item_id", "description", "quantity", "price")
+
+
+def cutoff_for(ttl_days: float, now: datetime = None) -> datetime:
+    """Returns the time before which an untouched cart is abandoned"""
+    return (now or datetime.now(timezone.utc)) - timedelta(days=ttl_days)
+
+
+def count_stale(connection, cutoff: datetime) -> int:
+    """Returns the number of carts last updated before cutoff"""
+    return connection.execute(select(func.count()).where(Shopcart.updated_at < cutoff)).scalar()
+
+
+def _archive(connection, ids: list):
+    """Copies the carts with ids and their items into shopcart_archive"""
+    shopcart, item = Shopcart.__table__, Item.__table__
+    items = {shopcart_id: [] for shopcart_id in ids}
+    rows = connection.execute(
+        select(item.c.shopcart_id, *[item.c[column] for column in _ITEM_COLUMNS])
+        .where(item.c.shopcart_id.in_(ids))
+        .order_by(item.c.id)
+    )
+    for shopcart_id, *values in rows:
+        items[shopcart_id].append(dict(zip(_ITEM_COLUMNS, values)))
+    carts = connection.execute(
+        select(shopcart.c.id, shopcart.c.name, shopcart.c.created_at, shopcart.c.updated_at)
+        .where(shopcart.c.id.in_(ids))
+    )
+    connection.execute(shopcart_archive.insert(), [dict(cart._mapping, items=items[cart.id]) for cart in carts])
+
+
+def purge_batch(connection, cutoff: datetime, batch_size: int, archive: bool = True) -> tuple:
+    """Archives and deletes up to batch_size abandoned carts in one transaction
+
+    Returns:
+        tuple: (carts deleted, items deleted)
+    """
+    shopcart, item = Shopcart.__table__, Item.__table__
+    stale = select(shopcart.c.id).where(shopcart.c.updated_at < cutoff).order_by(shopcart.c.id).limit(batch_size)
+    if connection.dialect.name == "postgresql":
+        # carts a request is working on are left for the next run
+        stale = stale.with_for_update(skip_locked=True)
+    with connection.begin():
+        ids = connection.execute(stale).scalars().all()
+        if not ids:
+            return 0, 0
+        if archive:
+            _archive(connection, ids)
+        if connection.dialect.name == "postgresql":
+            # the item triggers would touch the carts just before they are deleted
+            connection.execute(text("SET LOCAL shopcarts.purging = on"))
+        items = connection.execute(item.delete().where(item.c.shopcart_id.in_(ids))).rowcount
+        carts = connection.execute(shopcart.delete().where(shopcart.c.id.in_(ids))).rowcount
+    return carts, items
+
+
+def purge_carts(connection, cutoff: datetime, batch_size: int = 500, archive: bool = True, pause: float = 0.0,
+                max_batches: int = None, progress=None) -> dict:
+    """Purges every cart last updated before cutoff, a batch at a time
+
+    Args:
+        connection: a SQLAlchemy Connection outside of a transaction
+        cutoff: carts last updated before this are purged
+        batch_size: carts per batch and transaction
+        archive: copy the carts into shopcart_archive before deleting them
+        pause: seconds to sleep between batches to leave room for other work
+        max_batches: stop after this many batches (the next run carries on)
+        progress: optional callable that is passed the totals after each batch
+
+    Returns:
+        dict: the number of carts, items and batches purged and how long it took
+    """
+    # pylint: disable=too-many-arguments
+    totals = {"shopcarts": 0, "items": 0, "batches": 0, "seconds": 0.0}
+    start = time.perf_counter()
+    while max_batches is None or totals["batches"] < max_batches:
+        carts, items = purge_batch(connection, cutoff, batch_size, archive)
+        if not carts:
+            break
+        totals["shopcarts"] += carts
+        totals["items"] += items
+        totals["batches"] += 1
+        totals["seconds"] = round(time.perf_counter() - start, 3)
+        if progress:
+            progress(totals)
+        if pause:
+            time.sleep(pause)
+    totals["seconds"] = round(time.perf_counter() - start, 3)
+    return totals
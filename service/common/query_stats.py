@@ -0,0 +1,146 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Per-Request Query Statistics
+
+Counts and times the SQL statements issued while handling each request.
+Outside of production the totals are returned in the Server-Timing and
+X-Query-Count headers, and a warning is logged when one statement shape
+runs more than QUERY_REPEAT_THRESHOLD times in a request, which is how an
+N+1 query pattern shows up.
+
+QueryRecorder can also be used on its own, for example by tests that
+assert how many queries an endpoint makes.
+"""
+import contextvars
+import logging
+import re
+from collections import Counter
+from flask import current_app, g, request
+from . import statement_timing
+
+logger = logging.getLogger("flask.app")
+
+_recorders = contextvars.ContextVar("query_recorders", default=())
+
+_WHITESPACE = re.compile(r"\s+")
+
+# Savepoints are transaction control, like the BEGIN and COMMIT the driver
+# sends without a cursor, so they are not counted as queries
+_TRANSACTION_CONTROL = ("SAVEPOINT ", "RELEASE SAVEPOINT ", "ROLLBACK TO SAVEPOINT ")
+
+
+######################################################################
+#  Q U E R Y   R E C O R D E R
+######################################################################
+class QueryRecorder:
+    """Records the SQL statements executed while it is active
+
+    Recorders nest: every active recorder sees every statement.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self._token = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """Starts recording in the current context"""
+        self._token = _recorders.set(_recorders.get() + (self,))
+
+    def stop(self):
+        """Stops recording"""
+        if self._token is not None:
+            _recorders.reset(self._token)
+            self._token = None
+
+    def record(self, statement: str, elapsed: float):
+        """Adds one executed statement"""
+        self.count += 1
+        self.duration += elapsed
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold: int) -> list:
+        """Returns (shape, count) for the shapes run more than threshold times"""
+        return [(shape, count) for shape, count in self.shapes.most_common() if count > threshold]
+
+
+def statement_shape(statement: str) -> str:
+    """Returns the statement with its whitespace normalized
+
+    Values are sent as bind parameters, so the SQL text is the same for
+    every execution of the same query.
+    """
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+def _record_statement(conn, statement, parameters, context, executemany, elapsed):
+    # pylint: disable=unused-argument, too-many-arguments
+    recorders = _recorders.get()
+    if not recorders or statement.startswith(_TRANSACTION_CONTROL):
+        return
+    for recorder in recorders:
+        recorder.record(statement, elapsed)
+
+
+######################################################################
+#  F L A S K   I N T E G R A T I O N
+######################################################################
+def _start_recording():
+    recorder = QueryRecorder()
+    recorder.start()
+    g.query_recorder = recorder
+
+
+def _report_queries(response):
+    recorder = g.get("query_recorder")
+    if recorder is None:
+        return response
+    threshold = current_app.config["QUERY_REPEAT_THRESHOLD"]
+    for shape, count in recorder.repeated(threshold):
+        logger.warning(
+            "Possible N+1: statement ran %d times in %s %s: %s", count, request.method, request.path, shape
+        )
+    if current_app.config["QUERY_STATS_HEADERS"] or current_app.debug or current_app.testing:
+        response.headers["X-Query-Count"] = str(recorder.count)
+        response.headers.add(
+            "Server-Timing", f'db;dur={recorder.duration * 1000:.2f};desc="{recorder.count} queries"'
+        )
+    return response
+
+
+def _stop_recording(exc):  # pylint: disable=unused-argument
+    recorder = g.pop("query_recorder", None)
+    if recorder is not None:
+        recorder.stop()
+
+
+def init_query_stats(app):
+    """Records the queries of every request made to app"""
+    statement_timing.add_callbacks(_record_statement)
+    if app.config.get("QUERY_STATS_ENABLED", True):
+        app.before_request(_start_recording)
+        app.after_request(_report_queries)
+        app.teardown_request(_stop_recording)
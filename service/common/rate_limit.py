@@ -0,0 +1,277 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Rate Limiting
+
+Token bucket rate limits per client and per resource. Every client gets
+a bucket of "limit" tokens for each limited resource; a request takes one
+token and the bucket refills at limit/period tokens a second. A request
+that finds the bucket empty gets 429 Too Many Requests.
+
+Limits are set per flask-restx Resource in RATE_LIMITS, with
+RATE_LIMIT_DEFAULT for everything else, as "<limit>/<period>" where the
+period is "second", "minute", "hour", "day" or a number of seconds.
+
+The buckets live in this worker's memory, or with RATE_LIMIT_STORE=database
+in the rate_limit_bucket table so every worker and pod shares them.
+Responses carry the RateLimit-Limit, RateLimit-Remaining, RateLimit-Reset
+and RateLimit-Policy headers of the IETF RateLimit header fields draft.
+"""
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+from flask import current_app, request
+from sqlalchemy import case
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from service.models import db
+from . import status
+from .metrics import REGISTRY, Counter, resource_name
+
+logger = logging.getLogger("flask.app")
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+RATE_LIMITED = Counter(
+    REGISTRY, "shopcarts_rate_limited_total", "Requests rejected by the rate limiter", ("resource",)
+)
+
+Limit = namedtuple("Limit", "limit period")
+Decision = namedtuple("Decision", "allowed limit period remaining reset retry_after")
+
+
+def parse_limit(text: str) -> Limit:
+    """Parses "<limit>/<period>" (e.g. "100/minute" or "10/30")"""
+    count, _, period = text.strip().partition("/")
+    period = period.strip().lower() or "second"
+    seconds = PERIODS.get(period.rstrip("s"), None)
+    try:
+        limit = Limit(int(count), float(seconds if seconds is not None else period))
+    except ValueError as error:
+        raise ValueError(f"Invalid rate limit {text!r}") from error
+    if limit.limit <= 0 or limit.period <= 0:
+        raise ValueError(f"Invalid rate limit {text!r}")
+    return limit
+
+
+######################################################################
+#  B U C K E T   S T O R E S
+######################################################################
+class MemoryStore:
+    """Token buckets kept in this worker's memory"""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.buckets = {}
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def consume(self, key: str, capacity: int, rate: float, now: float) -> tuple:
+        """Takes a token from the bucket for key
+
+        Returns:
+            tuple: (whether a token was taken, tokens left)
+        """
+        with self.lock:
+            tokens, updated, _, _ = self.buckets.get(key, (capacity, now, capacity, rate))
+            tokens = min(capacity, tokens + max(now - updated, 0) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if key not in self.buckets and len(self.buckets) >= self.max_keys:
+                self.prune(now)
+            self.buckets[key] = (tokens, max(now, updated), capacity, rate)
+        return allowed, tokens
+
+    def prune(self, now: float):
+        """Drops the buckets that have refilled, which is the same as having none"""
+        for key, (tokens, updated, capacity, rate) in list(self.buckets.items()):
+            if tokens + (now - updated) * rate >= capacity:
+                del self.buckets[key]
+
+
+rate_limit_bucket = db.Table(
+    "rate_limit_bucket",
+    db.Column("key", db.String(255), primary_key=True),
+    db.Column("tokens", db.Float, nullable=False),
+    db.Column("updated_at", db.Float, nullable=False),
+    db.Column("allowed", db.Boolean, nullable=False),
+)
+
+
+class DatabaseStore:
+    """Token buckets shared by every worker through a database table
+
+    Each request costs a single upsert that refills and takes a token
+    atomically. PostgreSQL is the shared store in production; a SQLite
+    engine works as a local stand-in.
+    """
+
+    dialects = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+    def __init__(self, engine=None, idle_seconds: float = 86400, prune_interval: float = 300):
+        self._engine = engine
+        self.idle_seconds = idle_seconds
+        self.prune_interval = prune_interval
+        self.pruned_at = time.time()
+
+    @property
+    def engine(self):
+        """The engine holding the buckets (the service database by default)"""
+        return self._engine if self._engine is not None else db.engine
+
+    def consume(self, key: str, capacity: int, rate: float, now: float) -> tuple:
+        """Takes a token from the bucket for key
+
+        Returns:
+            tuple: (whether a token was taken, tokens left)
+        """
+        engine = self.engine
+        table = rate_limit_bucket
+        elapsed = case((table.c.updated_at < now, now - table.c.updated_at), else_=0.0)
+        refilled = table.c.tokens + elapsed * rate
+        refilled = case((refilled > capacity, float(capacity)), else_=refilled)
+        statement = self.dialects[engine.dialect.name](table).values(
+            key=key, tokens=capacity - 1.0, updated_at=now, allowed=True
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_={
+                "tokens": case((refilled >= 1, refilled - 1), else_=refilled),
+                "updated_at": case((table.c.updated_at < now, now), else_=table.c.updated_at),
+                "allowed": refilled >= 1,
+            },
+        ).returning(table.c.allowed, table.c.tokens)
+        with engine.begin() as connection:
+            allowed, tokens = connection.execute(statement).one()
+        if now - self.pruned_at >= self.prune_interval:
+            self.pruned_at = now
+            self.prune(self.idle_seconds, now)
+        return bool(allowed), tokens
+
+    def prune(self, idle_seconds: float, now: float) -> int:
+        """Deletes the buckets that have not been used for idle_seconds"""
+        with self.engine.begin() as connection:
+            result = connection.execute(
+                rate_limit_bucket.delete().where(rate_limit_bucket.c.updated_at < now - idle_seconds)
+            )
+        return result.rowcount
+
+
+######################################################################
+#  R A T E   L I M I T E R
+######################################################################
+class RateLimiter:
+    """Decides whether a client may make another request to a resource"""
+
+    def __init__(self, store, limits: dict, default: Limit = None):
+        self.store = store
+        self.limits = limits
+        self.default = default
+
+    def limit_for(self, resource: str) -> Limit:
+        """Returns the limit of resource (None if it is not limited)"""
+        return self.limits.get(resource, self.default)
+
+    def hit(self, resource: str, client: str, now: float = None) -> Decision:
+        """Takes a token for client from the bucket of resource"""
+        limit = self.limit_for(resource)
+        if limit is None:
+            return None
+        now = time.time() if now is None else now
+        rate = limit.limit / limit.period
+        try:
+            allowed, tokens = self.store.consume(f"{resource}:{client}", limit.limit, rate, now)
+        except SQLAlchemyError as error:
+            # fail open: an outage of the store must not take the API down
+            logger.warning("Rate limit store unavailable: %s", error)
+            return None
+        return Decision(
+            allowed=allowed,
+            limit=limit.limit,
+            period=limit.period,
+            remaining=int(tokens),
+            reset=math.ceil((limit.limit - tokens) / rate),
+            retry_after=0 if allowed else math.ceil((1 - tokens) / rate),
+        )
+
+
+def client_identity(config) -> str:
+    """Identifies the client by RATE_LIMIT_CLIENT_HEADER or its address"""
+    header = config["RATE_LIMIT_CLIENT_HEADER"]
+    if header and request.headers.get(header):
+        return "id:" + request.headers[header][:200]
+    proxies = config["RATE_LIMIT_PROXY_COUNT"]
+    route = request.access_route
+    if proxies and len(route) > proxies:
+        # each trusted proxy appends the address it received the request from
+        return "ip:" + route[-proxies - 1]
+    return "ip:" + (request.remote_addr or "unknown")
+
+
+######################################################################
+#  F L A S K   I N T E G R A T I O N
+######################################################################
+def _check_rate_limit():
+    # probes and scrapes share one client, so limiting them could get the pod restarted
+    if request.path in current_app.config["RATE_LIMIT_EXEMPT_PATHS"]:
+        return None
+    limiter = current_app.extensions["rate_limit"]
+    resource = resource_name()
+    decision = limiter.hit(resource, client_identity(current_app.config))
+    if decision is None:
+        return None
+    request.environ["shopcarts.rate_limit"] = decision
+    if decision.allowed:
+        return None
+    RATE_LIMITED.inc(resource=resource)
+    return {
+        "status_code": status.HTTP_429_TOO_MANY_REQUESTS,
+        "error": "Too Many Requests",
+        "message": f"Rate limit of {decision.limit} requests per {decision.period:g} seconds exceeded",
+    }, status.HTTP_429_TOO_MANY_REQUESTS, {"Retry-After": str(decision.retry_after)}
+
+
+def _add_rate_limit_headers(response):
+    decision = request.environ.get("shopcarts.rate_limit")
+    if decision is not None:
+        response.headers["RateLimit-Limit"] = str(decision.limit)
+        response.headers["RateLimit-Remaining"] = str(decision.remaining)
+        response.headers["RateLimit-Reset"] = str(decision.reset)
+        response.headers["RateLimit-Policy"] = f"{decision.limit};w={decision.period:g}"
+    return response
+
+
+def build_store(name: str):
+    """Returns the bucket store called name ("memory" or "database")"""
+    if name == "database":
+        return DatabaseStore()
+    if name == "memory":
+        return MemoryStore()
+    raise ValueError(f"Unknown rate limit store {name!r}")
+
+
+def init_rate_limit(app):
+    """Rate limits the app's requests when any limit is configured"""
+    limits = {name: parse_limit(text) for name, text in app.config["RATE_LIMITS"].items()}
+    default = parse_limit(app.config["RATE_LIMIT_DEFAULT"]) if app.config["RATE_LIMIT_DEFAULT"] else None
+    if not limits and default is None:
+        return
+    app.extensions["rate_limit"] = RateLimiter(build_store(app.config["RATE_LIMIT_STORE"]), limits, default)
+    app.before_request(_check_rate_limit)
+    app.after_request(_add_rate_limit_headers)
@@ -0,0 +1,170 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Synthetic Data
+
+Generates large, production-like datasets for benchmarks and load tests.
+Cart sizes follow a Zipf distribution (most carts hold a few items, a
+long tail holds many) and items are drawn from a product catalog with a
+Zipf skew, so a few hot products are in a lot of carts. The same seed
+always generates the same data, whatever the batch size.
+
+PostgreSQL is loaded with COPY, other databases with multi-row INSERTs.
+"""
+import itertools
+import random
+import time
+from collections import namedtuple
+from sqlalchemy import text
+from service.models import Shopcart, Item
+
+DISTRIBUTIONS = ("zipf", "uniform")
+
+Product = namedtuple("Product", "item_id description price")
+
+
+def cumulative_weights(count: int, skew: float) -> list:
+    """Returns the cumulative Zipf weights of ranks 1..count (skew 0 is uniform)"""
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+
+class DataGenerator:
+    """Deterministic generator of carts and their items
+
+    Args:
+        seed: the random seed
+        max_items: the largest cart
+        size_skew: Zipf exponent of the cart sizes
+        distribution: "zipf" or "uniform" cart sizes
+        products: size of the product catalog items are drawn from
+        product_skew: Zipf exponent of product popularity
+    """
+
+    def __init__(self, seed: int = 42, max_items: int = 50, size_skew: float = 1.1, distribution: str = "zipf",
+                 products: int = 5000, product_skew: float = 1.0):
+        # pylint: disable=too-many-arguments
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"Unknown distribution {distribution!r}")
+        # separate streams keep the data independent of how it is batched
+        self.size_random = random.Random(f"{seed}-sizes")
+        self.item_random = random.Random(f"{seed}-items")
+        catalog_random = random.Random(f"{seed}-catalog")
+        self.catalog = [
+            Product(str(number), f"product {number}", catalog_random.randint(100, 10000))
+            for number in range(1, products + 1)
+        ]
+        self.sizes = range(1, max_items + 1)
+        self.size_weights = cumulative_weights(max_items, size_skew if distribution == "zipf" else 0)
+        self.product_weights = cumulative_weights(products, product_skew)
+        self.quantity_weights = cumulative_weights(5, 2.0)
+
+    def cart_sizes(self, count: int) -> list:
+        """Returns the number of items of the next count carts"""
+        return self.size_random.choices(self.sizes, cum_weights=self.size_weights, k=count)
+
+    def items(self, size: int) -> list:
+        """Returns (item_id, description, quantity, price) for a cart of size items"""
+        products = self.item_random.choices(self.catalog, cum_weights=self.product_weights, k=size)
+        quantities = self.item_random.choices(range(1, 6), cum_weights=self.quantity_weights, k=size)
+        return [
+            (product.item_id, product.description, quantity, product.price)
+            for product, quantity in zip(products, quantities)
+        ]
+
+
+######################################################################
+#  L O A D E R S
+######################################################################
+def _copy_batch(connection, first: int, sizes: list, generator: DataGenerator) -> int:
+    """Loads one batch into PostgreSQL with COPY and returns the number of items"""
+    ids = connection.execute(
+        text("SELECT nextval(pg_get_serial_sequence('shopcart', 'id')) FROM generate_series(1, :count)"),
+        {"count": len(sizes)},
+    ).scalars().all()
+    cursor = connection.connection.cursor()
+    try:
+        with cursor.copy("COPY shopcart (id, name) FROM STDIN") as copy:
+            for number, shopcart_id in enumerate(ids, first):
+                copy.write_row((shopcart_id, f"cart-{number}"))
+        item_count = 0
+        with cursor.copy("COPY item (shopcart_id, item_id, description, quantity, price) FROM STDIN") as copy:
+            for shopcart_id, size in zip(ids, sizes):
+                for row in generator.items(size):
+                    copy.write_row((shopcart_id, *row))
+                item_count += size
+    finally:
+        cursor.close()
+    return item_count
+
+
+def _insert_batch(connection, first: int, sizes: list, generator: DataGenerator) -> int:
+    """Loads one batch with multi-row INSERTs and returns the number of items"""
+    ids = connection.execute(
+        Shopcart.__table__.insert().returning(Shopcart.__table__.c.id, sort_by_parameter_order=True),
+        [{"name": f"cart-{number}"} for number in range(first, first + len(sizes))],
+    ).scalars().all()
+    rows = [
+        {"shopcart_id": shopcart_id, "item_id": item_id, "description": description, "quantity": quantity,
+         "price": price}
+        for shopcart_id, size in zip(ids, sizes)
+        for item_id, description, quantity, price in generator.items(size)
+    ]
+    if rows:
+        connection.execute(Item.__table__.insert(), rows)
+    return len(rows)
+
+
+def truncate(connection):
+    """Deletes every cart and item"""
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("TRUNCATE item, shopcart RESTART IDENTITY"))
+    else:
+        connection.execute(Item.__table__.delete())
+        connection.execute(Shopcart.__table__.delete())
+    connection.commit()
+
+
+def seed_data(connection, generator: DataGenerator, carts: int, batch_size: int = 10000, progress=None) -> dict:
+    """Loads carts generated by generator, committing after every batch
+
+    Args:
+        connection: a SQLAlchemy Connection
+        generator: the DataGenerator to draw carts from
+        carts: how many carts to create
+        batch_size: carts per batch and transaction
+        progress: optional callable that is passed the totals after each batch
+
+    Returns:
+        dict: the number of carts and items loaded and how long it took
+    """
+    load_batch = _copy_batch if connection.dialect.name == "postgresql" else _insert_batch
+    totals = {"shopcarts": 0, "items": 0, "seconds": 0.0}
+    start = time.perf_counter()
+    for first in range(0, carts, batch_size):
+        sizes = generator.cart_sizes(min(batch_size, carts - first))
+        totals["items"] += load_batch(connection, first, sizes, generator)
+        totals["shopcarts"] += len(sizes)
+        connection.commit()
+        totals["seconds"] = round(time.perf_counter() - start, 3)
+        if progress:
+            progress(totals)
+    if connection.dialect.name == "postgresql":
+        # give the planner statistics for the new data
+        connection.execute(text("ANALYZE shopcart, item"))
+        connection.commit()
+    totals["seconds"] = round(time.perf_counter() - start, 3)
+    return totals
@@ -0,0 +1,271 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Slow Query Log
+
+Logs every SQL statement that takes longer than SLOW_QUERY_SECONDS with
+the shape of its parameters (never their values), the route that issued
+it and the function in service/models that ran it.
+
+With SLOW_QUERY_EXPLAIN on, slow statements issued from service/models
+are handed to a background thread that explains them on its own
+connection and logs the plan in a second line, so a request never waits
+for a plan or takes a second connection from the pool. SELECTs use
+EXPLAIN (ANALYZE, BUFFERS) and run again, for at most
+SLOW_QUERY_EXPLAIN_TIMEOUT seconds; other statements only get a plain
+EXPLAIN so nothing is written twice, and so do SELECTs that lock rows
+(FOR UPDATE/SHARE) or call volatile functions such as nextval(). Log lines are limited to
+SLOW_QUERY_LOG_LIMIT a minute and each statement is explained at most
+once per SLOW_QUERY_EXPLAIN_INTERVAL seconds.
+"""
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from flask import has_request_context, request
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from . import statement_timing
+
+logger = logging.getLogger("flask.app")
+
+# row locks a SELECT takes, which running it again under ANALYZE would take too
+_LOCKING = re.compile(r"\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b", re.IGNORECASE)
+_CALL = re.compile(r"\b([A-Za-z_][A-Za-z0-9_$]*)\s*\(")
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models") + os.sep
+
+settings = {
+    "threshold": 0.5,
+    "explain": False,
+    "log_limit": 10,
+    "explain_interval": 300.0,
+    "explain_timeout": 5.0,
+}
+
+# Most plans waiting for the explainer; more slow statements go unexplained
+EXPLAIN_QUEUE_SIZE = 16
+# Most statements remembered for SLOW_QUERY_EXPLAIN_INTERVAL
+EXPLAIN_CACHE_SIZE = 1000
+
+
+######################################################################
+#  R A T E   L I M I T I N G
+######################################################################
+class RateLimiter:
+    """Allows at most limit events per period seconds"""
+
+    def __init__(self, limit: int, period: float = 60.0):
+        self.limit = limit
+        self.period = period
+        self.window_start = 0.0
+        self.count = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Returns True if another event is allowed in this period"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.period:
+                self.window_start = now
+                self.count = 0
+            if self.count >= self.limit:
+                self.suppressed += 1
+                return False
+            self.count += 1
+            return True
+
+    def take_suppressed(self) -> int:
+        """Returns and resets the number of events that were not allowed"""
+        with self.lock:
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed
+
+
+_log_limiter = RateLimiter(settings["log_limit"])
+_explained = OrderedDict()  # hash of the statement -> when it was explained, oldest first
+_explained_lock = threading.Lock()
+
+
+def _explain_due(statement: str) -> bool:
+    """Returns True if statement has not been explained recently"""
+    key = hash(statement)
+    now = time.monotonic()
+    with _explained_lock:
+        if key in _explained and now - _explained[key] < settings["explain_interval"]:
+            return False
+        _explained[key] = now
+        _explained.move_to_end(key)
+        if len(_explained) > EXPLAIN_CACHE_SIZE:
+            _explained.popitem(last=False)
+    return True
+
+
+######################################################################
+#  S T A T E M E N T   D E T A I L S
+######################################################################
+def parameter_shape(parameters, executemany: bool = False) -> str:
+    """Describes the parameters by name and type without their values"""
+    if executemany:
+        rows = list(parameters)
+        return f"{len(rows)} x {parameter_shape(rows[0]) if rows else '()'}"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{name}: {type(value).__name__}" for name, value in parameters.items()) + "}"
+    if isinstance(parameters, (list, tuple)):
+        return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+    return type(parameters).__name__
+
+
+def model_caller() -> str:
+    """Returns module:function:line of the innermost caller in service/models"""
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(MODELS_DIR):
+            module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+            return f"{module}:{frame.f_code.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return None
+
+
+def current_route() -> str:
+    """Returns the method and route of the request being handled"""
+    if not has_request_context():
+        return "no request"
+    return f"{request.method} {request.url_rule or request.path}"
+
+
+def can_analyze(cursor, statement: str) -> bool:
+    """Returns True if statement can run again without side effects
+
+    That is a SELECT that takes no row locks and calls no function that
+    PostgreSQL marks volatile (any overload of the name counts).
+    """
+    if statement.lstrip()[:6].upper() != "SELECT" or _LOCKING.search(statement):
+        return False
+    names = sorted({name.lower() for name in _CALL.findall(statement)})
+    if not names:
+        return True
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_proc WHERE proname = ANY(%s) AND provolatile = 'v')", (names,))
+    return not cursor.fetchone()[0]
+
+
+def explain(engine, statement: str, parameters) -> str:
+    """Returns the query plan of statement
+
+    The plan comes from a raw DBAPI connection so the EXPLAIN does not
+    trigger SQLAlchemy events, and gives up after SLOW_QUERY_EXPLAIN_TIMEOUT.
+    """
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.execute(f"SET LOCAL statement_timeout = {int(settings['explain_timeout'] * 1000)}")
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if can_analyze(cursor, statement) else "EXPLAIN "
+        cursor.execute(prefix + statement, parameters)
+        return "\n".join(row[0] for row in cursor.fetchall())
+    finally:
+        raw.rollback()
+        raw.close()
+
+
+######################################################################
+#  E X P L A I N E R
+######################################################################
+_explain_queue = queue.Queue(EXPLAIN_QUEUE_SIZE)
+_explainer = {"thread": None, "engines": {}}
+_explainer_lock = threading.Lock()
+
+
+def _explain_engine(engine):
+    """Returns an engine with one dedicated connection to the database of engine"""
+    if engine not in _explainer["engines"]:
+        _explainer["engines"][engine] = create_engine(engine.url, poolclass=StaticPool, pool_pre_ping=True)
+    return _explainer["engines"][engine]
+
+
+def _explain_worker():
+    """Explains the queued statements one at a time and logs their plans"""
+    while True:
+        engine, statement, parameters, caller = _explain_queue.get()
+        try:
+            plan = explain(_explain_engine(engine), statement, parameters)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            plan = f"EXPLAIN failed: {error}"
+        finally:
+            _explain_queue.task_done()
+        logger.warning("Plan of the slow query from %s: %s\n%s", caller, statement, plan)
+
+
+def submit_explain(engine, statement: str, parameters, caller: str) -> bool:
+    """Queues a statement for the explainer, returning False when the queue is full"""
+    with _explainer_lock:
+        if _explainer["thread"] is None:
+            _explainer["thread"] = threading.Thread(target=_explain_worker, name="slow-query-explainer", daemon=True)
+            _explainer["thread"].start()
+    try:
+        _explain_queue.put_nowait((engine, statement, parameters, caller))
+    except queue.Full:
+        return False
+    return True
+
+
+######################################################################
+#  E V E N T   H O O K S
+######################################################################
+def _check_statement(conn, statement, parameters, context, executemany, elapsed):
+    # pylint: disable=unused-argument, too-many-arguments
+    if elapsed < settings["threshold"] or not _log_limiter.allow():
+        return
+    log_slow_query(conn, statement, parameters, executemany, elapsed)
+
+
+def log_slow_query(conn, statement, parameters, executemany, elapsed):
+    """Logs one slow statement and, when enabled, its plan"""
+    # pylint: disable=too-many-arguments
+    caller = model_caller()
+    message = "Slow query (%.1f ms) in %s from %s: %s params=%s"
+    args = [elapsed * 1000, current_route(), caller or "outside service/models", statement,
+            parameter_shape(parameters, executemany)]
+    suppressed = _log_limiter.take_suppressed()
+    if suppressed:
+        message += " (%d more slow queries were not logged)"
+        args.append(suppressed)
+    logger.warning(message, *args)
+    if (settings["explain"] and caller and not executemany
+            and conn.dialect.name == "postgresql" and _explain_due(statement)):
+        submit_explain(conn.engine, statement, parameters, caller)
+
+
+def init_slow_query_log(app):
+    """Logs the slow queries of every engine using the app's settings"""
+    settings.update(
+        threshold=app.config["SLOW_QUERY_SECONDS"],
+        explain=app.config["SLOW_QUERY_EXPLAIN"],
+        log_limit=app.config["SLOW_QUERY_LOG_LIMIT"],
+        explain_interval=app.config["SLOW_QUERY_EXPLAIN_INTERVAL"],
+        explain_timeout=app.config["SLOW_QUERY_EXPLAIN_TIMEOUT"],
+    )
+    _log_limiter.limit = settings["log_limit"]
+    enabled = app.config["SLOW_QUERY_LOG_ENABLED"]
+    if enabled:
+        statement_timing.add_callbacks(_check_statement)
+    else:
+        statement_timing.remove_callbacks(_check_statement)
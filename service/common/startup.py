@@ -0,0 +1,50 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Startup Timing
+
+This module records how long each phase of create_app() takes so that
+slow worker boots can be tracked down
+"""
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """Collects wall clock timings, in milliseconds, for named startup phases"""
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """Times the code run inside the with block as the named phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (time.perf_counter() - start) * 1000.0
+
+    @property
+    def total(self) -> float:
+        """Total time of all recorded phases in milliseconds"""
+        return sum(self.phases.values())
+
+    def report(self) -> str:
+        """Returns a one line summary suitable for logging"""
+        timings = " ".join(f"{name}={elapsed:.1f}ms" for name, elapsed in self.phases.items())
+        return f"Startup timings: {timings} total={self.total:.1f}ms"
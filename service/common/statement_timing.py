@@ -0,0 +1,94 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Statement Timing
+
+One set of Engine hooks times every SQL statement for all of the SQL
+instrumentation (metrics, query statistics, the slow query log and
+tracing), so a statement is timed once however many of them are on.
+
+Each feature adds a callback that is called after every statement with
+its duration:
+
+    callback(conn, statement, parameters, context, executemany, elapsed)
+
+and, if it wants to hear about them, one for the statements that fail:
+
+    callback(conn, statement, error, elapsed)
+
+The start time is kept on the statement's ExecutionContext, which goes
+away with the statement even when it fails or is cancelled, so nothing
+is ever left on a pooled connection.
+"""
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_callbacks = {"after": [], "error": []}
+
+
+def _elapsed(context) -> float:
+    start = getattr(context, "statement_timing_start", None)
+    return None if start is None else time.perf_counter() - start
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument, too-many-arguments
+    context.statement_timing_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument, too-many-arguments
+    elapsed = _elapsed(context)
+    if elapsed is None:
+        return
+    for callback in _callbacks["after"]:
+        callback(conn, statement, parameters, context, executemany, elapsed)
+
+
+def _handle_error(exception_context):
+    elapsed = _elapsed(exception_context.execution_context)
+    if elapsed is None:
+        return
+    for callback in _callbacks["error"]:
+        callback(exception_context.connection, exception_context.statement,
+                 exception_context.original_exception, elapsed)
+
+
+def add_callbacks(after, error=None):
+    """Calls after (and error) for every statement, once however often it is added"""
+    if after not in _callbacks["after"]:
+        _callbacks["after"].append(after)
+    if error is not None and error not in _callbacks["error"]:
+        _callbacks["error"].append(error)
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+
+
+def remove_callbacks(after, error=None):
+    """Stops calling after (and error)"""
+    if after in _callbacks["after"]:
+        _callbacks["after"].remove(after)
+    if error in _callbacks["error"]:
+        _callbacks["error"].remove(error)
+
+
+def has_callback(after) -> bool:
+    """Returns True if after is called for every statement"""
+    return after in _callbacks["after"]
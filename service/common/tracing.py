@@ -0,0 +1,452 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Distributed Tracing
+
+A small OpenTelemetry compatible tracer. Each request gets a server span
+named after the flask-restx resource method, continuing the trace of an
+incoming W3C "traceparent" header. Model CRUD calls, response encoding
+and every SQL statement get child spans, so a trace shows how much of a
+request went to the database, to the ORM and to serialization.
+
+Finished spans are exported in batches from a background thread as
+OTLP/JSON, either to an OTLP/HTTP collector (TRACING_EXPORTER=otlp) or
+as one span per line to a file (TRACING_EXPORTER=file). With no exporter
+configured tracing is off and spans cost a single attribute check.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.request
+from collections import deque
+from functools import wraps
+from flask import g, request
+from . import statement_timing
+from .metrics import resource_name, statement_operation
+
+logger = logging.getLogger("flask.app")
+
+SPAN_KINDS = {"INTERNAL": 1, "SERVER": 2, "CLIENT": 3}
+STATUS_ERROR = 2
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def parse_traceparent(header: str):
+    """Returns (trace_id, parent_id, sampled) from a traceparent header or None"""
+    match = _TRACEPARENT.match(header.strip().lower()) if header else None
+    if not match or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+######################################################################
+#  S P A N S
+######################################################################
+class Span:
+    """A timed operation within a trace"""
+
+    __slots__ = (
+        "tracer", "name", "kind", "trace_id", "span_id", "parent_id", "sampled",
+        "attributes", "start_ns", "end_ns", "error", "_token",
+    )
+
+    def __init__(self, tracer, name, kind, trace_id, parent_id, sampled, attributes):
+        # pylint: disable=too-many-arguments
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self._token = None
+
+    @property
+    def traceparent(self) -> str:
+        """The W3C traceparent header that continues this span's trace"""
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def set_attribute(self, key: str, value):
+        """Adds an attribute to the span"""
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException):
+        """Marks the span as failed"""
+        self.error = f"{type(error).__name__}: {error}"
+
+    def activate(self):
+        """Makes this span the parent of spans started after it"""
+        self._token = _current_span.set(self)
+        return self
+
+    def end(self):
+        """Finishes the span and hands it to the exporter"""
+        if self._token is not None:
+            _current_span.reset(self._token)
+            self._token = None
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            processor = self.tracer.processor
+            if self.sampled and processor is not None:
+                processor.on_end(self)
+
+    def __enter__(self):
+        return self.activate()
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc is not None:
+            self.record_error(exc)
+        self.end()
+
+    def to_otlp(self) -> dict:
+        """Returns the span in the OTLP/JSON encoding"""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KINDS[self.kind],
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error:
+            span["status"] = {"code": STATUS_ERROR, "message": self.error}
+        return span
+
+
+class _NoopSpan:
+    """Stands in for a span while tracing is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return None
+
+    def set_attribute(self, key, value):
+        """Ignores the attribute"""
+
+    def record_error(self, error):
+        """Ignores the error"""
+
+    def end(self):
+        """Nothing to finish"""
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+######################################################################
+#  E X P O R T E R S
+######################################################################
+class InMemoryExporter:
+    """Keeps exported spans in a list (for tests)"""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans: list, resource: dict):  # pylint: disable=unused-argument
+        """Stores the spans"""
+        self.spans.extend(spans)
+
+
+class FileExporter:
+    """Appends each span to a file as one line of OTLP/JSON"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: list, resource: dict):
+        """Writes the spans with their resource attributes"""
+        with open(self.path, "a", encoding="utf-8") as trace_file:
+            for span in spans:
+                trace_file.write(json.dumps({"resource": resource, "span": span.to_otlp()}) + "\n")
+
+
+class OtlpHttpExporter:
+    """Posts spans to an OTLP/HTTP collector using the JSON encoding"""
+
+    def __init__(self, endpoint: str, timeout: float = 5.0):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def payload(self, spans: list, resource: dict) -> dict:
+        """Builds the ExportTraceServiceRequest body"""
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes(resource)},
+                "scopeSpans": [{
+                    "scope": {"name": "service.common.tracing"},
+                    "spans": [span.to_otlp() for span in spans],
+                }],
+            }]
+        }
+
+    def export(self, spans: list, resource: dict):
+        """Sends the spans to the collector"""
+        body = json.dumps(self.payload(spans, resource)).encode("utf-8")
+        post = urllib.request.Request(
+            self.endpoint, data=body, headers={"Content-Type": "application/json"}, method="POST"
+        )
+        with urllib.request.urlopen(post, timeout=self.timeout):  # nosec - configured collector URL
+            pass
+
+
+class BatchProcessor:
+    """Collects finished spans and exports them from a background thread
+
+    At most max_queue_size spans wait for export. When the exporter falls
+    behind, the oldest are dropped and counted, as the OpenTelemetry SDK does.
+    """
+
+    def __init__(self, exporter, resource: dict, max_batch: int = 512, interval: float = 2.0,
+                 max_queue_size: int = 2048):
+        # pylint: disable=too-many-arguments
+        self.exporter = exporter
+        self.resource = resource
+        self.max_batch = max_batch
+        self.interval = interval
+        self.spans = deque(maxlen=max_queue_size)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def on_end(self, span: Span):
+        """Queues a finished span, dropping the oldest when the queue is full"""
+        with self.lock:
+            if len(self.spans) == self.spans.maxlen:
+                self.dropped += 1
+            self.spans.append(span)
+            full = len(self.spans) >= self.max_batch
+        if self.thread is None:
+            self.start()
+        if full:
+            self.wakeup.set()
+
+    def start(self):
+        """Starts the export thread"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Exports the queued spans now, max_batch at a time"""
+        with self.lock:
+            spans = list(self.spans)
+            self.spans.clear()
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            logger.warning("Dropped %d spans, the export queue was full", dropped)
+        for start in range(0, len(spans), self.max_batch):
+            batch = spans[start:start + self.max_batch]
+            try:
+                self.exporter.export(batch, self.resource)
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                logger.warning("Dropped %d spans, export failed: %s", len(batch), error)
+
+
+######################################################################
+#  T R A C E R
+######################################################################
+class Tracer:
+    """Starts spans and sends the finished ones to its processor"""
+
+    def __init__(self):
+        self.processor = None
+
+    @property
+    def enabled(self) -> bool:
+        """True when spans are being exported"""
+        return self.processor is not None
+
+    def start_span(self, name: str, kind: str = "INTERNAL", attributes: dict = None, parent=None) -> Span:
+        """Starts a span under parent, the current span, or a new trace
+
+        Args:
+            parent: a Span or a (trace_id, span_id, sampled) tuple
+        """
+        parent = parent if parent is not None else _current_span.get()
+        if parent is None:
+            trace_id, parent_id, sampled = os.urandom(16).hex(), None, True
+        elif isinstance(parent, Span):
+            trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+        else:
+            trace_id, parent_id, sampled = parent
+        return Span(self, name, kind, trace_id, parent_id, sampled, dict(attributes or {}))
+
+    def span(self, name: str, kind: str = "INTERNAL", **attributes):
+        """Returns a span to use in a with statement (a no-op when tracing is off)"""
+        if self.processor is None:
+            return NOOP_SPAN
+        return self.start_span(name, kind, attributes)
+
+    def flush(self):
+        """Exports every finished span now"""
+        if self.processor is not None:
+            self.processor.flush()
+
+
+tracer = Tracer()
+
+
+def current_span():
+    """Returns the active span (None outside of a span)"""
+    return _current_span.get()
+
+
+def traced_method(func):
+    """Wraps a model method in a span named Class.method"""
+
+    @wraps(func)
+    def decorated(owner, *args, **kwargs):
+        if tracer.processor is None:
+            return func(owner, *args, **kwargs)
+        model = owner.__name__ if isinstance(owner, type) else type(owner).__name__
+        with tracer.start_span(f"{model}.{func.__name__}", attributes={"code.function": func.__qualname__}):
+            return func(owner, *args, **kwargs)
+
+    return decorated
+
+
+######################################################################
+#  F L A S K   A N D   S Q L A L C H E M Y   H O O K S
+######################################################################
+def _start_request_span():
+    if tracer.processor is None:
+        return
+    view_name = resource_name()
+    name = f"{view_name}.{request.method.lower()}" if view_name != "unmatched" else f"{request.method} unmatched"
+    span = tracer.start_span(
+        name,
+        kind="SERVER",
+        parent=parse_traceparent(request.headers.get("traceparent")),
+        attributes={
+            "http.request.method": request.method,
+            "http.route": str(request.url_rule or ""),
+            "url.path": request.path,
+        },
+    )
+    g.trace_span = span.activate()
+
+
+def _record_status(response):
+    span = g.get("trace_span")
+    if span is not None:
+        span.set_attribute("http.response.status_code", response.status_code)
+        if response.status_code >= 500:
+            span.error = f"HTTP {response.status_code}"
+    return response
+
+
+def _end_request_span(exc):
+    span = g.pop("trace_span", None)
+    if span is not None:
+        if exc is not None:
+            span.record_error(exc)
+        span.end()
+
+
+def _statement_span(conn, statement: str, elapsed: float) -> Span:
+    """Returns the span of a statement that started elapsed seconds ago
+
+    Statements have no child spans, so theirs is never activated.
+    """
+    span = tracer.start_span(
+        statement_operation(statement),
+        kind="CLIENT",
+        attributes={"db.system": conn.dialect.name, "db.statement": statement},
+    )
+    span.start_ns -= int(elapsed * 1e9)
+    return span
+
+
+def _trace_statement(conn, statement, parameters, context, executemany, elapsed):
+    # pylint: disable=unused-argument, too-many-arguments
+    if tracer.processor is not None:
+        _statement_span(conn, statement, elapsed).end()
+
+
+def _trace_failed_statement(conn, statement, error, elapsed):
+    if tracer.processor is not None:
+        span = _statement_span(conn, statement, elapsed)
+        span.record_error(error)
+        span.end()
+
+
+def build_exporter(app):
+    """Returns the exporter selected by TRACING_EXPORTER (None for off)"""
+    name = app.config["TRACING_EXPORTER"]
+    if name == "otlp":
+        return OtlpHttpExporter(app.config["TRACING_OTLP_ENDPOINT"])
+    if name == "file":
+        return FileExporter(app.config["TRACING_FILE"])
+    return None
+
+
+def init_tracing(app):
+    """Traces the app's requests and SQL statements when an exporter is configured
+
+    The hooks are always installed and return at once while tracing is off.
+    """
+    exporter = build_exporter(app)
+    if exporter is None:
+        tracer.processor = None
+    else:
+        tracer.processor = BatchProcessor(exporter, {"service.name": app.config["TRACING_SERVICE_NAME"]},
+                                          max_queue_size=app.config["TRACING_MAX_QUEUE_SIZE"])
+        atexit.register(tracer.flush)
+    statement_timing.add_callbacks(_trace_statement, _trace_failed_statement)
+    if "tracing" not in app.extensions:
+        app.extensions["tracing"] = tracer
+        app.before_request(_start_request_span)
+        app.after_request(_record_status)
+        app.teardown_request(_end_request_span)
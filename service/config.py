@@ -15,6 +15,174 @@ SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 # SQLALCHEMY_POOL_SIZE = 2
 
+# psycopg turns a query into a server-side prepared statement once it has
+# run this many times on a connection. Set it to "none" when connecting
+# through a transaction pooling PgBouncer, which cannot keep them.
+DB_PREPARE_THRESHOLD = os.getenv("DB_PREPARE_THRESHOLD", "1")
+SQLALCHEMY_ENGINE_OPTIONS = {}
+if DATABASE_URI.startswith("postgresql+psycopg"):
+    SQLALCHEMY_ENGINE_OPTIONS["connect_args"] = {
+        "prepare_threshold": None if DB_PREPARE_THRESHOLD.lower() == "none" else int(DB_PREPARE_THRESHOLD)
+    }
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
+
+# Swagger UI at /apidocs and the spec at /api/swagger.json. Workers that
+# never serve the docs can turn them off to skip registering them.
+API_DOCS_ENABLED = os.getenv("API_DOCS_ENABLED", "true").lower() == "true"
+# Optional prebuilt spec (see "flask openapi-spec") served instead of
+# building it from the api models on the first request
+OPENAPI_SPEC_FILE = os.getenv("OPENAPI_SPEC_FILE")
+
+# Encode cart and item responses with precompiled encoders (and orjson when
+# installed) instead of flask-restx marshal_with()
+FAST_JSON_ENABLED = os.getenv("FAST_JSON_ENABLED", "true").lower() == "true"
+
+# Prometheus metrics at /metrics. Under gunicorn set PROMETHEUS_MULTIPROC_DIR
+# to a directory shared by the workers so /metrics reports all of them;
+# each worker writes its snapshot there at most every METRICS_FLUSH_SECONDS.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+
+# Count and time the queries of each request and warn when one statement
+# runs more than QUERY_REPEAT_THRESHOLD times (an N+1 pattern). The totals
+# are sent as Server-Timing and X-Query-Count headers in debug and testing
+# mode, or everywhere when QUERY_STATS_HEADERS is true.
+QUERY_STATS_ENABLED = os.getenv("QUERY_STATS_ENABLED", "true").lower() == "true"
+QUERY_STATS_HEADERS = os.getenv("QUERY_STATS_HEADERS", "false").lower() == "true"
+QUERY_REPEAT_THRESHOLD = int(os.getenv("QUERY_REPEAT_THRESHOLD", "5"))
+
+# Log statements slower than SLOW_QUERY_SECONDS, at most SLOW_QUERY_LOG_LIMIT
+# a minute. SLOW_QUERY_EXPLAIN adds the plan of slow statements issued from
+# service/models, at most once per SLOW_QUERY_EXPLAIN_INTERVAL seconds each,
+# from a background thread that gives up after SLOW_QUERY_EXPLAIN_TIMEOUT.
+SLOW_QUERY_LOG_ENABLED = os.getenv("SLOW_QUERY_LOG_ENABLED", "true").lower() == "true"
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "0.5"))
+SLOW_QUERY_LOG_LIMIT = int(os.getenv("SLOW_QUERY_LOG_LIMIT", "10"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() == "true"
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", "300"))
+SLOW_QUERY_EXPLAIN_TIMEOUT = float(os.getenv("SLOW_QUERY_EXPLAIN_TIMEOUT", "5"))
+
+# Profile a request when it sends "X-Profile: <PROFILE_TOKEN>", or a random
+# PROFILE_SAMPLE_RATE fraction of all requests. Profiles are written to
+# PROFILE_DIR as pstats or speedscope files.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/shopcarts-profiles")
+PROFILE_FORMAT = os.getenv("PROFILE_FORMAT", "pstats")
+
+# Bearer token for the /admin endpoints, which are disabled when it is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Each worker keeps only its newest MEMORY_MAX_SNAPSHOTS tracemalloc snapshots
+MEMORY_MAX_SNAPSHOTS = int(os.getenv("MEMORY_MAX_SNAPSHOTS", "10"))
+
+# Logs are written by a background QueueListener unless LOG_ASYNC is false.
+# LOG_FORMAT=json writes one JSON object per line. LOG_SAMPLE_RATES keeps the
+# INFO messages of only a fraction of the requests to busy resources, e.g.
+# "ShopcartCollection=0.1,ItemCollection=0.1"
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_SAMPLE_RATES = {
+    name.strip(): float(rate)
+    for name, _, rate in (entry.partition("=") for entry in os.getenv("LOG_SAMPLE_RATES", "").split(","))
+    if name.strip()
+}
+
+# Tracing: "otlp" posts spans to an OTLP/HTTP collector, "file" appends them
+# to TRACING_FILE as JSON lines, "none" turns tracing off
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none").lower()
+TRACING_OTLP_ENDPOINT = os.getenv("TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACING_FILE = os.getenv("TRACING_FILE", "/tmp/shopcarts-traces.jsonl")
+TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "shopcarts")
+# Most spans waiting for export; the oldest are dropped past it
+TRACING_MAX_QUEUE_SIZE = int(os.getenv("TRACING_MAX_QUEUE_SIZE", "2048"))
+
+# /readyz fails when the pool is this full, or when SELECT 1 takes longer
+# than READINESS_MAX_DB_SECONDS. The database is checked at most once every
+# READINESS_CACHE_SECONDS no matter how often the probe is called.
+READINESS_MAX_POOL_SATURATION = float(os.getenv("READINESS_MAX_POOL_SATURATION", "0.9"))
+READINESS_MAX_DB_SECONDS = float(os.getenv("READINESS_MAX_DB_SECONDS", "1.0"))
+READINESS_CACHE_SECONDS = float(os.getenv("READINESS_CACHE_SECONDS", "2.0"))
+
+# Admission control: a worker handles at most ADMISSION_MAX_IN_FLIGHT
+# requests at once, of which at most ADMISSION_MAX_READS are GET/HEAD/OPTIONS
+# and ADMISSION_MAX_WRITES are anything else (0 means no limit). Requests over
+# a limit get 503 with "Retry-After: ADMISSION_RETRY_AFTER" straight away.
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32"))
+ADMISSION_MAX_READS = int(os.getenv("ADMISSION_MAX_READS", "24"))
+ADMISSION_MAX_WRITES = int(os.getenv("ADMISSION_MAX_WRITES", "8"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+ADMISSION_EXEMPT_PATHS = tuple(
+    path.strip() for path in os.getenv("ADMISSION_EXEMPT_PATHS", "/livez,/readyz,/health,/metrics").split(",")
+    if path.strip()
+)
+
+# Token bucket rate limits per client, as "<limit>/<period>" with a period of
+# second, minute, hour, day or a number of seconds. RATE_LIMITS sets them per
+# flask-restx Resource, e.g. "ShopcartCollection=60/minute,ItemCollection=120/minute",
+# and RATE_LIMIT_DEFAULT covers every other endpoint. Buckets are kept in
+# "memory" (per worker) or in the "database" (shared by all workers and pods).
+# Clients are told apart by RATE_LIMIT_CLIENT_HEADER when a trusted gateway
+# sets it, else by their address, skipping RATE_LIMIT_PROXY_COUNT proxies.
+# RATE_LIMIT_EXEMPT_PATHS (the probes by default) are never limited.
+RATE_LIMITS = {
+    name.strip(): limit.strip()
+    for name, _, limit in (entry.partition("=") for entry in os.getenv("RATE_LIMITS", "").split(","))
+    if name.strip()
+}
+RATE_LIMIT_DEFAULT = os.getenv("RATE_LIMIT_DEFAULT", "")
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory").lower()
+RATE_LIMIT_CLIENT_HEADER = os.getenv("RATE_LIMIT_CLIENT_HEADER")
+RATE_LIMIT_PROXY_COUNT = int(os.getenv("RATE_LIMIT_PROXY_COUNT", "0"))
+RATE_LIMIT_EXEMPT_PATHS = tuple(
+    path.strip() for path in os.getenv("RATE_LIMIT_EXEMPT_PATHS", ",".join(ADMISSION_EXEMPT_PATHS)).split(",")
+    if path.strip()
+)
+
+# Carts that have not been updated for CART_TTL_DAYS are archived and deleted
+# by "flask purge-carts", PURGE_BATCH_SIZE carts per transaction.
+CART_TTL_DAYS = float(os.getenv("CART_TTL_DAYS", "30"))
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "500"))
+
+# Writes append events to the outbox_event table. "flask dispatch-events"
+# publishes them to the change feed at /api/events EVENTS_BATCH_SIZE at a
+# time and deletes them EVENTS_RETENTION_DAYS after. A feed request waits
+# up to EVENTS_MAX_WAIT seconds for new events, reading the feed every
+# EVENTS_POLL_INTERVAL; past EVENTS_MAX_WAITERS waiting requests per
+# worker the others answer at once so they do not tie up every thread.
+EVENTS_BATCH_SIZE = int(os.getenv("EVENTS_BATCH_SIZE", "500"))
+EVENTS_RETENTION_DAYS = float(os.getenv("EVENTS_RETENTION_DAYS", "7"))
+EVENTS_MAX_WAIT = float(os.getenv("EVENTS_MAX_WAIT", "25"))
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "0.5"))
+EVENTS_MAX_WAITERS = int(os.getenv("EVENTS_MAX_WAITERS", "8"))
+
+# GET /api/shopcarts/<id>/stream pushes a cart's events as Server-Sent
+# Events. While any stream is open one thread per worker reads the change
+# feed every EVENTS_POLL_INTERVAL and fans the events out. A worker serves
+# at most STREAM_MAX_SUBSCRIBERS streams, queues at most STREAM_BUFFER
+# events for a slow client before disconnecting it, and sends a comment
+# after STREAM_HEARTBEAT_SECONDS of quiet so proxies keep idle streams open.
+# Every stream holds a worker thread for as long as it is open, and the
+# worker gets a thread for each of them (see WORKER_THREADS below).
+STREAM_MAX_SUBSCRIBERS = int(os.getenv("STREAM_MAX_SUBSCRIBERS", "16"))
+STREAM_BUFFER = int(os.getenv("STREAM_BUFFER", "100"))
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+
+# gunicorn.conf.py runs threaded workers with WORKER_THREADS threads: one for
+# every admitted request and every stream, plus WORKER_SPARE_THREADS that
+# answer the shed requests and the probes at once. An admitted request uses
+# at most one database connection, so the pool keeps DB_POOL_SIZE
+# connections and opens up to DB_MAX_OVERFLOW more, enough for
+# ADMISSION_MAX_IN_FLIGHT requests and the event hub's thread. A stream only
+# borrows a connection for a moment when it opens.
+WORKER_SPARE_THREADS = int(os.getenv("WORKER_SPARE_THREADS", "8"))
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", str(
+    ADMISSION_MAX_IN_FLIGHT + STREAM_MAX_SUBSCRIBERS + WORKER_SPARE_THREADS
+)))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", str(max(ADMISSION_MAX_IN_FLIGHT + 1 - DB_POOL_SIZE, 0))))
+if DATABASE_URI.startswith("postgresql"):
+    SQLALCHEMY_ENGINE_OPTIONS.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
@@ -7,3 +7,6 @@ All of the models are stored in this package
 from .persistent_base import db, DataValidationError
 from .shopcart import Shopcart
 from .item import Item
+from .migrations import upgrade, current_version
+from .read_models import ShopcartView, ItemView
+from .outbox import outbox_event
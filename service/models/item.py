@@ -3,6 +3,7 @@ Persistent Base class for database CRUD functions
 """
 
 import logging
+from service.common.tracing import traced_method
 from .persistent_base import db, PersistentBase, DataValidationError
 
 logger = logging.getLogger("flask.app")
@@ -100,6 +101,20 @@ class Item(db.Model, PersistentBase):
     #     return cls.query.filter(cls.id == id)
 
     @classmethod
+    @traced_method
+    def find_in_shopcart(cls, by_id, shopcart_id):
+        """Finds an Item by its ID only if it belongs to the Shopcart
+
+        Args:
+            by_id (integer): the id of the Item
+            shopcart_id (integer): the id of the Shopcart it must be in
+        """
+        logger.info("Processing lookup for id %s in shopcart %s ...", by_id, shopcart_id)
+        statement = cls._select_by("id", "shopcart_id")
+        return db.session.scalars(statement, {"id": by_id, "shopcart_id": shopcart_id}).first()
+
+    @classmethod
+    @traced_method
     def find_by_price(cls, price):
         """Returns all items with the given price
 
@@ -107,9 +122,10 @@ class Item(db.Model, PersistentBase):
             price (integer): the name of the Accounts you want to match
         """
         logger.info("Processing price query for %s ...", price)
-        return cls.query.filter(cls.price == price)
+        return cls._find_by(price=price)
 
     @classmethod
+    @traced_method
     def find_by_item_id(cls, item_id):
         """Returns all items with the given item_id
 
@@ -117,9 +133,10 @@ class Item(db.Model, PersistentBase):
             item_id (String): the name of the Accounts you want to match
         """
         logger.info("Processing id query for %s ...", item_id)
-        return cls.query.filter(cls.item_id == item_id)
+        return cls._find_by(item_id=item_id)
 
     @classmethod
+    @traced_method
     def find_by_quantity(cls, quantity):
         """Returns all items with the given quantity
 
@@ -127,4 +144,4 @@ class Item(db.Model, PersistentBase):
             quantity (integer): the name of the Accounts you want to match
         """
         logger.info("Processing id query for %s ...", quantity)
-        return cls.query.filter(cls.quantity == quantity)
+        return cls._find_by(quantity=quantity)
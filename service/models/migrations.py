@@ -0,0 +1,246 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Versioned schema migrations
+
+Every change to the database schema is a numbered migration that is applied
+exactly once and recorded in the ``schema_version`` table. Migrations are run
+with ``flask db-upgrade`` before the service starts so that the application
+itself never has to issue DDL when it boots.
+
+To change the schema append a new entry to ``MIGRATIONS`` with the next
+version number. Never edit a migration that has already been released.
+
+The migrations are written for PostgreSQL. Other databases (SQLite in the
+tests) get the schema from the models and are recorded at the latest version.
+"""
+
+import logging
+from sqlalchemy import text
+from .persistent_base import db
+
+logger = logging.getLogger("flask.app")
+
+# Arbitrary key for pg_advisory_xact_lock so concurrent upgrades serialize
+MIGRATION_LOCK_ID = 20_241_026
+
+schema_version = db.Table(
+    "schema_version",
+    db.Column("version", db.Integer, primary_key=True, autoincrement=False),
+    db.Column("description", db.String(128), nullable=False),
+    db.Column(
+        "applied_at", db.DateTime, nullable=False, server_default=db.func.now()
+    ),
+)
+
+######################################################################
+#  M I G R A T I O N S
+#  (version, description, [DDL statements])
+######################################################################
+MIGRATIONS = [
+    (
+        1,
+        "Create shopcart and item tables",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS shopcart (
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(64) NOT NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS item (
+                id SERIAL PRIMARY KEY,
+                shopcart_id INTEGER NOT NULL
+                    REFERENCES shopcart (id) ON DELETE CASCADE,
+                item_id VARCHAR(16) NOT NULL,
+                description VARCHAR(64) NOT NULL,
+                quantity INTEGER NOT NULL,
+                price INTEGER NOT NULL
+            )
+            """,
+        ],
+    ),
+    (
+        2,
+        "Create rate_limit_bucket table",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS rate_limit_bucket (
+                key VARCHAR(255) PRIMARY KEY,
+                tokens DOUBLE PRECISION NOT NULL,
+                updated_at DOUBLE PRECISION NOT NULL,
+                allowed BOOLEAN NOT NULL
+            )
+            """,
+        ],
+    ),
+    (
+        3,
+        "Add cart timestamps and the shopcart_archive table",
+        [
+            # now() is stable, so existing rows get the migration time without a table rewrite
+            "ALTER TABLE shopcart ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+            "ALTER TABLE shopcart ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+            "CREATE INDEX IF NOT EXISTS ix_shopcart_updated_at ON shopcart (updated_at)",
+            """
+            CREATE TABLE IF NOT EXISTS shopcart_archive (
+                id INTEGER PRIMARY KEY,
+                name VARCHAR(64) NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL,
+                archived_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                items JSONB NOT NULL
+            )
+            """,
+            # adding, changing or removing items counts as activity on the cart;
+            # statement triggers touch each cart once however many items change
+            """
+            CREATE OR REPLACE FUNCTION shopcart_touch() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                UPDATE shopcart SET updated_at = now()
+                WHERE id IN (SELECT shopcart_id FROM changed_items) AND updated_at < now();
+                RETURN NULL;
+            END
+            $$
+            """,
+            "DROP TRIGGER IF EXISTS item_insert_touch ON item",
+            "DROP TRIGGER IF EXISTS item_update_touch ON item",
+            "DROP TRIGGER IF EXISTS item_delete_touch ON item",
+            """
+            CREATE TRIGGER item_insert_touch AFTER INSERT ON item
+            REFERENCING NEW TABLE AS changed_items FOR EACH STATEMENT EXECUTE FUNCTION shopcart_touch()
+            """,
+            """
+            CREATE TRIGGER item_update_touch AFTER UPDATE ON item
+            REFERENCING NEW TABLE AS changed_items FOR EACH STATEMENT EXECUTE FUNCTION shopcart_touch()
+            """,
+            """
+            CREATE TRIGGER item_delete_touch AFTER DELETE ON item
+            REFERENCING OLD TABLE AS changed_items FOR EACH STATEMENT EXECUTE FUNCTION shopcart_touch()
+            """,
+        ],
+    ),
+    (
+        4,
+        "Create outbox_event table",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS outbox_event (
+                id BIGSERIAL PRIMARY KEY,
+                event_type VARCHAR(32) NOT NULL,
+                shopcart_id INTEGER NOT NULL,
+                payload JSONB NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                position BIGINT UNIQUE,
+                dispatched_at TIMESTAMPTZ
+            )
+            """,
+            # the dispatcher only ever looks for the events it has not numbered yet
+            "CREATE INDEX IF NOT EXISTS ix_outbox_event_pending ON outbox_event (id) WHERE position IS NULL",
+        ],
+    ),
+    (
+        5,
+        "Skip cart touches while purging",
+        [
+            # the purge deletes the carts right after their items, so touching them
+            # would only leave a dead row and index entry behind for each one
+            """
+            CREATE OR REPLACE FUNCTION shopcart_touch() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                IF current_setting('shopcarts.purging', true) = 'on' THEN
+                    RETURN NULL;
+                END IF;
+                UPDATE shopcart SET updated_at = now()
+                WHERE id IN (SELECT shopcart_id FROM changed_items) AND updated_at < now();
+                RETURN NULL;
+            END
+            $$
+            """,
+        ],
+    ),
+]
+
+
+def head() -> int:
+    """Returns the latest migration version known to this code"""
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(connection=None) -> int:
+    """Returns the version the database has been migrated to
+
+    Args:
+        connection: an optional open connection to use for the lookup
+    """
+    if connection is None:
+        with db.engine.connect() as conn:
+            return current_version(conn)
+    if not db.inspect(connection).has_table(schema_version.name):
+        return 0
+    version = connection.execute(db.select(db.func.max(schema_version.c.version))).scalar()
+    return version or 0
+
+
+def _create_from_models(conn, target: int) -> list:
+    """Builds the schema of a non-PostgreSQL database from the models"""
+    applied = [version for version, _, _ in MIGRATIONS if current_version(conn) < version <= target]
+    if applied:
+        db.metadata.create_all(conn)
+        conn.execute(
+            schema_version.insert(),
+            [{"version": version, "description": description}
+             for version, description, _ in MIGRATIONS if version in applied],
+        )
+    return applied
+
+
+def upgrade(target: int = None) -> list:
+    """Applies all pending migrations up to target (default: the latest)
+
+    Each migration runs in its own transaction together with the row that
+    records it, so a failed migration leaves the database at the previous
+    version.
+
+    Returns:
+        list: the versions that were applied
+    """
+    target = head() if target is None else target
+    with db.engine.begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+        if conn.dialect.name != "postgresql":
+            return _create_from_models(conn, target)
+
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version > target:
+            break
+        with db.engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_ID})
+            # re-check under the lock in case another process got here first
+            if current_version(conn) >= version:
+                continue
+            logger.info("Applying migration %d: %s", version, description)
+            for statement in statements:
+                conn.execute(text(statement))
+            conn.execute(schema_version.insert().values(version=version, description=description))
+        applied.append(version)
+
+    logger.info("Database schema is at version %d", current_version())
+    return applied
@@ -0,0 +1,87 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Transactional outbox for cart events
+
+Every write made through PersistentBase (create, update, delete, and
+so the clear action too) appends one compact row per changed cart or
+item to the outbox_event table. Session hooks insert the rows when the
+changes are flushed, in the same transaction, so an event is recorded
+if and only if its change is committed.
+
+The rows start without a position. "flask dispatch-events" numbers them
+in the order it finds them committed, which is the order of the change
+feed at /api/events.
+"""
+
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from .persistent_base import db
+
+outbox_event = db.Table(
+    "outbox_event",
+    db.Column("id", db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True),
+    db.Column("event_type", db.String(32), nullable=False),
+    db.Column("shopcart_id", db.Integer, nullable=False),
+    db.Column("payload", db.JSON().with_variant(postgresql.JSONB(), "postgresql"), nullable=False),
+    db.Column("created_at", db.DateTime(timezone=True), nullable=False, server_default=db.func.now()),
+    # set by the dispatcher, unique and gapless in dispatch order
+    db.Column("position", db.BigInteger, unique=True),
+    db.Column("dispatched_at", db.DateTime(timezone=True)),
+    db.Index(
+        "ix_outbox_event_pending", "id",
+        postgresql_where=db.text("position IS NULL"), sqlite_where=db.text("position IS NULL"),
+    ),
+)
+
+
+def _event(record, action: str) -> dict:
+    payload = record.event_payload()
+    return {
+        "event_type": f"{record.__tablename__}.{action}",
+        # item payloads name their cart, a cart's payload is the cart
+        "shopcart_id": payload.get("shopcart_id", payload["id"]),
+        "payload": payload,
+    }
+
+
+@event.listens_for(Session, "before_flush")
+def _collect_changes(session, flush_context, instances):  # pylint: disable=unused-argument
+    """Notes the carts and items a flush is about to write"""
+    # session.new, dirty and deleted build a new set on every access, so each is read once
+    new, dirty, removed = session.new, session.dirty, session.deleted
+    # carts first, so a cart's events come before those of its items
+    created = sorted(
+        (record for record in new if hasattr(record, "event_payload")), key=lambda r: r.__tablename__ != "shopcart"
+    )
+    updated = [
+        record for record in dirty
+        if hasattr(record, "event_payload") and session.is_modified(record, include_collections=False)
+    ]
+    # deleted records cannot be read any more once the flush has run
+    deleted = [_event(record, "deleted") for record in removed if hasattr(record, "event_payload")]
+    session.info["outbox"] = (created, updated, deleted)
+
+
+@event.listens_for(Session, "after_flush")
+def _append_events(session, flush_context):  # pylint: disable=unused-argument
+    """Inserts the events of the flushed changes with one statement in the same transaction"""
+    created, updated, deleted = session.info.pop("outbox", ((), (), ()))
+    events = [_event(record, "created") for record in created] + [_event(record, "updated") for record in updated]
+    if events or deleted:
+        session.connection().execute(outbox_event.insert().inline(), events + deleted)
@@ -21,11 +21,16 @@ Persistent Base class for database CRUD functions
 import logging
 from abc import abstractmethod
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+from service.common.tracing import traced_method
 
 logger = logging.getLogger("flask.app")
 
 db = SQLAlchemy()
 
+# Statements built by PersistentBase._select_by(), keyed on (class, columns)
+_statement_cache = {}
+
 
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
@@ -40,6 +45,11 @@ class PersistentBase:
     def __init__(self):
         self.id = None  # pylint: disable=invalid-name
 
+    def _log_id(self):
+        """Returns the primary key for log messages without loading any attributes"""
+        identity = inspect(self).identity
+        return identity[0] if identity else None
+
     @abstractmethod
     def serialize(self) -> dict:
         """Convert an object into a dictionary"""
@@ -48,11 +58,16 @@ class PersistentBase:
     def deserialize(self, data: dict) -> None:
         """Convert a dictionary into an object"""
 
+    def event_payload(self) -> dict:
+        """Returns the data of the outbox event recorded when this record changes"""
+        return self.serialize()
+
+    @traced_method
     def create(self) -> None:
         """
         Creates a Account to the database
         """
-        logger.info("Creating %s", self)
+        logger.info("Creating %s", type(self).__name__)
         # id must be none to generate next primary key
         self.id = None
         try:
@@ -60,42 +75,66 @@ class PersistentBase:
             db.session.commit()
         except Exception as e:
             db.session.rollback()
-            logger.error("Error creating record: %s", self)
+            logger.error("Error creating %s record", type(self).__name__)
             raise DataValidationError(e) from e
 
+    @traced_method
     def update(self) -> None:
         """
         Updates a Account to the database
         """
-        logger.info("Updating %s", self)
+        logger.info("Updating %s id=%s", type(self).__name__, self._log_id())
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
         try:
             db.session.commit()
         except Exception as e:
             db.session.rollback()
-            logger.error("Error updating record: %s", self)
+            logger.error("Error updating %s record id=%s", type(self).__name__, self._log_id())
             raise DataValidationError(e) from e
 
+    @traced_method
     def delete(self) -> None:
         """Removes a Account from the data store"""
-        logger.info("Deleting %s", self)
+        logger.info("Deleting %s id=%s", type(self).__name__, self._log_id())
         try:
             db.session.delete(self)
             db.session.commit()
         except Exception as e:
             db.session.rollback()
-            logger.error("Error deleting record: %s", self)
+            logger.error("Error deleting %s record id=%s", type(self).__name__, self._log_id())
             raise DataValidationError(e) from e
 
     @classmethod
+    def _select_by(cls, *columns):
+        """Returns a select of the class filtered on columns
+
+        The statement uses bind parameters named after the columns and is
+        built once per process, so SQLAlchemy only has to look up its
+        compiled form on each call instead of constructing a new query.
+        """
+        key = (cls, columns)
+        statement = _statement_cache.get(key)
+        if statement is None:
+            statement = db.select(cls).where(*[getattr(cls, column) == db.bindparam(column) for column in columns])
+            _statement_cache[key] = statement
+        return statement
+
+    @classmethod
+    def _find_by(cls, **criteria) -> list:
+        """Returns all of the records matching every column=value in criteria"""
+        statement = cls._select_by(*sorted(criteria))
+        return db.session.scalars(statement, criteria).all()
+
+    @classmethod
+    @traced_method
     def all(cls):
         """Returns all of the records in the database"""
         logger.info("Processing all records")
-        # pylint: disable=no-member
-        return cls.query.all()
+        return cls._find_by()
 
     @classmethod
+    @traced_method
     def find(cls, by_id):
         """Finds a record by it's ID"""
         logger.info("Processing lookup for id %s ...", by_id)
@@ -0,0 +1,206 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Read models for Shopcarts and Items
+
+The GET routes only need to turn rows into JSON, so instead of hydrating
+full ORM objects (identity map, change tracking, lazy loading) these
+classes select the columns with SQLAlchemy Core and keep them in compact
+read-only objects. Use the ORM models in shopcart.py and item.py for
+anything that writes.
+"""
+
+import logging
+from service.common.tracing import traced_method
+from .persistent_base import db
+from .shopcart import Shopcart
+from .item import Item
+
+logger = logging.getLogger("flask.app")
+
+
+######################################################################
+#  S T A T E M E N T S
+#  Built once at import and run with bind parameters so each request
+#  only pays for a lookup in SQLAlchemy's compiled statement cache
+######################################################################
+ITEM_FIELDS = ("id", "shopcart_id", "item_id", "description", "quantity", "price")
+
+_items = Item.__table__
+_shopcarts = Shopcart.__table__
+
+_SELECT_ITEMS = db.select(*[_items.c[name] for name in ITEM_FIELDS]).order_by(_items.c.id)
+_SELECT_ITEMS_BY = {
+    column: _SELECT_ITEMS.where(_items.c[column] == db.bindparam(column))
+    for column in ("id", "item_id", "quantity", "price")
+}
+_SELECT_ITEMS_IN_SHOPCARTS = _SELECT_ITEMS.where(
+    _items.c.shopcart_id.in_(db.bindparam("shopcart_ids", expanding=True))
+)
+
+_SELECT_SHOPCARTS = db.select(_shopcarts.c.id, _shopcarts.c.name).order_by(_shopcarts.c.id)
+_SELECT_SHOPCARTS_BY = {
+    column: _SELECT_SHOPCARTS.where(_shopcarts.c[column] == db.bindparam(column)) for column in ("id", "name")
+}
+_SHOPCART_EXISTS = db.select(_shopcarts.c.id).where(_shopcarts.c.id == db.bindparam("id"))
+
+
+######################################################################
+#  I T E M   V I E W
+######################################################################
+class ItemView:
+    """Read-only Item built straight from a database row
+
+    This is a plain __slots__ class rather than a tuple because flask-restx
+    marshals tuples as lists.
+    """
+
+    __slots__ = ITEM_FIELDS
+
+    def __init__(self, row):
+        # pylint: disable=invalid-name
+        self.id, self.shopcart_id, self.item_id, self.description, self.quantity, self.price = row
+
+    def __repr__(self):
+        return f"<ItemView {self.item_id} id=[{self.id}] shopcart[{self.shopcart_id}]>"
+
+    def serialize(self) -> dict:
+        """Converts an ItemView into a dictionary"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def _fetch(cls, statement, params=None) -> list:
+        """Runs statement and maps every row into an ItemView"""
+        return [cls(row) for row in db.session.execute(statement, params)]
+
+    @classmethod
+    @traced_method
+    def all(cls) -> list:
+        """Returns all of the Items in the database"""
+        logger.info("Processing all item views")
+        return cls._fetch(_SELECT_ITEMS)
+
+    @classmethod
+    @traced_method
+    def find(cls, by_id):
+        """Finds an Item by its ID"""
+        logger.info("Processing item view lookup for id %s ...", by_id)
+        row = db.session.execute(_SELECT_ITEMS_BY["id"], {"id": by_id}).first()
+        return cls(row) if row else None
+
+    @classmethod
+    @traced_method
+    def find_by_item_id(cls, item_id) -> list:
+        """Returns all Items with the given item_id"""
+        logger.info("Processing item view query for item_id %s ...", item_id)
+        return cls._fetch(_SELECT_ITEMS_BY["item_id"], {"item_id": item_id})
+
+    @classmethod
+    @traced_method
+    def find_by_quantity(cls, quantity) -> list:
+        """Returns all Items with the given quantity"""
+        logger.info("Processing item view query for quantity %s ...", quantity)
+        return cls._fetch(_SELECT_ITEMS_BY["quantity"], {"quantity": quantity})
+
+    @classmethod
+    @traced_method
+    def find_by_price(cls, price) -> list:
+        """Returns all Items with the given price"""
+        logger.info("Processing item view query for price %s ...", price)
+        return cls._fetch(_SELECT_ITEMS_BY["price"], {"price": price})
+
+
+######################################################################
+#  S H O P C A R T   V I E W
+######################################################################
+class ShopcartView:
+    """Read-only Shopcart with its items, built straight from database rows"""
+
+    __slots__ = ("id", "name", "items")
+
+    def __init__(self, shopcart_id: int, name: str, items: list = None):
+        self.id = shopcart_id  # pylint: disable=invalid-name
+        self.name = name
+        self.items = items if items is not None else []
+
+    def __repr__(self):
+        return f"<ShopcartView {self.name} id=[{self.id}] items={len(self.items)}>"
+
+    def serialize(self) -> dict:
+        """Converts a ShopcartView into a dictionary"""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "items": [item.serialize() for item in self.items],
+        }
+
+    @property
+    def total_price(self) -> int:
+        """Total price of all of the items in the Shopcart"""
+        return sum(item.quantity * item.price for item in self.items)
+
+    @classmethod
+    def _fetch(cls, column=None, value=None) -> list:
+        """Loads the Shopcarts where column == value (or all) with their items
+
+        Items are loaded with one extra query for all carts instead of one
+        lazy load per cart.
+        """
+        if column is None:
+            rows = db.session.execute(_SELECT_SHOPCARTS)
+        else:
+            rows = db.session.execute(_SELECT_SHOPCARTS_BY[column], {column: value})
+        shopcarts = {row.id: cls(row.id, row.name) for row in rows}
+        if not shopcarts:
+            return []
+
+        if column is None:
+            items = ItemView._fetch(_SELECT_ITEMS)
+        else:
+            items = ItemView._fetch(_SELECT_ITEMS_IN_SHOPCARTS, {"shopcart_ids": list(shopcarts)})
+        for item in items:
+            shopcart = shopcarts.get(item.shopcart_id)
+            if shopcart is not None:
+                shopcart.items.append(item)
+        return list(shopcarts.values())
+
+    @classmethod
+    @traced_method
+    def all(cls) -> list:
+        """Returns all of the Shopcarts in the database"""
+        logger.info("Processing all shopcart views")
+        return cls._fetch()
+
+    @classmethod
+    @traced_method
+    def find(cls, by_id):
+        """Finds a Shopcart by its ID"""
+        logger.info("Processing shopcart view lookup for id %s ...", by_id)
+        shopcarts = cls._fetch("id", by_id)
+        return shopcarts[0] if shopcarts else None
+
+    @classmethod
+    @traced_method
+    def find_by_name(cls, name) -> list:
+        """Returns all of the Shopcarts with the given name"""
+        logger.info("Processing shopcart view query for %s ...", name)
+        return cls._fetch("name", name)
+
+    @staticmethod
+    def exists(by_id) -> bool:
+        """Returns True if a Shopcart with the ID exists"""
+        return db.session.execute(_SHOPCART_EXISTS, {"id": by_id}).first() is not None
@@ -3,6 +3,7 @@ Persistent Base class for database CRUD functions
 """
 
 import logging
+from service.common.tracing import traced_method
 from .persistent_base import db, PersistentBase, DataValidationError
 from .item import Item
 
@@ -21,6 +22,11 @@ class Shopcart(db.Model, PersistentBase):
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    # also touched by a database trigger whenever the cart's items change
+    updated_at = db.Column(
+        db.DateTime(timezone=True), nullable=False, server_default=db.func.now(), onupdate=db.func.now(), index=True
+    )
     items = db.relationship("Item", backref="shopcart", passive_deletes=True)
 
     def __repr__(self):
@@ -37,6 +43,10 @@ class Shopcart(db.Model, PersistentBase):
             shopcart["items"].append(item.serialize())
         return shopcart
 
+    def event_payload(self):
+        """Leaves the items out of a cart's events, they have events of their own"""
+        return {"id": self.id, "name": self.name}
+
     def deserialize(self, data):
         """
         Populates an Shopcart from a dictionary
@@ -70,6 +80,7 @@ class Shopcart(db.Model, PersistentBase):
         return self
 
     @classmethod
+    @traced_method
     def find_by_name(cls, name):
         """Returns the unique Shopcart with the given name
 
@@ -77,7 +88,7 @@ class Shopcart(db.Model, PersistentBase):
             name (string): the name of the Accounts you want to match
         """
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        return cls._find_by(name=name)
 
     @classmethod
     def calculate_selected_items_price(
@@ -100,6 +111,7 @@ class Shopcart(db.Model, PersistentBase):
         return total_price
 
     @classmethod
+    @traced_method
     def calculate_total_price(cls, shopcart_id: int):
         """_summary_
 
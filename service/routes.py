@@ -21,13 +21,21 @@ This service implements a REST API that allows you to Create, Read, Update
 and Delete YourResourceModel
 """
 
-from flask import request
+import threading
+from flask import Response, request
 from flask import current_app as app  # Import Flask application
 from flask_restx import Resource, fields, reqparse
-from service.models import Shopcart, Item
+from service.models import db, Shopcart, Item, ShopcartView, ItemView
 from service.common import status  # HTTP Status Codes
+from service.common import change_feed, health
+from service.common.event_hub import EventHub
+from service.common.fast_json import marshal_with
+from service.common.metrics import render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 from . import api  # pylint: disable=cyclic-import
 
+# Request bodies are logged at DEBUG and cut off after this many characters
+PAYLOAD_LOG_LIMIT = 500
+
 
 ######################################################################
 # GET HEALTH CHECK
@@ -38,6 +46,35 @@ def health_check():
     return {"status": 200, "message": "Healthy"}, 200
 
 
+######################################################################
+# GET LIVENESS AND READINESS
+######################################################################
+@app.route("/livez")
+def liveness_check():
+    """The worker is running and able to answer requests"""
+    return {"status": "alive"}, status.HTTP_200_OK
+
+
+@app.route("/readyz")
+def readiness_check():
+    """The worker can reach the database and has free pooled connections"""
+    ready, report = health.readiness(app.config)
+    report["status"] = "ready" if ready else "not ready"
+    if not ready:
+        app.logger.warning("Not ready: %s", report["reason"])
+        return report, status.HTTP_503_SERVICE_UNAVAILABLE
+    return report, status.HTTP_200_OK
+
+
+######################################################################
+# GET METRICS
+######################################################################
+@app.route("/metrics")
+def metrics():
+    """Returns the service metrics in the Prometheus text format"""
+    return render_metrics(), 200, {"Content-Type": METRICS_CONTENT_TYPE}
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -126,6 +163,39 @@ item_args.add_argument(
     help="Price the Item",
 )
 
+event_args = reqparse.RequestParser()
+event_args.add_argument(
+    "after",
+    type=int,
+    location="args",
+    default=0,
+    help="Return the events after this position",
+)
+event_args.add_argument(
+    "limit",
+    type=int,
+    location="args",
+    default=100,
+    help="Most events to return (1-1000)",
+)
+event_args.add_argument(
+    "wait",
+    type=float,
+    location="args",
+    default=0,
+    help="Seconds to wait for new events when there are none",
+)
+
+# Requests of this worker that may be waiting for events at once
+_feed_waiters = threading.BoundedSemaphore(app.config["EVENTS_MAX_WAITERS"])
+# Fans the change feed out to the event streams of this worker
+_event_hub = EventHub(
+    db.engine,
+    poll_interval=app.config["EVENTS_POLL_INTERVAL"],
+    max_subscribers=app.config["STREAM_MAX_SUBSCRIBERS"],
+    buffer=app.config["STREAM_BUFFER"],
+)
+
 ######################################################################
 #  PATH: /shopcarts/{id}
 ######################################################################
@@ -148,7 +218,7 @@ class ShopcartResource(Resource):
     # ------------------------------------------------------------------
     @api.doc("get_shopcarts")
     @api.response(404, "Shopcart not found")
-    @api.marshal_with(shopcart_model)
+    @marshal_with(api, shopcart_model)
     def get(self, shopcart_id):
         """
         Retrieve a single Shopcart
@@ -157,7 +227,7 @@ class ShopcartResource(Resource):
         """
 
         app.logger.info("Request to Retrieve a shopcart with id: %s", shopcart_id)
-        shopcart = Shopcart.find(shopcart_id)
+        shopcart = ShopcartView.find(shopcart_id)
         if not shopcart:
             abort(
                 status.HTTP_404_NOT_FOUND,
@@ -165,7 +235,7 @@ class ShopcartResource(Resource):
             )
 
         app.logger.info("Returning shopcart: %s", shopcart.name)
-        return shopcart.serialize(), status.HTTP_200_OK
+        return shopcart, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING SHOPCART
@@ -174,7 +244,7 @@ class ShopcartResource(Resource):
     @api.response(404, "Shopcart not found")
     @api.response(400, "The posted Shopcart data was not valid")
     @api.expect(shopcart_model)
-    @api.marshal_with(shopcart_model)
+    @marshal_with(api, shopcart_model)
     def put(self, shopcart_id):
         """
         Update a Shopcart
@@ -190,13 +260,13 @@ class ShopcartResource(Resource):
                 f"shopcart with id '{shopcart_id}' was not found.",
             )
 
-        app.logger.info("Processing: %s", api.payload)
+        app.logger.debug("Processing: %.*s", PAYLOAD_LOG_LIMIT, api.payload)
 
         shopcart.deserialize(api.payload)
         shopcart.id = shopcart_id
         shopcart.update()
 
-        return shopcart.serialize(), status.HTTP_200_OK
+        return shopcart, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # DELETE A SHOPCART
@@ -231,7 +301,7 @@ class ShopcartCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("list_shopcarts")
     @api.expect(shopcart_args, validate=True)
-    @api.marshal_list_with(shopcart_model)
+    @marshal_with(api, shopcart_model, as_list=True)
     def get(self):
         """Returns all of the Shopcarts"""
 
@@ -242,12 +312,11 @@ class ShopcartCollection(Resource):
 
         if args["name"]:
             app.logger.info("Filtering by name: %s", args["name"])
-            shopcarts = Shopcart.find_by_name(args["name"])
+            shopcarts = ShopcartView.find_by_name(args["name"])
         else:
             app.logger.info("Returning unfiltered list")
-            shopcarts = Shopcart.all()
+            shopcarts = ShopcartView.all()
 
-        shopcarts = [shopcart.serialize() for shopcart in shopcarts]
         app.logger.info("Returning [%d] shopcarts", len(shopcarts))
 
         return shopcarts, status.HTTP_200_OK
@@ -258,7 +327,7 @@ class ShopcartCollection(Resource):
     @api.doc("create_shopcarts")
     @api.response(400, "The posted Shopcart data was not valid")
     @api.expect(create_shopcart_model)
-    @api.marshal_with(shopcart_model, code=201)
+    @marshal_with(api, shopcart_model, code=201)
     def post(self):
         """
         Creates a Shopcart
@@ -267,7 +336,7 @@ class ShopcartCollection(Resource):
         """
 
         app.logger.info("Request to create a Shopcart")
-        app.logger.info("Processing: %s", api.payload)
+        app.logger.debug("Processing: %.*s", PAYLOAD_LOG_LIMIT, api.payload)
 
         shopcart = Shopcart()
         shopcart.deserialize(request.get_json())
@@ -278,7 +347,7 @@ class ShopcartCollection(Resource):
             ShopcartResource, shopcart_id=shopcart.id, _external=True
         )
 
-        return shopcart.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+        return shopcart, status.HTTP_201_CREATED, {"Location": location_url}
 
 
 ######################################################################
@@ -299,7 +368,7 @@ class ClearResource(Resource):
 
         This endpoint will clear a Shopcart based on its id and make it empty
         """
-        app.logger.info(f"Request to clear shopcart : {shopcart_id}")
+        app.logger.info("Request to clear shopcart : %s", shopcart_id)
 
         shopcart = Shopcart.find(shopcart_id)
         if not shopcart:
@@ -314,6 +383,48 @@ class ClearResource(Resource):
         return shopcart.serialize(), status.HTTP_200_OK
 
 
+######################################################################
+#  PATH: /shopcarts/{id}/stream
+######################################################################
+@api.route("/shopcarts/<int:shopcart_id>/stream")
+@api.param("shopcart_id", "The Shopcart identifier")
+class ShopcartStream(Resource):
+    """Live events of a Shopcart as Server-Sent Events"""
+
+    @api.doc("stream_shopcart", produces=["text/event-stream"])
+    @api.response(404, "Shopcart not found")
+    @api.response(503, "Too many streams are open")
+    def get(self, shopcart_id):
+        """
+        Stream the changes of a Shopcart
+
+        This endpoint keeps the connection open and sends an event every time
+        an item of the Shopcart is added, updated or deleted. Clients that
+        reconnect with Last-Event-ID are sent the events they missed.
+        """
+        app.logger.info("Request to stream shopcart %s", shopcart_id)
+        if not ShopcartView.exists(shopcart_id):
+            abort(status.HTTP_404_NOT_FOUND, f"Shopcart with id '{shopcart_id}' was not found.")
+        subscription = _event_hub.subscribe(shopcart_id)
+        if subscription is None:
+            app.logger.warning("Too many streams, refusing shopcart %s", shopcart_id)
+            return {"message": "Too many streams are open, retry later"}, status.HTTP_503_SERVICE_UNAVAILABLE, {
+                "Retry-After": str(app.config["ADMISSION_RETRY_AFTER"])
+            }
+        last_id = request.headers.get("Last-Event-ID", "")
+        events = _event_hub.stream(
+            subscription, int(last_id) if last_id.isdigit() else None, app.config["STREAM_HEARTBEAT_SECONDS"]
+        )
+        response = Response(events, mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            # stops nginx from buffering the stream
+            "X-Accel-Buffering": "no",
+        })
+        # also when the client leaves before the stream has started
+        response.call_on_close(lambda: _event_hub.unsubscribe(subscription))
+        return response
+
+
 ######################################################################
 #  Total Price ACTION => PATH: /shopcarts/{id}/clear
 ######################################################################
@@ -336,11 +447,11 @@ class CalculateTotalPriceResource(Resource):
             "Request to calculate total price for all items in Shopcart %s", shopcart_id
         )
 
-        shopcart = Shopcart.find(shopcart_id)
+        shopcart = ShopcartView.find(shopcart_id)
         if not shopcart:
             abort(status.HTTP_404_NOT_FOUND, f"No such shopcart: {shopcart_id}.")
 
-        total_price = Shopcart.calculate_total_price(shopcart_id)
+        total_price = shopcart.total_price
         app.logger.info(
             "Total price for all items in Shopcart %s is %d", shopcart_id, total_price
         )
@@ -369,7 +480,7 @@ class ItemResource(Resource):
     # ------------------------------------------------------------------
     @api.doc("get_items")
     @api.response(404, "Item not found")
-    @api.marshal_with(item_model)
+    @marshal_with(api, item_model)
     def get(self, shopcart_id, item_id):
         """
         Retrieve a Item from Shopcart
@@ -379,14 +490,14 @@ class ItemResource(Resource):
             "Request to retrieve Item %s for Account id: %s", (item_id, shopcart_id)
         )
 
-        item = Item.find(item_id)
+        item = ItemView.find(item_id)
         if not item:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Account with id '{item_id}' could not be found.",
             )
 
-        return item.serialize(), status.HTTP_200_OK
+        return item, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # UPDATE A SHOPCART ITEM
@@ -395,7 +506,7 @@ class ItemResource(Resource):
     @api.response(404, "Item not found")
     @api.response(400, "The Item data was not valid")
     @api.expect(item_model)
-    @api.marshal_with(item_model)
+    @marshal_with(api, item_model)
     def put(self, shopcart_id, item_id):
         """
         Update an Item
@@ -415,7 +526,7 @@ class ItemResource(Resource):
         item.deserialize(api.payload)
         item.update()
 
-        return item.serialize(), status.HTTP_200_OK
+        return item, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # DELETE A SHOPCART ITEM
@@ -438,7 +549,7 @@ class ItemResource(Resource):
                 f"Shopcart with id '{shopcart_id}' was not found.",
             )
 
-        item = Item.query.filter_by(id=item_id, shopcart_id=shopcart_id).first()
+        item = Item.find_in_shopcart(item_id, shopcart_id)
         if item:
             # Delete the item if it exists
             item.delete()
@@ -466,7 +577,7 @@ class ItemCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("list_shopcart_items")
     @api.expect(item_args, validate=True)
-    @api.marshal_list_with(item_model)
+    @marshal_with(api, item_model, as_list=True)
     def get(self, shopcart_id):
         """
         List all items in a Shopcart
@@ -475,15 +586,12 @@ class ItemCollection(Resource):
         app.logger.info("Request to list items in Shopcart %s", shopcart_id)
 
         # Attempt to find the Shopcart and abort if not found
-        shopcart = Shopcart.find(shopcart_id)
-        if not shopcart:
+        if not ShopcartView.exists(shopcart_id):
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Shopcart with id '{shopcart_id}' was not found.",
             )
 
-        items = shopcart.items
-
         # Get the query parameters
         args = item_args.parse_args()
 
@@ -499,22 +607,20 @@ class ItemCollection(Resource):
 
         if args["item_id"]:
             app.logger.info("Filtering by item_id: %s", args["item_id"])
-            items = Item.find_by_item_id(args["item_id"])
+            items = ItemView.find_by_item_id(args["item_id"])
         elif args["quantity"]:
             app.logger.info("Filtering by quantity: %s", args["quantity"])
-            items = Item.find_by_quantity(args["quantity"])
+            items = ItemView.find_by_quantity(args["quantity"])
         elif args["price"] is not None:
             app.logger.info("Filtering by price: %s", args["price"])
-            items = Item.find_by_price(args["price"])
+            items = ItemView.find_by_price(args["price"])
         else:
             app.logger.info("Returning unfiltered list.")
-            items = Item.all()
+            items = ItemView.all()
 
-        result = [item.serialize() for item in items]
+        app.logger.info("Returning %d items from Shopcart %s", len(items), shopcart_id)
 
-        app.logger.info("Returning %d items from Shopcart %s", len(result), shopcart_id)
-
-        return result, status.HTTP_200_OK
+        return items, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # CREATE AN ITEM
@@ -522,7 +628,7 @@ class ItemCollection(Resource):
     @api.doc("create_shopcart_items")
     @api.response(400, "The posted Shopcart Item data was not valid")
     @api.expect(create_item_model)
-    @api.marshal_with(item_model, code=201)
+    @marshal_with(api, item_model, code=201)
     def post(self, shopcart_id):
         """
         Create a Item on a Shopcart
@@ -540,7 +646,7 @@ class ItemCollection(Resource):
 
         data = api.payload
 
-        app.logger.info("Processing: %s", data)
+        app.logger.debug("Processing: %.*s", PAYLOAD_LOG_LIMIT, data)
 
         item = Item()
         item.deserialize(data)
@@ -556,7 +662,42 @@ class ItemCollection(Resource):
             _external=True,
         )
 
-        return item.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+        return item, status.HTTP_201_CREATED, {"Location": location_url}
+
+
+######################################################################
+#  PATH: /events
+######################################################################
+@api.route("/events", strict_slashes=False)
+class EventFeed(Resource):
+    """The change feed of cart and item events"""
+
+    @api.doc("list_events")
+    @api.expect(event_args, validate=True)
+    def get(self):
+        """
+        Returns the events after a position
+
+        Pass the position of the last event seen as after. With wait the
+        request waits up to that many seconds for new events when there are
+        none, so consumers can poll in a loop without hammering the service.
+        """
+        args = event_args.parse_args()
+        if not 1 <= args["limit"] <= 1000:
+            abort(status.HTTP_400_BAD_REQUEST, "limit must be between 1 and 1000")
+        wait = min(max(args["wait"], 0), app.config["EVENTS_MAX_WAIT"])
+        # past the cap a request reads the feed once instead of waiting
+        if wait and _feed_waiters.acquire(blocking=False):  # pylint: disable=consider-using-with
+            try:
+                events = change_feed.wait_for_events(
+                    db.engine, args["after"], args["limit"], wait, app.config["EVENTS_POLL_INTERVAL"]
+                )
+            finally:
+                _feed_waiters.release()
+        else:
+            events = change_feed.wait_for_events(db.engine, args["after"], args["limit"], 0, 0)
+        last = events[-1]["position"] if events else args["after"]
+        return {"events": events, "last": last}, status.HTTP_200_OK
 
 
 ######################################################################
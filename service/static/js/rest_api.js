@@ -8,6 +8,7 @@ $(function () {
         
         $("#shopcart_id").val(res.id);
         $("#shopcart_name").val(res.name);
+        watch_shopcart(res.id);
 
         // Handle items array - taking first item for now
         // if (res.items && res.items.length > 0) {
@@ -26,6 +27,42 @@ $(function () {
         $("#flash_message").append(message);
     }
 
+    // Follows the item changes of the shopcart on the form as they happen
+    let stream = null;
+
+    function watch_shopcart(id) {
+        if (stream) {
+            stream.close();
+        }
+        stream = new EventSource(`/api/shopcarts/${id}/stream`);
+
+        function on_item_change(event) {
+            let item = JSON.parse(event.data);
+            flash_item_message(`Item ${item.id} ${event.type.split(".")[1]}`);
+            if ($("#item_id").val() == String(item.id)) {
+                if (event.type == "item.deleted") {
+                    clear_item_form_data();
+                } else {
+                    update_item_form_data(item);
+                }
+            }
+        }
+
+        stream.addEventListener("item.created", on_item_change);
+        stream.addEventListener("item.updated", on_item_change);
+        stream.addEventListener("item.deleted", on_item_change);
+        // sent instead of the missed events when there are too many of them
+        stream.addEventListener("reset", function () {
+            if ($("#item_id").val()) {
+                $("#retrieve-item-btn").click();
+            }
+        });
+        stream.addEventListener("shopcart.deleted", function () {
+            stream.close();
+            stream = null;
+        });
+    }
+
     // ****************************************
     // Create a Shopcart
     // ****************************************
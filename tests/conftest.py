@@ -0,0 +1,143 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Shared pytest fixtures
+
+Test database options:
+
+    pytest -n 4               each xdist worker gets its own database and whole test files
+    pytest --sqlite --no-cov  runs the tests marked "sqlite" on SQLite in memory
+"""
+import os
+from contextlib import contextmanager
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
+from service import config as service_config
+from service.common.query_stats import QueryRecorder
+from service.models import db
+
+
+######################################################################
+#  T E S T   D A T A B A S E
+######################################################################
+def pytest_addoption(parser):
+    """Adds the --sqlite option"""
+    parser.addoption("--sqlite", action="store_true", help="run the tests marked sqlite on SQLite in memory")
+
+
+def worker_database(uri: str, worker: str) -> str:
+    """Creates (if needed) a PostgreSQL database for an xdist worker and returns its URI"""
+    url = make_url(uri)
+    name = f"{url.database}_{worker}"
+    engine = create_engine(url, isolation_level="AUTOCOMMIT")
+    try:
+        with engine.connect() as connection:
+            if not connection.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": name}).scalar():
+                connection.execute(text(f'CREATE DATABASE "{name}"'))
+    finally:
+        engine.dispose()
+    return url.set(database=name).render_as_string(hide_password=False)
+
+
+def use_database(uri: str, engine_options: dict = None):
+    """Points the service configuration (read when wsgi.app is created) at uri"""
+    os.environ["DATABASE_URI"] = service_config.DATABASE_URI = service_config.SQLALCHEMY_DATABASE_URI = uri
+    if engine_options is not None:
+        service_config.SQLALCHEMY_ENGINE_OPTIONS = engine_options
+
+
+def enable_foreign_keys(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+    """Makes SQLite enforce foreign keys (and cascade deletes) like PostgreSQL"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def pytest_configure(config):
+    """Chooses the test database before any test module creates the app"""
+    config.addinivalue_line("markers", "sqlite: the test also runs on SQLite (pytest --sqlite)")
+    if config.getoption("sqlite"):
+        use_database("sqlite://", {"poolclass": StaticPool, "connect_args": {"check_same_thread": False}})
+        event.listen(Engine, "connect", enable_foreign_keys)
+        return
+    if getattr(config.option, "dist", "no") == "load":
+        # a worker runs a file's tests together, as the classes only empty their tables once
+        config.option.dist = "loadfile"
+    worker = os.getenv("PYTEST_XDIST_WORKER")
+    if worker and make_url(service_config.DATABASE_URI).get_backend_name() == "postgresql":
+        use_database(worker_database(service_config.DATABASE_URI, worker))
+
+
+def pytest_collection_modifyitems(config, items):
+    """Skips the tests that need PostgreSQL when running on SQLite"""
+    if not config.getoption("sqlite"):
+        return
+    skip = pytest.mark.skip(reason="needs PostgreSQL")
+    for item in items:
+        if "sqlite" not in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def db_transaction():
+    """Runs a test inside a transaction that is rolled back when it ends
+
+    db.session joins the transaction and every commit only releases a
+    SAVEPOINT, so nothing the test (or the service) writes through the
+    session outlives the test and no cleanup has to be committed. SQLite
+    in memory is emptied after the test instead.
+    """
+    if db.engine.dialect.name != "postgresql":
+        yield None
+        db.session.rollback()
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+        return
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    session = db.session
+    db.session = scoped_session(sessionmaker(bind=connection, join_transaction_mode="create_savepoint"))
+    try:
+        yield connection
+    finally:
+        db.session.remove()
+        db.session = session
+        transaction.rollback()
+        connection.close()
+
+
+@pytest.fixture
+def max_queries():
+    """Asserts that a block of code runs at most limit SQL statements
+
+    Usage:
+        with max_queries(2):
+            client.get("/api/shopcarts/1")
+    """
+
+    @contextmanager
+    def check(limit: int):
+        with QueryRecorder() as recorder:
+            yield recorder
+        shapes = "\n".join(f"  {count} x {shape}" for shape, count in recorder.shapes.most_common())
+        assert recorder.count <= limit, f"{recorder.count} queries, expected at most {limit}:\n{shapes}"
+
+    return check
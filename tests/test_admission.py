@@ -0,0 +1,172 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for admission control
+"""
+
+# pylint: disable=duplicate-code
+import http.client
+import logging
+import os
+import runpy
+import threading
+from contextlib import closing
+from unittest import TestCase
+from unittest.mock import patch
+from werkzeug.serving import make_server
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+import service
+from service import config, create_app
+from service.common import status
+from service.common.admission import IN_FLIGHT, SHED, AdmissionController, AdmissionMiddleware
+from service.models import db, upgrade
+from wsgi import app
+
+BASE_URL = "/api/shopcarts"
+
+
+######################################################################
+#        A D M I S S I O N   T E S T   C A S E S
+######################################################################
+class TestAdmission(TestCase):
+    """Admission Control Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.controller = AdmissionController(max_in_flight=3, max_reads=2, max_writes=1)
+        self.middleware = AdmissionMiddleware(app.wsgi_app, self.controller, retry_after=5, exempt_paths=("/livez",))
+        self.client = Client(self.middleware, Response)
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_controller_limits(self):
+        """It should admit requests until a class or the worker is full"""
+        self.assertTrue(self.controller.try_acquire("write"))
+        self.assertFalse(self.controller.try_acquire("write"))
+        self.assertTrue(self.controller.try_acquire("read"))
+        self.assertTrue(self.controller.try_acquire("read"))
+        self.assertFalse(self.controller.try_acquire("read"))
+        self.assertEqual(IN_FLIGHT.get(route_class="read"), 2)
+        self.controller.release("write")
+        self.assertEqual(self.controller.in_flight, {"total": 2, "read": 2, "write": 0})
+
+    def test_total_limit(self):
+        """It should reject any class once the worker is full"""
+        controller = AdmissionController(max_in_flight=1)
+        self.assertTrue(controller.try_acquire("read"))
+        self.assertFalse(controller.try_acquire("write"))
+
+    def test_admits_and_releases(self):
+        """It should pass requests through and free the slot afterwards"""
+        resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.controller.in_flight, {"total": 0, "read": 0, "write": 0})
+
+    def test_rejects_when_full(self):
+        """It should answer 503 with Retry-After when the class is full"""
+        self.controller.try_acquire("write")
+        shed = SHED.get(route_class="write") or 0
+        resp = self.client.post(BASE_URL, json={"customer_id": 1})
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.headers["Retry-After"], "5")
+        self.assertEqual(resp.get_json()["error"], "Service Unavailable")
+        self.assertEqual(SHED.get(route_class="write"), shed + 1)
+        # reads have their own slots
+        self.assertEqual(self.client.get(BASE_URL).status_code, status.HTTP_200_OK)
+
+    def test_exempt_paths(self):
+        """It should never shed the exempt paths"""
+        self.controller.try_acquire("read")
+        self.controller.try_acquire("read")
+        self.assertEqual(self.client.get("/livez").status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(BASE_URL).status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_releases_on_error(self):
+        """It should free the slot when the app raises"""
+        def broken_app(environ, start_response):
+            raise RuntimeError("boom")
+
+        client = Client(AdmissionMiddleware(broken_app, self.controller), Response)
+        with self.assertRaises(RuntimeError):
+            client.get(BASE_URL)
+        self.assertEqual(self.controller.in_flight["total"], 0)
+
+    def test_concurrent_requests(self):
+        """It should shed the reads over the limit while others are in flight on a threaded server"""
+        entered, release = threading.Barrier(3), threading.Event()
+
+        def slow_app(environ, start_response):  # pylint: disable=unused-argument
+            entered.wait(5)
+            release.wait(5)
+            start_response("200 OK", [("Content-Length", "0")])
+            return [b""]
+
+        server = make_server("127.0.0.1", 0, AdmissionMiddleware(slow_app, self.controller), threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        statuses = []
+
+        def get():
+            with closing(http.client.HTTPConnection("127.0.0.1", server.port, timeout=10)) as connection:
+                connection.request("GET", BASE_URL)
+                statuses.append(connection.getresponse().status)
+
+        readers = [threading.Thread(target=get) for _ in range(2)]
+        for reader in readers:
+            reader.start()
+        entered.wait(5)
+        get()
+        self.assertEqual(statuses, [status.HTTP_503_SERVICE_UNAVAILABLE])
+        release.set()
+        for reader in readers:
+            reader.join(5)
+        self.assertEqual(statuses.count(status.HTTP_200_OK), 2)
+
+    def test_worker_threads(self):
+        """It should run threaded workers with a thread for every admitted request and stream, and spares"""
+        settings = runpy.run_path(os.path.join(os.path.dirname(__file__), "..", "gunicorn.conf.py"))
+        self.assertEqual(settings["worker_class"], "gthread")
+        self.assertGreater(settings["threads"], config.ADMISSION_MAX_IN_FLIGHT + config.STREAM_MAX_SUBSCRIBERS)
+        self.assertGreaterEqual(config.DB_POOL_SIZE + config.DB_MAX_OVERFLOW, config.ADMISSION_MAX_IN_FLIGHT)
+
+    def test_create_app_installs_middleware(self):
+        """It should only wrap the app when a limit is set"""
+        real_api = service.api
+        try:
+            self.assertIsInstance(create_app().wsgi_app, AdmissionMiddleware)
+            with patch.multiple("service.config", ADMISSION_MAX_IN_FLIGHT=0, ADMISSION_MAX_READS=0,
+                                ADMISSION_MAX_WRITES=0):
+                self.assertNotIsInstance(create_app().wsgi_app, AdmissionMiddleware)
+        finally:
+            service.api = real_api
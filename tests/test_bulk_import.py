@@ -0,0 +1,170 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the bulk import
+"""
+
+# pylint: disable=duplicate-code
+import io
+import json
+import logging
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from click.testing import CliRunner
+from sqlalchemy import create_engine
+from wsgi import app
+from service.common import export
+from service.common.bulk_import import import_carts
+from service.common.cli_commands import import_carts as import_command
+from service.common.seed_data import DataGenerator, seed_data
+from service.models import db, Shopcart, Item, upgrade
+
+BAD_NDJSON = "\n".join([
+    '{"id": 1, "name": "good", "items": [{"item_id": "a", "description": "apple", "quantity": 2, "price": 10},'
+    ' {"item_id": "b", "description": "bread", "quantity": "lots", "price": 5}]}',
+    "{not json",
+    '{"id": 2, "items": []}',
+    '{"id": 3, "name": "bad items", "items": "none"}',
+    '{"id": 4, "name": "odd", "items": [[1, 2], {"item_id": "' + "x" * 17 + '", "description": "d",'
+    ' "quantity": 1, "price": 1}, {"item_id": "c", "description": "c", "quantity": 1, "price": 9999999999}]}',
+    "",
+    '{"name": "no id", "items": [{"item_id": "d", "description": "dates", "quantity": 1}]}',
+    '{"id": 1, "name": "good", "items": [{"item_id": "e", "description": "eggs", "quantity": 12, "price": 3}]}',
+]) + "\n"
+
+
+def contents(connection=None) -> list:
+    """Returns every cart's name and items, without ids, in a stable order"""
+    rows = export.export_carts(connection or db.engine, "ndjson")
+    carts = [json.loads(line) for line in b"".join(rows).decode().splitlines()]
+    return sorted(
+        (cart["name"], sorted((i["item_id"], i["description"], i["quantity"], i["price"]) for i in cart["items"]))
+        for cart in carts
+    )
+
+
+######################################################################
+#        I M P O R T   T E S T   C A S E S
+######################################################################
+class TestBulkImport(TestCase):
+    """Bulk Import Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.clear()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def clear(self):
+        """Deletes every cart and item"""
+        db.session.query(Item).delete()
+        db.session.query(Shopcart).delete()
+        db.session.commit()
+
+    def round_trip(self, fmt: str, batch_size: int):
+        """Exports seeded carts, deletes them and imports the export"""
+        with db.engine.connect() as connection:
+            seed_data(connection, DataGenerator(seed=9, max_items=8), 40)
+        before = contents()
+        data = b"".join(export.export_carts(db.engine, fmt)).decode()
+        self.clear()
+        with db.engine.connect() as connection:
+            totals = import_carts(connection, io.StringIO(data), fmt, batch_size=batch_size)
+        self.assertEqual(totals["shopcarts"], 40)
+        self.assertEqual(totals["items"], sum(len(items) for _, items in before))
+        self.assertEqual(totals["rejects"], 0)
+        self.assertEqual(contents(), before)
+
+    def test_ndjson_round_trip(self):
+        """It should import an NDJSON export with COPY"""
+        self.round_trip("ndjson", 5000)
+
+    def test_csv_round_trip_in_batches(self):
+        """It should keep a cart together when its rows span batches"""
+        progress = []
+        self.round_trip("csv", 7)
+        with db.engine.connect() as connection:
+            data = "shopcart_id,shopcart_name,id,item_id,description,quantity,price\n" + "".join(
+                f"77,split,,{n},item {n},1,{n}\n" for n in range(10)
+            )
+            totals = import_carts(connection, io.StringIO(data), "csv", batch_size=3, progress=progress.append)
+        self.assertEqual((totals["shopcarts"], totals["items"]), (1, 10))
+        self.assertGreater(len(progress), 2)
+        self.assertEqual(len(Shopcart.find_by_name("split")), 1)
+
+    def test_rejects(self):
+        """It should write invalid rows to the rejects file and import the rest"""
+        rejects = io.StringIO()
+        with db.engine.connect() as connection:
+            totals = import_carts(connection, io.StringIO(BAD_NDJSON), "ndjson", rejects)
+        self.assertEqual(totals["rejects"], 8)
+        self.assertEqual((totals["shopcarts"], totals["items"]), (1, 2))
+        self.assertEqual(contents(), [("good", [("a", "apple", 2, 10), ("e", "eggs", 12, 3)])])
+        errors = [json.loads(line) for line in rejects.getvalue().splitlines()]
+        self.assertEqual([error["line"] for error in errors], [1, 2, 3, 4, 5, 5, 5, 7])
+        self.assertIn("Invalid data type", errors[0]["error"])
+        self.assertEqual(errors[0]["record"]["items"][0]["item_id"], "b")
+        self.assertIn("Invalid JSON", errors[1]["error"])
+        self.assertIn("Shopcart name", errors[2]["error"])
+        self.assertIn("not an object", errors[4]["error"])
+        self.assertIn("longer than 16", errors[5]["error"])
+        self.assertIn("out of range", errors[6]["error"])
+        with db.engine.connect() as connection:
+            totals = import_carts(connection, io.StringIO("shopcart_id,shopcart_name\n,nameless\n"), "csv")
+        self.assertEqual(totals["rejects"], 1)
+        with self.assertRaises(ValueError):
+            import_carts(None, [], "xml")
+
+    def test_import_sqlite(self):
+        """It should import into databases without COPY"""
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine, tables=[Shopcart.__table__, Item.__table__])
+        with engine.connect() as connection:
+            totals = import_carts(connection, io.StringIO(BAD_NDJSON), "ndjson", batch_size=2)
+            self.assertEqual((totals["shopcarts"], totals["items"], totals["rejects"]), (1, 2, 8))
+        self.assertEqual(contents(engine), [("good", [("a", "apple", 2, 10), ("e", "eggs", 12, 3)])])
+
+    def test_import_command(self):
+        """It should import a file from the command line"""
+        runner = CliRunner()
+        with tempfile.TemporaryDirectory() as directory, patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            source, rejects = os.path.join(directory, "carts.csv"), os.path.join(directory, "rejects.ndjson")
+            with open(source, "w", encoding="utf-8") as csv_file:
+                csv_file.write("shopcart_id,shopcart_name,id,item_id,description,quantity,price\n"
+                               "1,cli,,a,apple,1,10\n1,cli,,b,bread,x,10\n")
+            result = runner.invoke(import_command, [source, "--rejects", rejects, "--batch-size", "1"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Imported 1 shopcarts and 1 items from 2 rows", result.output)
+            self.assertIn("Rejected 1 rows", result.output)
+            with open(rejects, encoding="utf-8") as rejects_file:
+                self.assertEqual(json.loads(rejects_file.read())["line"], 3)
+            result = runner.invoke(import_command, ["-", "--rejects", rejects], input='{"id": 1, "name": "stdin"}\n')
+            self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(contents(), [("cli", [("a", "apple", 1, 10)]), ("stdin", [])])
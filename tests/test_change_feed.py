@@ -0,0 +1,245 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the transactional outbox and the change feed
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import patch
+from click.testing import CliRunner
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+from wsgi import app
+from service.common import change_feed
+from service.common.cli_commands import dispatch_events as dispatch_command
+from service.models import db, Shopcart, Item, DataValidationError, outbox_event, upgrade
+from tests.factories import ShopcartFactory, ItemFactory
+
+BASE_URL = "/api/shopcarts"
+
+
+def events() -> list:
+    """Returns the type and cart of every outbox event in the order written"""
+    rows = db.session.execute(select(outbox_event.c.event_type, outbox_event.c.shopcart_id).order_by(outbox_event.c.id))
+    return [tuple(row) for row in rows]
+
+
+def dispatch():
+    """Publishes every pending event"""
+    with db.engine.connect() as connection:
+        return change_feed.dispatch_events(connection, batch_size=3, once=True)
+
+
+######################################################################
+#        C H A N G E   F E E D   T E S T   C A S E S
+######################################################################
+class TestChangeFeed(TestCase):
+    """Outbox and Change Feed Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Item).delete()
+        db.session.query(Shopcart).delete()
+        db.session.execute(outbox_event.delete())
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_writes_append_events(self):
+        """It should record an event for every cart and item write"""
+        shopcart = ShopcartFactory()
+        shopcart.items = [ItemFactory(shopcart=None, id=None) for _ in range(2)]
+        shopcart.create()
+        cart, name = shopcart.id, shopcart.name
+        self.assertEqual(events(), [("shopcart.created", cart), ("item.created", cart), ("item.created", cart)])
+        item = ItemFactory(shopcart=None, shopcart_id=cart).serialize()
+        item_id = self.client.post(f"{BASE_URL}/{cart}/items", json=item).get_json()["id"]
+        item["quantity"] = 99
+        self.client.put(f"{BASE_URL}/{cart}/items/{item_id}", json=item)
+        self.client.put(f"{BASE_URL}/{cart}", json={"name": "renamed", "items": []})
+        self.client.put(f"{BASE_URL}/{cart}", json={"name": "renamed", "items": []})
+        self.client.put(f"{BASE_URL}/{cart}/clear")
+        self.client.delete(f"{BASE_URL}/{cart}")
+        self.assertEqual([event for event, _ in events()[3:]], [
+            "item.created", "item.updated", "shopcart.updated",
+            "item.deleted", "item.deleted", "item.deleted", "shopcart.deleted",
+        ])
+        payloads = db.session.execute(select(outbox_event.c.payload).order_by(outbox_event.c.id)).scalars().all()
+        self.assertEqual(payloads[0], {"id": cart, "name": name})
+        self.assertEqual(payloads[4]["quantity"], 99)
+        self.assertEqual(payloads[5], {"id": cart, "name": "renamed"})
+
+    def test_large_carts(self):
+        """It should record the events of a large cart reading the session's changes once per flush"""
+        reads = []
+        new = Session.new
+
+        def counted(session):
+            reads.append(session)
+            return new.fget(session)
+
+        shopcart = ShopcartFactory()
+        shopcart.items = [ItemFactory(shopcart=None, id=None) for _ in range(500)]
+        with patch.object(Session, "new", property(counted)):
+            shopcart.create()
+        self.assertEqual(len(events()), 501)
+        self.assertEqual(len(reads), 1)
+
+    def test_failed_writes_have_no_events(self):
+        """It should not record the events of a write that is rolled back"""
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        item = Item()
+        item.deserialize(ItemFactory(shopcart=None, shopcart_id=shopcart.id + 1000).serialize())
+        self.assertRaises(DataValidationError, item.create)
+        self.assertEqual(events(), [("shopcart.created", shopcart.id)])
+
+    def test_dispatch_numbers_events_in_commit_order(self):
+        """It should publish pending events a batch at a time without gaps"""
+        for _ in range(4):
+            ShopcartFactory().create()
+        progress = []
+        with db.engine.connect() as connection:
+            totals = change_feed.dispatch_events(connection, batch_size=3, once=True, progress=progress.append)
+        self.assertEqual((totals["events"], totals["batches"], len(progress)), (4, 2, 2))
+        # an event committed late with a lower id is published after the others
+        db.session.execute(outbox_event.insert().values(id=1, event_type="shopcart.updated", shopcart_id=0, payload={}))
+        db.session.commit()
+        self.assertEqual(dispatch()["events"], 1)
+        rows = db.session.execute(select(outbox_event.c.id, outbox_event.c.position).order_by(outbox_event.c.position))
+        self.assertEqual([position for _, position in rows], [1, 2, 3, 4, 5])
+        self.assertEqual(db.session.scalar(select(outbox_event.c.id).where(outbox_event.c.position == 5)), 1)
+        self.assertEqual(dispatch()["events"], 0)
+
+    def test_prune(self):
+        """It should delete the events published before the retention period but the newest"""
+        shopcarts = [ShopcartFactory() for _ in range(3)]
+        for shopcart in shopcarts[:2]:
+            shopcart.create()
+        dispatch()
+        shopcarts[2].create()
+        with db.engine.connect() as connection:
+            self.assertEqual(change_feed.prune(connection, 1), 0)
+            later = datetime.now(timezone.utc) + timedelta(days=2)
+            self.assertEqual(change_feed.prune(connection, 1, now=later), 1)
+        self.assertEqual([shopcart_id for _, shopcart_id in events()], [shopcart.id for shopcart in shopcarts[1:]])
+
+    def test_positions_survive_pruning(self):
+        """It should keep numbering events after the last position once everything old is pruned"""
+        for _ in range(2):
+            ShopcartFactory().create()
+        dispatch()
+        later = datetime.now(timezone.utc) + timedelta(days=2)
+        with db.engine.connect() as connection:
+            change_feed.prune(connection, 1, now=later)
+            self.assertEqual(change_feed.last_position(connection), 2)
+        ShopcartFactory().create()
+        dispatch()
+        feed = self.client.get("/api/events?after=2").get_json()["events"]
+        self.assertEqual([event["position"] for event in feed], [3])
+
+    def test_dispatcher_loop(self):
+        """It should keep dispatching and sleep when there is nothing to publish"""
+        ShopcartFactory().create()
+        with db.engine.connect() as connection, patch("service.common.change_feed.time.sleep",
+                                                      side_effect=KeyboardInterrupt) as sleep:
+            with self.assertRaises(KeyboardInterrupt):
+                change_feed.dispatch_events(connection, interval=2, retention_days=7)
+        sleep.assert_called_once_with(2)
+        self.assertEqual(self.client.get("/api/events").get_json()["last"], 1)
+
+    def test_feed(self):
+        """It should return the events after a position"""
+        shopcart = ShopcartFactory()
+        shopcart.items = [ItemFactory(shopcart=None, id=None)]
+        shopcart.create()
+        self.assertEqual(self.client.get("/api/events").get_json(), {"events": [], "last": 0})
+        dispatch()
+        feed = self.client.get("/api/events?limit=1").get_json()
+        self.assertEqual(feed["last"], 1)
+        self.assertEqual(feed["events"][0]["type"], "shopcart.created")
+        self.assertEqual(feed["events"][0]["data"]["id"], shopcart.id)
+        self.assertEqual(set(feed["events"][0]), {"position", "type", "shopcart_id", "data", "created_at"})
+        feed = self.client.get("/api/events?after=1").get_json()
+        self.assertEqual(([event["type"] for event in feed["events"]], feed["last"]), (["item.created"], 2))
+        self.assertEqual(self.client.get("/api/events?after=2").get_json(), {"events": [], "last": 2})
+        self.assertEqual(self.client.get("/api/events?limit=0").status_code, 400)
+        self.assertEqual(self.client.get("/api/events?after=x").status_code, 400)
+
+    def write_in_background(self):
+        """Creates a cart and publishes its event from another thread"""
+        with app.app_context():
+            ShopcartFactory().create()
+            dispatch()
+            db.session.remove()
+
+    def test_long_poll(self):
+        """It should wait for new events when there are none"""
+        app.config["EVENTS_POLL_INTERVAL"] = 0.05
+        writer = threading.Timer(0.2, self.write_in_background)
+        try:
+            writer.start()
+            feed = self.client.get("/api/events?wait=5").get_json()
+        finally:
+            writer.join()
+            app.config["EVENTS_POLL_INTERVAL"] = 0.5
+        self.assertEqual([event["type"] for event in feed["events"]], ["shopcart.created"])
+        with patch("service.routes._feed_waiters") as waiters:
+            waiters.acquire.return_value = False
+            self.assertEqual(self.client.get("/api/events?after=1&wait=5").get_json()["events"], [])
+        started = datetime.now()
+        self.assertEqual(self.client.get("/api/events?after=1&wait=0.1").get_json()["events"], [])
+        self.assertGreater(datetime.now() - started, timedelta(seconds=0.05))
+
+    def test_dispatch_sqlite(self):
+        """It should dispatch on databases without advisory locks"""
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine, tables=[outbox_event])
+        with engine.begin() as connection:
+            connection.execute(outbox_event.insert(), [
+                {"event_type": "shopcart.created", "shopcart_id": n, "payload": {"id": n}} for n in range(3)
+            ])
+        with engine.connect() as connection:
+            self.assertEqual(change_feed.dispatch_events(connection, batch_size=2, once=True)["events"], 3)
+            feed = change_feed.read_feed(connection, 1, 10)
+        self.assertEqual([(event["position"], event["data"]) for event in feed], [(2, {"id": 1}), (3, {"id": 2})])
+
+    def test_dispatch_command(self):
+        """It should dispatch from the command line"""
+        ShopcartFactory().create()
+        runner = CliRunner()
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = runner.invoke(dispatch_command, ["--once", "--batch-size", "10"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Published 1 events in 1 batches, pruned 0", result.output)
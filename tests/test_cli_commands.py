@@ -21,13 +21,14 @@ CLI Command Extensions for Flask
 
 # pylint: disable=duplicate-code
 import os
+import json
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
 
 # pylint: disable=unused-import
 from wsgi import app  # noqa: F401
-from service.common.cli_commands import db_create  # noqa: E402
+from service.common.cli_commands import db_create, db_upgrade, openapi_spec, memory_report  # noqa: E402
 
 
 class TestFlaskCLI(TestCase):
@@ -36,10 +37,61 @@ class TestFlaskCLI(TestCase):
     def setUp(self):
         self.runner = CliRunner()
 
+    @patch("service.common.cli_commands.upgrade")
     @patch("service.common.cli_commands.db")
-    def test_db_create(self, db_mock):
+    def test_db_create(self, db_mock, upgrade_mock):
         """It should call the db-create command"""
         db_mock.return_value = MagicMock()
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+            db_mock.drop_all.assert_called_once()
+            upgrade_mock.assert_called_once_with()
+
+    @patch("service.common.cli_commands.upgrade")
+    def test_db_upgrade(self, upgrade_mock):
+        """It should call the db-upgrade command"""
+        upgrade_mock.return_value = [1]
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_upgrade, ["--target", "1"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Applied migrations: 1", result.output)
+            upgrade_mock.assert_called_once_with(1)
+
+    @patch("service.common.cli_commands.upgrade")
+    def test_db_upgrade_up_to_date(self, upgrade_mock):
+        """It should report when there is nothing to migrate"""
+        upgrade_mock.return_value = []
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_upgrade)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("up to date", result.output)
+            upgrade_mock.assert_called_once_with(None)
+
+    def test_openapi_spec(self):
+        """It should write the OpenAPI spec as JSON"""
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(openapi_spec)
+            self.assertEqual(result.exit_code, 0)
+            spec = json.loads(result.output)
+            self.assertEqual(spec["info"]["title"], "Shopcarts RESTX API Service")
+            self.assertIn("/shopcarts", spec["paths"])
+
+    def test_memory_report(self):
+        """It should print the memory report as JSON"""
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(memory_report)
+            self.assertEqual(result.exit_code, 0)
+            report = json.loads(result.output)
+            self.assertGreater(report["rss_bytes"], 0)
+            self.assertNotIn("diff", report)
+
+    def test_memory_report_for_request(self):
+        """It should report the allocations left behind by a request"""
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(memory_report, ["--path", "/health", "--repeat", "2", "--top", "3"])
+            self.assertEqual(result.exit_code, 0)
+            report = json.loads(result.output)
+            self.assertEqual(report["request"]["statuses"], [200])
+            self.assertLessEqual(len(report["diff"]), 3)
+            self.assertEqual(report["snapshots"], [1, 2][:len(report["snapshots"])])
@@ -0,0 +1,238 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the event hub and the Server-Sent Events stream
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy.exc import SQLAlchemyError
+from wsgi import app
+from service import routes
+from service.common import change_feed
+from service.common.event_hub import EventHub, Subscription, format_event
+from service.models import db, Shopcart, Item, outbox_event, upgrade
+from tests.factories import ShopcartFactory, ItemFactory
+
+BASE_URL = "/api/shopcarts"
+
+
+def dispatch():
+    """Publishes every pending event"""
+    with db.engine.connect() as connection:
+        change_feed.dispatch_events(connection, once=True)
+
+
+def add_item(shopcart_id: int) -> dict:
+    """Adds an item to a cart through the API and returns it"""
+    item = ItemFactory(shopcart=None, shopcart_id=shopcart_id).serialize()
+    return app.test_client().post(f"{BASE_URL}/{shopcart_id}/items", json=item).get_json()
+
+
+class StopLoop(Exception):
+    """Breaks out of the hub's endless loop"""
+
+
+######################################################################
+#        E V E N T   H U B   T E S T   C A S E S
+######################################################################
+class TestEventHub(TestCase):
+    """Event Hub and Stream Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+        # every test makes its own carts and only follows their events
+        db.session.query(Item).delete()
+        db.session.query(Shopcart).delete()
+        db.session.execute(outbox_event.delete())
+        db.session.commit()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        self.shopcart = ShopcartFactory()
+        self.shopcart.create()
+        self.other = ShopcartFactory()
+        self.other.create()
+        dispatch()
+
+    def tearDown(self):
+        """This runs after each test"""
+        routes._event_hub.stop()  # pylint: disable=protected-access
+        db.session.remove()
+
+    def make_hub(self, **kwargs) -> EventHub:
+        """Returns an EventHub whose thread is stopped after the test"""
+        hub = EventHub(db.engine, **kwargs)
+        self.addCleanup(hub.stop)
+        return hub
+
+    def test_subscription(self):
+        """It should queue events and close when its client falls behind"""
+        subscription = Subscription(1, limit=2)
+        self.assertEqual(subscription.get(0.01), [])
+        subscription.put({"position": 1})
+        subscription.put({"position": 2})
+        self.assertEqual(subscription.get(0.01), [{"position": 1}, {"position": 2}])
+        subscription.put({"position": 0})
+        self.assertEqual(subscription.get(0.01), [])
+        for position in range(3, 6):
+            subscription.put({"position": position})
+        self.assertTrue(subscription.closed)
+        self.assertEqual(len(subscription.get(0.01)), 2)
+        self.assertIsNone(subscription.get(0.01))
+        event = {"position": 7, "type": "item.created", "data": {"id": 1}}
+        self.assertEqual(format_event(event), 'id: 7\nevent: item.created\ndata: {"id": 1}\n\n')
+
+    def test_fan_out(self):
+        """It should hand each event to the subscribers of its cart only"""
+        hub = self.make_hub(poll_interval=0.01, max_subscribers=3)
+        first, second = hub.subscribe(self.shopcart.id), hub.subscribe(self.shopcart.id)
+        other = hub.subscribe(self.other.id)
+        self.assertIsNone(hub.subscribe(self.other.id))
+        item = add_item(self.shopcart.id)
+        dispatch()
+        for subscription in (first, second):
+            events = subscription.get(5)
+            self.assertEqual([(event["type"], event["data"]["id"]) for event in events], [("item.created", int(item["id"]))])
+        self.assertEqual(other.get(0.05), [])
+        for subscription in (first, second, other):
+            hub.unsubscribe(subscription)
+        hub.unsubscribe(first)
+        self.assertEqual((hub.count, hub.subscriptions), (0, {}))
+        # a new subscription only gets the events published after it was made
+        add_item(self.shopcart.id)
+        dispatch()
+        again = hub.subscribe(self.shopcart.id)
+        self.assertEqual(again.get(0.05), [])
+        hub.unsubscribe(again)
+        hub.stop()
+        self.assertIsNone(hub.thread)
+
+    def test_events_before_first_poll(self):
+        """It should hand out the events published before its thread first reads the feed"""
+        hub = self.make_hub(poll_interval=0.01)
+        with patch.object(hub, "poll", return_value=0):
+            subscription = hub.subscribe(self.shopcart.id)
+            item = add_item(self.shopcart.id)
+            dispatch()
+        # a late subscription moves nobody else ahead
+        late = hub.subscribe(self.shopcart.id)
+        self.assertEqual([event["data"]["id"] for event in subscription.get(5)], [int(item["id"])])
+        self.assertEqual(late.get(0.05), [])
+        hub.stop()
+        self.assertTrue(subscription.closed and late.closed)
+
+    def test_catches_up(self):
+        """It should read the feed again at once until it has caught up"""
+        hub = EventHub(db.engine)
+        hub.thread = threading.current_thread()
+        subscription = hub.subscribe(self.shopcart.id)
+        items = [add_item(self.shopcart.id) for _ in range(3)]
+        dispatch()
+        with patch("service.common.event_hub.REPLAY_LIMIT", 1), \
+                patch("service.common.event_hub.time.sleep", side_effect=StopLoop) as sleep:
+            self.assertRaises(StopLoop, hub.run)
+        sleep.assert_called_once()
+        self.assertEqual([event["data"]["id"] for event in subscription.get(0)], [int(item["id"]) for item in items])
+
+    def test_feed_errors(self):
+        """It should log errors reading the feed and keep going"""
+        hub = EventHub(db.engine)
+        hub.count = 1
+        hub.thread = threading.current_thread()
+        with patch.object(hub, "poll", side_effect=SQLAlchemyError("down")), \
+                patch("service.common.event_hub.time.sleep", side_effect=StopLoop), \
+                self.assertLogs("flask.app", level="WARNING") as logs:
+            self.assertRaises(StopLoop, hub.run)
+        self.assertIn("Could not read the change feed", logs.output[0])
+
+    def test_stream(self):
+        """It should stream a cart's events until the cart is deleted"""
+        item = add_item(self.shopcart.id)
+        dispatch()
+        with patch.object(routes._event_hub, "poll_interval", 0.01):  # pylint: disable=protected-access
+            resp = self.client.get(f"{BASE_URL}/{self.shopcart.id}/stream", buffered=False,
+                                   headers={"Last-Event-ID": "0"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "text/event-stream")
+            self.assertEqual(resp.headers["Cache-Control"], "no-cache")
+            chunks = resp.iter_encoded()
+            self.assertEqual(next(chunks), b"retry: 3000\n\n")
+            replayed = next(chunks).decode()
+            self.assertIn("event: shopcart.created", replayed)
+            self.assertIn("event: item.created", next(chunks).decode())
+            self.client.delete(f"{BASE_URL}/{self.shopcart.id}/items/{item['id']}")
+            dispatch()
+            self.assertIn(f'event: item.deleted\ndata: {{"id": {item["id"]}', next(chunks).decode())
+            self.client.delete(f"{BASE_URL}/{self.shopcart.id}")
+            dispatch()
+            self.assertIn("event: shopcart.deleted", next(chunks).decode())
+            self.assertRaises(StopIteration, next, chunks)
+            resp.close()
+        self.assertEqual(routes._event_hub.count, 0)  # pylint: disable=protected-access
+
+    def test_stream_reset(self):
+        """It should send a reset instead of replaying more missed events than it can"""
+        add_item(self.shopcart.id)
+        dispatch()
+        with db.engine.connect() as connection:
+            head = change_feed.last_position(connection)
+        with patch("service.common.event_hub.REPLAY_LIMIT", 1):
+            resp = self.client.get(f"{BASE_URL}/{self.shopcart.id}/stream", buffered=False,
+                                   headers={"Last-Event-ID": "0"})
+            chunks = resp.iter_encoded()
+            self.assertEqual(next(chunks), b"retry: 3000\n\n")
+            self.assertEqual(next(chunks).decode(), f'id: {head}\nevent: reset\ndata: {{"id": {self.shopcart.id}}}\n\n')
+            item = add_item(self.shopcart.id)
+            dispatch()
+            self.assertIn(f'event: item.created\ndata: {{"id": {item["id"]}', next(chunks).decode())
+            resp.close()
+
+    def test_stream_heartbeat(self):
+        """It should keep a quiet stream open and end it when the client falls behind"""
+        app.config["STREAM_HEARTBEAT_SECONDS"] = 0.01
+        try:
+            resp = self.client.get(f"{BASE_URL}/{self.shopcart.id}/stream", buffered=False)
+        finally:
+            app.config["STREAM_HEARTBEAT_SECONDS"] = 15
+        chunks = resp.iter_encoded()
+        self.assertEqual(next(chunks), b"retry: 3000\n\n")
+        self.assertEqual(next(chunks), b": keep-alive\n\n")
+        subscription = next(iter(routes._event_hub.subscriptions[self.shopcart.id]))  # pylint: disable=protected-access
+        subscription.closed = True
+        self.assertRaises(StopIteration, next, chunks)
+        resp.close()
+
+    def test_stream_errors(self):
+        """It should refuse streams of unknown carts and past the limit"""
+        resp = self.client.get(f"{BASE_URL}/0/stream")
+        self.assertEqual(resp.status_code, 404)
+        with patch.object(routes._event_hub, "max_subscribers", 1):  # pylint: disable=protected-access
+            with patch.object(routes._event_hub, "count", 1):  # pylint: disable=protected-access
+                resp = self.client.get(f"{BASE_URL}/{self.shopcart.id}/stream")
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], "1")
@@ -0,0 +1,220 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the bulk export
+"""
+
+# pylint: disable=duplicate-code
+import csv
+import io
+import json
+import logging
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from click.testing import CliRunner
+from flask_restx import fields
+from sqlalchemy import create_engine
+from wsgi import app
+from service.common import export
+from service.common.cli_commands import export_carts as export_command
+from service.common.seed_data import DataGenerator, seed_data
+from service.models import db, Shopcart, Item, upgrade
+
+ADMIN_HEADERS = {"Authorization": "Bearer admin-secret"}
+
+
+def read_ndjson(data: bytes) -> list:
+    """Decodes an NDJSON export"""
+    return [json.loads(line) for line in data.decode("utf-8").splitlines()]
+
+
+def read_csv(data: bytes) -> list:
+    """Decodes a CSV export"""
+    return list(csv.DictReader(io.StringIO(data.decode("utf-8"))))
+
+
+######################################################################
+#        E X P O R T   T E S T   C A S E S
+######################################################################
+class TestExport(TestCase):
+    """Bulk Export Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+        # the tests only read the carts, so they are seeded once
+        db.session.query(Item).delete()
+        db.session.query(Shopcart).delete()
+        db.session.commit()
+        with db.engine.connect() as connection:
+            seed_data(connection, DataGenerator(seed=5, max_items=6), 20)
+        # an empty cart and a name that needs quoting
+        empty = Shopcart()
+        empty.name = 'empty, "quoted"'
+        empty.create()
+        db.session.remove()
+
+    def setUp(self):
+        """Runs before each test"""
+        app.config["ADMIN_TOKEN"] = "admin-secret"
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """This runs after each test"""
+        app.config["ADMIN_TOKEN"] = None
+        db.session.remove()
+
+    def expected_carts(self) -> list:
+        """Returns every cart as the API serializes it"""
+        ids = db.session.scalars(db.select(Shopcart.id).order_by(Shopcart.id)).all()
+        carts = [self.client.get(f"/api/shopcarts/{shopcart_id}").get_json() for shopcart_id in ids]
+        return [dict(cart, items=sorted(cart["items"], key=lambda i: int(i["id"]))) for cart in carts]
+
+    def export(self, fmt: str, **kwargs) -> bytes:
+        """Returns a whole export as bytes"""
+        return b"".join(export.export_carts(db.engine, fmt, **kwargs))
+
+    def test_ndjson_export(self):
+        """It should export one cart per line like the API, in batches"""
+        self.assertEqual(read_ndjson(self.export("ndjson", batch_size=7)), self.expected_carts())
+
+    def test_ndjson_follows_the_model(self):
+        """It should encode the carts with whatever fields the API's cart model has"""
+        item = {"id": fields.String, "price": fields.Integer, "currency": fields.String(default="USD")}
+        model = {"id": fields.Integer, "items": fields.List(fields.Nested(item))}
+        with patch("service.routes.shopcart_model", model):
+            carts = read_ndjson(self.export("ndjson"))
+        expected = self.expected_carts()
+        self.assertEqual(carts, [{"id": cart["id"], "items": [
+            {"id": line["id"], "price": line["price"], "currency": "USD"} for line in cart["items"]
+        ]} for cart in expected])
+
+    def test_csv_export_with_copy(self):
+        """It should export one row per item with COPY, the same as the Python writer"""
+        data = self.export("csv")
+        rows = read_csv(data)
+        carts = self.expected_carts()
+        self.assertEqual(len(rows), sum(max(len(cart["items"]), 1) for cart in carts))
+        empty = [row for row in rows if row["shopcart_name"] == 'empty, "quoted"']
+        self.assertEqual(empty, [dict.fromkeys(export.COLUMNS, "") | {
+            "shopcart_id": str(carts[-1]["id"]), "shopcart_name": 'empty, "quoted"'}])
+        with db.engine.connect() as connection:
+            python_csv = b"".join(export._csv_lines(  # pylint: disable=protected-access
+                connection.execute(export.export_statement())
+            ))
+        self.assertEqual(data, python_csv)
+
+    def test_export_id_range(self):
+        """It should only export the carts in an id range"""
+        carts = self.expected_carts()
+        first, last = carts[3]["id"], carts[8]["id"]
+        exported = read_ndjson(self.export("ndjson", first_id=first, last_id=last))
+        self.assertEqual(exported, carts[3:9])
+        self.assertEqual(len({row["shopcart_id"] for row in read_csv(self.export("csv", first_id=first))}), 18)
+        with self.assertRaises(ValueError):
+            self.export("xml")
+
+    def test_id_ranges(self):
+        """It should split the ids into contiguous ranges"""
+        carts = self.expected_carts()
+        low, high = carts[0]["id"], carts[-1]["id"]
+        with db.engine.connect() as connection:
+            ranges = export.id_ranges(connection, 4)
+            self.assertEqual(len(ranges), 4)
+            self.assertEqual((ranges[0][0], ranges[-1][1]), (low, high))
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(start, end + 1)
+            self.assertEqual(export.id_ranges(connection, 100, low, low + 2), [(low, low), (low + 1, low + 1),
+                                                                               (low + 2, low + 2)])
+            connection.execute(db.delete(Shopcart))
+            self.assertEqual(export.id_ranges(connection, 4), [(None, None)])
+            # the carts are shared by the other tests
+            connection.rollback()
+
+    def test_parallel_export(self):
+        """It should export id ranges to separate files at the same time"""
+        with tempfile.TemporaryDirectory() as directory:
+            sizes = export.write_parallel(db.engine, "ndjson", os.path.join(directory, "carts.ndjson"), 3)
+            self.assertEqual(list(sizes), [os.path.join(directory, f"carts.{n}.ndjson") for n in range(3)])
+            exported = []
+            for path, size in sizes.items():
+                with open(path, "rb") as part:
+                    data = part.read()
+                self.assertEqual(len(data), size)
+                exported += read_ndjson(data)
+        self.assertEqual(exported, self.expected_carts())
+        self.assertEqual(export.part_path("out", 2), "out.2")
+
+    def test_export_sqlite(self):
+        """It should stream from databases without COPY"""
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine, tables=[Shopcart.__table__, Item.__table__])
+        with engine.connect() as connection:
+            seed_data(connection, DataGenerator(seed=5, max_items=6), 20)
+        carts = read_ndjson(b"".join(export.export_carts(engine, "ndjson", batch_size=5)))
+        rows = read_csv(b"".join(export.export_carts(engine, "csv", batch_size=5)))
+        self.assertEqual(len(carts), 20)
+        self.assertEqual(len(rows), sum(len(cart["items"]) for cart in carts))
+        self.assertEqual(rows[0]["shopcart_id"], "1")
+
+    def test_export_endpoint(self):
+        """It should stream the export to admins"""
+        self.assertEqual(self.client.get("/admin/export").status_code, 401)
+        resp = self.client.get("/admin/export", headers=ADMIN_HEADERS)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(read_ndjson(resp.get_data()), self.expected_carts())
+        carts = self.expected_carts()
+        resp = self.client.get("/admin/export", headers=ADMIN_HEADERS, query_string={
+            "format": "csv", "min_id": carts[10]["id"], "max_id": carts[10]["id"]
+        })
+        self.assertEqual(resp.mimetype, "text/csv")
+        self.assertIn("filename=shopcarts.csv", resp.headers["Content-Disposition"])
+        self.assertEqual({row["shopcart_id"] for row in read_csv(resp.get_data())}, {str(carts[10]["id"])})
+        resp = self.client.get("/admin/export?format=xml", headers=ADMIN_HEADERS)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_export_command(self):
+        """It should export from the command line"""
+        runner = CliRunner()
+        with tempfile.TemporaryDirectory() as directory, patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = runner.invoke(export_command, [])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(read_ndjson(result.stdout_bytes), self.expected_carts())
+            path = os.path.join(directory, "carts.csv")
+            result = runner.invoke(export_command, ["--format", "csv", "--output", path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn(f"Wrote {path}", result.output)
+            result = runner.invoke(export_command, ["--output", path, "--parallel", "2"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertTrue(os.path.exists(os.path.join(directory, "carts.1.csv")))
+            result = runner.invoke(export_command, ["--parallel", "2"])
+            self.assertEqual(result.exit_code, 2)
+            result = runner.invoke(export_command, ["--output", path, "--parallel", "2", "--min-id", "1"])
+            self.assertEqual(result.exit_code, 2)
+            with patch("service.common.export.FORMATS", ("ndjson", "csv")):
+                result = runner.invoke(export_command, ["--format", "parquet", "--output", path])
+            self.assertEqual(result.exit_code, 2)
+            self.assertIn("needs pyarrow", result.output)
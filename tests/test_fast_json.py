@@ -0,0 +1,163 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the fast JSON serializer
+"""
+
+# pylint: disable=duplicate-code
+import json
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from flask_restx import fields, marshal
+from wsgi import app
+from service.common import fast_json
+from service.common.fast_json import compile_encoder, dumps
+from service.models import db, Shopcart, upgrade
+from service.routes import shopcart_model, item_model
+from tests.factories import ShopcartFactory, ItemFactory
+
+BASE_URL = "/api/shopcarts"
+
+
+######################################################################
+#        F A S T   J S O N   T E S T   C A S E S
+######################################################################
+class TestFastJsonEncoder(TestCase):
+    """Fast JSON Encoder Tests"""
+
+    def _shopcart(self):
+        """Makes an in-memory shopcart with two items"""
+        shopcart = ShopcartFactory()
+        shopcart.items = [ItemFactory(shopcart=None, shopcart_id=shopcart.id) for _ in range(2)]
+        return shopcart
+
+    def test_encoder_matches_marshal_for_objects(self):
+        """It should encode ORM objects exactly like marshal()"""
+        shopcart = self._shopcart()
+        encode = compile_encoder(shopcart_model)
+        self.assertEqual(encode(shopcart), marshal(shopcart, shopcart_model))
+
+    def test_encoder_matches_marshal_for_dicts(self):
+        """It should encode serialized dicts exactly like marshal()"""
+        data = self._shopcart().serialize()
+        encode = compile_encoder(shopcart_model)
+        self.assertEqual(encode(data), marshal(data, shopcart_model))
+        # the documented schema has string ids for items
+        self.assertIsInstance(encode(data)["items"][0]["id"], str)
+
+    def test_encoder_handles_missing_values(self):
+        """It should use None for missing values like marshal()"""
+        encode = compile_encoder(item_model)
+        self.assertEqual(encode({}), marshal({}, item_model))
+        # marshal() would pick up dict.items() here, the encoder does not
+        encode = compile_encoder(shopcart_model)
+        self.assertEqual(encode({"name": "empty"}), {"name": "empty", "items": None, "id": None})
+
+    def test_encoder_field_defaults(self):
+        """It should apply field defaults and other Raw fields like marshal()"""
+        model = {
+            "flag": fields.Boolean(default=False),
+            "count": fields.Integer(default=7),
+            "label": fields.String(default="none"),
+            "raw": fields.Raw,
+            "tags": fields.List(fields.String, default=[]),
+            "child": fields.Nested({"x": fields.Integer}, allow_null=True),
+            "other": fields.Nested({"x": fields.Integer}, default={"x": 1}),
+            "empty": fields.Nested({"x": fields.Integer}),
+        }
+        encode = compile_encoder(model)
+        self.assertEqual(encode({}), marshal({}, model))
+        data = {"flag": 1, "count": "3", "label": 5, "raw": [1], "tags": [1, 2], "child": {"x": "2"}}
+        self.assertEqual(encode(data), marshal(data, model))
+
+    def test_encoder_rejects_unsupported_fields(self):
+        """It should refuse fields whose output cannot be precompiled"""
+        self.assertRaises(ValueError, compile_encoder, {"url": fields.Url("index")})
+        self.assertRaises(ValueError, compile_encoder, {"name": fields.String(attribute=lambda obj: obj)})
+        self.assertRaises(ValueError, compile_encoder, {"child": fields.Nested({"x": fields.Integer}, skip_none=True)})
+
+    def test_dumps(self):
+        """It should encode compact JSON bytes with or without orjson"""
+        data = {"id": 1, "name": "cart", "items": []}
+        encoded = dumps(data)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(json.loads(encoded), data)
+        with patch.object(fast_json, "orjson", None):
+            self.assertEqual(dumps(data), b'{"id":1,"name":"cart","items":[]}')
+
+
+class TestFastJsonRoutes(TestCase):
+    """Fast JSON Route Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Shopcart).delete()  # clean up the last tests
+        db.session.commit()
+        shopcart = ShopcartFactory()
+        item = ItemFactory(shopcart=None)
+        data = shopcart.serialize()
+        data["items"] = [item.serialize()]
+        resp = self.client.post(BASE_URL, json=data)
+        self.assertEqual(resp.status_code, 201)
+        self.shopcart = resp.get_json()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+        app.config["FAST_JSON_ENABLED"] = True
+
+    def test_fast_and_marshalled_responses_match(self):
+        """It should return the same body on the fast and marshalled paths"""
+        url = f"{BASE_URL}/{self.shopcart['id']}"
+        fast = self.client.get(url)
+        app.config["FAST_JSON_ENABLED"] = False
+        slow = self.client.get(url)
+        self.assertEqual(fast.status_code, slow.status_code)
+        self.assertEqual(fast.content_type, "application/json")
+        self.assertEqual(fast.get_json(), slow.get_json())
+        self.assertEqual(fast.get_json(), self.shopcart)
+
+    def test_field_mask_uses_marshal(self):
+        """It should honour the X-Fields mask by falling back to marshal"""
+        resp = self.client.get(f"{BASE_URL}/{self.shopcart['id']}", headers={"X-Fields": "name"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json(), {"name": self.shopcart["name"]})
+
+    def test_list_items_match(self):
+        """It should list items identically on both paths"""
+        url = f"{BASE_URL}/{self.shopcart['id']}/items"
+        fast = self.client.get(url).get_json()
+        app.config["FAST_JSON_ENABLED"] = False
+        slow = self.client.get(url).get_json()
+        self.assertEqual(fast, slow)
+        self.assertEqual(fast, self.shopcart["items"])
@@ -0,0 +1,117 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the liveness and readiness probes
+"""
+
+# pylint: disable=duplicate-code
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+from wsgi import app
+from service.common import health
+from service.common import status
+from service.models import db
+
+
+######################################################################
+#        H E A L T H   T E S T   C A S E S
+######################################################################
+class TestHealth(TestCase):
+    """Liveness and Readiness Probe Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        health.reset()
+
+    def tearDown(self):
+        """This runs after each test"""
+        health.reset()
+        db.session.remove()
+
+    def test_livez(self):
+        """It should report that the worker is alive"""
+        resp = self.client.get("/livez")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"status": "alive"})
+
+    def test_readyz(self):
+        """It should report the database latency and pool usage"""
+        resp = self.client.get("/readyz")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["status"], "ready")
+        self.assertTrue(data["database"]["ok"])
+        self.assertGreaterEqual(data["database"]["latency_ms"], 0)
+        self.assertIn("checked_at", data["database"])
+        self.assertLess(data["pool"]["saturation"], 1)
+        self.assertEqual(data["pool"]["size"], db.engine.pool.size())
+
+    def test_readyz_caches_database_check(self):
+        """It should not check the database on every probe"""
+        with patch.object(health, "check_database", wraps=health.check_database) as check:
+            self.client.get("/readyz")
+            self.client.get("/readyz")
+        check.assert_called_once()
+
+    def test_readyz_database_down(self):
+        """It should not be ready when the database is unavailable"""
+        error = OperationalError("SELECT 1", {}, Exception("connection refused"))
+        with patch.object(db.engine, "connect", side_effect=error):
+            resp = self.client.get("/readyz")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        data = resp.get_json()
+        self.assertEqual(data["status"], "not ready")
+        self.assertEqual(data["reason"], "database unavailable")
+        self.assertIn("OperationalError", data["database"]["error"])
+
+    def test_readyz_database_slow(self):
+        """It should not be ready when SELECT 1 is too slow"""
+        with patch.dict(app.config, {"READINESS_MAX_DB_SECONDS": -1}):
+            resp = self.client.get("/readyz")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.get_json()["reason"], "database too slow")
+
+    def test_readyz_pool_saturated(self):
+        """It should not be ready when the pool is nearly exhausted"""
+        with patch.dict(app.config, {"READINESS_MAX_POOL_SATURATION": 0}):
+            with patch.object(health, "check_database") as check:
+                resp = self.client.get("/readyz")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.get_json()["reason"], "connection pool saturated")
+        check.assert_not_called()
+
+    def test_concurrent_probe_gets_last_result(self):
+        """It should answer from the cache while another probe is checking"""
+        first = health.cached_database_check(0)
+        with health._lock:  # pylint: disable=protected-access
+            self.assertIs(health.cached_database_check(0), first)
+
+    def test_pool_without_queue(self):
+        """It should report pools that do not queue as never saturated"""
+        self.assertEqual(health.pool_status(NullPool(lambda: None)), {"class": "NullPool", "saturation": 0.0})
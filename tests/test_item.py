@@ -6,8 +6,9 @@ Test cases for Item Model
 import logging
 import os
 from unittest import TestCase
+import pytest
 from wsgi import app
-from service.models import Shopcart, Item, db
+from service.models import Shopcart, Item, db, upgrade
 from tests.factories import ShopcartFactory, ItemFactory
 
 DATABASE_URI = os.getenv(
@@ -18,6 +19,8 @@ DATABASE_URI = os.getenv(
 ######################################################################
 #        P R O D U C T   M O D E L   T E S T   C A S E S
 ######################################################################
+@pytest.mark.sqlite
+@pytest.mark.usefixtures("db_transaction")
 class TestItem(TestCase):
     """Item Model Test Cases"""
 
@@ -29,18 +32,17 @@ class TestItem(TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
         app.app_context().push()
+        upgrade()
+        # each test is rolled back, so only other suites leave rows behind
+        db.session.query(Shopcart).delete()
+        db.session.query(Item).delete()
+        db.session.commit()
 
     @classmethod
     def tearDownClass(cls):
         """This runs once after the entire test suite"""
         db.session.close()
 
-    def setUp(self):
-        """This runs before each test"""
-        db.session.query(Shopcart).delete()  # clean up the last tests
-        db.session.query(Item).delete()  # clean up the last tests
-        db.session.commit()
-
     def tearDown(self):
         """This runs after each test"""
         db.session.remove()
@@ -291,3 +293,21 @@ class TestItem(TestCase):
         same_item = Item.find_by_quantity(item.quantity)[0]
         self.assertEqual(same_item.item_id, item.item_id)
         self.assertEqual(same_item.quantity, item.quantity)
+
+    def test_find_in_shopcart(self):
+        """It should Find an item only in its own shopcart"""
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        item = ItemFactory(shopcart=shopcart)
+        item.create()
+
+        same_item = Item.find_in_shopcart(item.id, shopcart.id)
+        self.assertEqual(same_item.id, item.id)
+        self.assertIsNone(Item.find_in_shopcart(item.id, shopcart.id + 1))
+
+    def test_finder_statements_are_cached(self):
+        """It should build each finder statement only once"""
+        statement = Item._select_by("price")
+        self.assertIs(Item._select_by("price"), statement)
+        self.assertIsNot(Item._select_by("quantity"), statement)
+        self.assertIsNot(Shopcart._select_by("id"), Item._select_by("id"))
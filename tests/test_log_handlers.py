@@ -0,0 +1,140 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the log handlers
+"""
+
+# pylint: disable=duplicate-code
+import json
+import logging
+from logging.handlers import QueueHandler
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from service.common.log_handlers import init_logging, stop_logging, JsonFormatter, RouteSampler
+
+
+class ListHandler(logging.Handler):
+    """Keeps the formatted records in a list"""
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+######################################################################
+#        L O G   H A N D L E R   T E S T   C A S E S
+######################################################################
+class TestLogHandlers(TestCase):
+    """Log Handler Tests"""
+
+    def setUp(self):
+        self.handler = ListHandler()
+        self.server_logger = logging.getLogger("test.gunicorn.error")
+        self.server_logger.handlers = [self.handler]
+        self.server_logger.setLevel(logging.INFO)
+        self.app = Flask("log_test")
+
+        @self.app.route("/busy")
+        def busy():
+            self.app.logger.info("busy route")
+            self.app.logger.warning("busy warning")
+            return ""
+
+    def tearDown(self):
+        stop_logging(self.app)
+        self.server_logger.handlers = []
+
+    def test_async_logging(self):
+        """It should write logs through a queue listener"""
+        init_logging(self.app, "test.gunicorn.error")
+        self.assertIsInstance(self.app.logger.handlers[0], QueueHandler)
+        self.app.logger.info("hello %s", "world")
+        stop_logging(self.app)
+        self.assertRegex(self.handler.lines[-1], r"^\[.*\] \[INFO\] \[test_log_handlers\] hello world$")
+        self.assertIn("Logging handler established", self.handler.lines[0])
+
+    def test_sync_logging(self):
+        """It should write logs directly when LOG_ASYNC is off"""
+        self.app.config["LOG_ASYNC"] = False
+        init_logging(self.app, "test.gunicorn.error")
+        self.assertEqual(self.app.logger.handlers, [self.handler])
+        self.assertNotIn("log_listener", self.app.extensions)
+
+    def test_reinit_stops_listener(self):
+        """It should replace the listener when logging is set up again"""
+        init_logging(self.app, "test.gunicorn.error")
+        first = self.app.extensions["log_listener"]
+        with patch.object(first, "stop", wraps=first.stop) as stop:
+            init_logging(self.app, "test.gunicorn.error")
+        stop.assert_called_once()
+        self.assertIsNot(self.app.extensions["log_listener"], first)
+
+    def test_json_format(self):
+        """It should write one JSON object per line"""
+        self.app.config.update(LOG_ASYNC=False, LOG_FORMAT="json")
+        init_logging(self.app, "test.gunicorn.error")
+        try:
+            raise ValueError("bad")
+        except ValueError:
+            self.app.logger.exception("failed %d", 42)
+        entry = json.loads(self.handler.lines[-1])
+        self.assertEqual(entry["level"], "ERROR")
+        self.assertEqual(entry["message"], "failed 42")
+        self.assertIn("ValueError: bad", entry["exception"])
+        self.assertIsInstance(JsonFormatter().format(logging.makeLogRecord({"msg": "x"})), str)
+
+    def test_async_exceptions(self):
+        """It should keep tracebacks apart from the message through the queue"""
+        self.app.config.update(LOG_FORMAT="json")
+        init_logging(self.app, "test.gunicorn.error")
+        try:
+            raise ValueError("bad")
+        except ValueError:
+            self.app.logger.exception("failed %d", 42)
+        stop_logging(self.app)
+        entry = json.loads(self.handler.lines[-1])
+        self.assertEqual(entry["message"], "failed 42")
+        self.assertIn("ValueError: bad", entry["exception"])
+        self.app.config.update(LOG_FORMAT="text")
+        init_logging(self.app, "test.gunicorn.error")
+        try:
+            raise ValueError("worse")
+        except ValueError:
+            self.app.logger.exception("failed again")
+        stop_logging(self.app)
+        self.assertRegex(self.handler.lines[-1], r"\] failed again\nTraceback .*\n(.*\n)*ValueError: worse$")
+
+    def test_route_sampling(self):
+        """It should drop the INFO logs of requests that are not sampled"""
+        self.app.config.update(LOG_ASYNC=False, LOG_SAMPLE_RATES={"busy": 0.0})
+        init_logging(self.app, "test.gunicorn.error")
+        client = self.app.test_client()
+        client.get("/busy")
+        self.assertNotIn("busy route", self.handler.lines)
+        self.assertIn("busy warning", self.handler.lines[-1])
+        self.app.logger.info("outside a request")
+        self.assertIn("outside a request", self.handler.lines[-1])
+
+        self.app.config["LOG_SAMPLE_RATES"] = {"busy": 1.0}
+        init_logging(self.app, "test.gunicorn.error")
+        self.assertEqual(len([f for f in self.app.logger.filters if isinstance(f, RouteSampler)]), 1)
+        client.get("/busy")
+        self.assertIn("busy route", self.handler.lines[-2])
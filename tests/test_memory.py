@@ -0,0 +1,132 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the memory admin endpoints
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import tracemalloc
+from unittest import TestCase
+from wsgi import app
+from service.common import memory
+from service.models import db, Shopcart, upgrade
+from tests.factories import ShopcartFactory, ItemFactory
+
+ADMIN_HEADERS = {"Authorization": "Bearer admin-secret"}
+
+
+######################################################################
+#        M E M O R Y   T E S T   C A S E S
+######################################################################
+class TestMemory(TestCase):
+    """Memory Admin Endpoint Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+
+    def setUp(self):
+        """Runs before each test"""
+        app.config["ADMIN_TOKEN"] = "admin-secret"
+        self.client = app.test_client()
+        db.session.query(Shopcart).delete()  # clean up the last tests
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        app.config["ADMIN_TOKEN"] = None
+        memory.snapshots.clear()
+        db.session.remove()
+
+    def test_admin_token_required(self):
+        """It should hide admin endpoints without a token and reject bad ones"""
+        self.assertEqual(self.client.get("/admin/memory").status_code, 401)
+        resp = self.client.get("/admin/memory", headers={"Authorization": "Bearer wrong"})
+        self.assertEqual(resp.status_code, 401)
+        app.config["ADMIN_TOKEN"] = None
+        self.assertEqual(self.client.get("/admin/memory", headers=ADMIN_HEADERS).status_code, 404)
+
+    def test_memory_report(self):
+        """It should report RSS, live model objects and identity maps"""
+        shopcart = ShopcartFactory()
+        items = [ItemFactory(shopcart=None) for _ in range(3)]
+        shopcart.items = list(items)
+        shopcart.create()
+        resp = self.client.get("/admin/memory", headers=ADMIN_HEADERS)
+        self.assertEqual(resp.status_code, 200)
+        report = resp.get_json()
+        self.assertGreater(report["rss_bytes"], 0)
+        self.assertGreaterEqual(report["peak_rss_bytes"], report["rss_bytes"])
+        self.assertGreaterEqual(report["live_objects"]["Shopcart"], 1)
+        self.assertGreaterEqual(report["live_objects"]["Item"], 3)
+        self.assertGreaterEqual(max(report["identity_maps"]), 4)
+        self.assertFalse(report["tracemalloc"])
+        self.assertNotIn("top_allocations", report)
+        self.assertEqual(len(items), 3)
+
+    def test_snapshot_diff(self):
+        """It should take snapshots and compare them"""
+        resp = self.client.post("/admin/memory/snapshots", headers=ADMIN_HEADERS)
+        self.assertEqual(resp.status_code, 201)
+        first = resp.get_json()["id"]
+        self.assertTrue(tracemalloc.is_tracing())
+        hoard = [bytearray(1024) for _ in range(100)]
+        second = self.client.post("/admin/memory/snapshots", headers=ADMIN_HEADERS).get_json()["id"]
+
+        resp = self.client.get(f"/admin/memory/snapshots/{first}/diff/{second}?limit=5", headers=ADMIN_HEADERS)
+        self.assertEqual(resp.status_code, 200)
+        diff = resp.get_json()["diff"]
+        self.assertLessEqual(len(diff), 5)
+        self.assertTrue(any("test_memory.py:" in site["site"] for site in diff))
+        self.assertEqual(len(hoard), 100)
+
+        report = self.client.get("/admin/memory?limit=3", headers=ADMIN_HEADERS).get_json()
+        self.assertTrue(report["tracemalloc"])
+        self.assertEqual(report["snapshots"], [first, second])
+        self.assertLessEqual(len(report["top_allocations"]), 3)
+
+        resp = self.client.delete("/admin/memory/snapshots", headers=ADMIN_HEADERS)
+        self.assertEqual(resp.status_code, 204)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_snapshot_limit(self):
+        """It should keep only the newest snapshots"""
+        app.config["MEMORY_MAX_SNAPSHOTS"] = 2
+        try:
+            ids = [self.client.post("/admin/memory/snapshots", headers=ADMIN_HEADERS).get_json()["id"] for _ in range(3)]
+        finally:
+            app.config["MEMORY_MAX_SNAPSHOTS"] = 10
+        self.assertEqual(memory.snapshots.ids(), ids[1:])
+        self.assertIsNone(memory.snapshots.get(ids[0]))
+        resp = self.client.get(f"/admin/memory/snapshots/{ids[0]}/diff/{ids[2]}", headers=ADMIN_HEADERS)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_diff_missing_snapshot(self):
+        """It should return 404 for snapshots that do not exist"""
+        resp = self.client.get("/admin/memory/snapshots/1/diff/2", headers=ADMIN_HEADERS)
+        self.assertEqual(resp.status_code, 404)
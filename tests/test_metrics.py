@@ -0,0 +1,240 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Prometheus metrics
+"""
+
+# pylint: disable=duplicate-code
+import json
+import logging
+import os
+import re
+import runpy
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy.exc import DBAPIError
+from wsgi import app
+from service import config
+from service.common import metrics
+from service.common.metrics import Registry, Counter, Gauge, Histogram
+from service.models import db, Shopcart, upgrade
+from tests.factories import ShopcartFactory
+
+
+######################################################################
+#        R E G I S T R Y   T E S T   C A S E S
+######################################################################
+class TestRegistry(TestCase):
+    """Metrics Registry Tests"""
+
+    def setUp(self):
+        self.registry = Registry()
+        self.counter = Counter(self.registry, "test_total", "A counter", ("kind",))
+        self.gauge = Gauge(self.registry, "test_gauge", "A gauge")
+        self.histogram = Histogram(self.registry, "test_seconds", "A histogram", buckets=(0.1, 1.0))
+
+    def test_render(self):
+        """It should render metrics in the Prometheus text format"""
+        self.counter.inc(kind='say "hi"\n')
+        self.counter.inc(2, kind='say "hi"\n')
+        self.gauge.set(3)
+        self.histogram.observe(0.05)
+        self.histogram.observe(0.5)
+        self.histogram.observe(5)
+        text = self.registry.render()
+        self.assertIn("# TYPE test_total counter", text)
+        self.assertIn('test_total{kind="say \\"hi\\"\\n"} 3.0', text)
+        self.assertIn("test_gauge 3.0", text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1.0', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2.0', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3.0', text)
+        self.assertIn("test_seconds_sum 5.55", text)
+        self.assertIn("test_seconds_count 3.0", text)
+        self.assertEqual(self.counter.get(kind="other"), None)
+
+    def test_merge_snapshots(self):
+        """It should add up the snapshots of live and exited workers"""
+        self.counter.inc(kind="a")
+        self.gauge.set(2)
+        self.histogram.observe(0.5)
+        with tempfile.TemporaryDirectory() as directory:
+            metrics.write_snapshot(self.registry, directory)
+            snapshot = {"pid": 2 ** 22 + 1, "metrics": self.registry.snapshot()}
+            with open(os.path.join(directory, "metrics-dead.json"), "w", encoding="utf-8") as dead:
+                json.dump(snapshot, dead)
+            with open(os.path.join(directory, "metrics-bad.json"), "w", encoding="utf-8") as bad:
+                bad.write("{")
+            merged = dict(
+                (name, dict((tuple(labels), value) for labels, value in rows))
+                for name, rows in metrics.merge_snapshots(self.registry, directory).items()
+            )
+        self.assertEqual(merged["test_total"][("a",)], 2)
+        # the gauge of the exited worker is dropped
+        self.assertEqual(merged["test_gauge"][()], 2)
+        self.assertEqual(merged["test_seconds"][()], [0, 2, 0, 1.0])
+
+    def merged(self, directory: str) -> dict:
+        """Returns merge_snapshots() as {name: {labels: value}}"""
+        return {
+            name: {tuple(labels): value for labels, value in rows}
+            for name, rows in metrics.merge_snapshots(self.registry, directory).items()
+        }
+
+    def test_merge_exited_worker(self):
+        """It should fold the snapshot of an exited worker into the exited totals and remove it"""
+        self.counter.inc(kind="a")
+        self.gauge.set(2)
+        self.histogram.observe(0.5)
+        dead = 2 ** 22 + 1
+        snapshot = {"pid": dead, "metrics": self.registry.snapshot()}
+        with tempfile.TemporaryDirectory() as directory:
+            metrics.write_snapshot(self.registry, directory)
+            for number in range(2):
+                with open(os.path.join(directory, f"metrics-{dead}-{number}.json"), "w", encoding="utf-8") as file:
+                    json.dump(snapshot, file)
+            metrics.merge_exited_worker(self.registry, directory, dead)
+            metrics.merge_exited_worker(self.registry, directory, dead + 1)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted([metrics.EXITED_FILE, os.path.basename(metrics.snapshot_path(directory))]))
+            merged = self.merged(directory)
+            self.assertEqual(merged["test_total"][("a",)], 3)
+            self.assertEqual(merged["test_gauge"][()], 2)
+            self.assertEqual(merged["test_seconds"][()], [0, 3, 0, 1.5])
+            # a new worker with the same pid starts a snapshot of its own
+            with open(os.path.join(directory, f"metrics-{dead}-2.json"), "w", encoding="utf-8") as file:
+                json.dump(snapshot, file)
+            self.assertEqual(self.merged(directory)["test_total"][("a",)], 4)
+            # a snapshot that is already in the totals is not counted twice before it is removed
+            with open(os.path.join(directory, metrics.EXITED_FILE), encoding="utf-8") as file:
+                exited = json.load(file)
+            exited["merged"].append(f"metrics-{dead}-2.json")
+            with open(os.path.join(directory, metrics.EXITED_FILE), "w", encoding="utf-8") as file:
+                json.dump(exited, file)
+            self.assertEqual(self.merged(directory)["test_total"][("a",)], 3)
+
+    def test_snapshot_path(self):
+        """It should name the snapshot after the process, not only its pid"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = metrics.snapshot_path(directory)
+            self.assertRegex(os.path.basename(path), rf"^metrics-{os.getpid()}-[0-9a-f]+\.json$")
+            self.assertEqual(metrics.snapshot_path(directory), path)
+            with patch("os.getpid", return_value=1):
+                self.assertTrue(os.path.basename(metrics.snapshot_path(directory)).startswith("metrics-1-"))
+            self.assertNotEqual(metrics.snapshot_path(directory), path)
+
+    def test_gunicorn_child_exit(self):
+        """It should merge a worker's metrics when gunicorn reports that it exited"""
+        settings = runpy.run_path(os.path.join(os.path.dirname(__file__), "..", "gunicorn.conf.py"))
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "metrics-7-1.json"), "w", encoding="utf-8") as file:
+                json.dump({"pid": 7, "metrics": {}}, file)
+            settings["child_exit"](None, SimpleNamespace(pid=7))
+            self.assertEqual(os.listdir(directory), ["metrics-7-1.json"])
+            with patch.object(config, "PROMETHEUS_MULTIPROC_DIR", directory):
+                settings["child_exit"](None, SimpleNamespace(pid=7))
+            self.assertEqual(os.listdir(directory), [metrics.EXITED_FILE])
+
+    def test_statement_operation(self):
+        """It should find the SQL verb of a statement"""
+        self.assertEqual(metrics.statement_operation("  select 1"), "SELECT")
+        self.assertEqual(metrics.statement_operation(""), "UNKNOWN")
+
+
+######################################################################
+#        E N D P O I N T   T E S T   C A S E S
+######################################################################
+class TestMetricsEndpoint(TestCase):
+    """Metrics Endpoint Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Shopcart).delete()  # clean up the last tests
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+        app.config["PROMETHEUS_MULTIPROC_DIR"] = None
+
+    def test_request_metrics(self):
+        """It should count requests and their latency per resource"""
+        before = metrics.HTTP_REQUESTS.get(resource="ShopcartCollection", method="GET", status=200) or 0
+        self.client.get("/api/shopcarts")
+        self.client.get("/no/such/page")
+        after = metrics.HTTP_REQUESTS.get(resource="ShopcartCollection", method="GET", status=200)
+        self.assertEqual(after, before + 1)
+        self.assertIsNotNone(metrics.HTTP_REQUESTS.get(resource="unmatched", method="GET", status=404))
+        self.assertIsNotNone(metrics.HTTP_LATENCY.get(resource="ShopcartCollection", method="GET"))
+
+    def test_database_metrics(self):
+        """It should count queries, statement cache lookups and pool checkouts"""
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        self.client.get(f"/api/shopcarts/{shopcart.id}")
+        self.assertGreater(metrics.DB_QUERIES.get(operation="SELECT"), 0)
+        self.assertIsNotNone(metrics.DB_QUERY_LATENCY.get(operation="INSERT"))
+        self.assertGreater(metrics.DB_STATEMENT_CACHE.get(result="hit") or 0, 0)
+        self.assertIsNotNone(metrics.DB_POOL_CHECKOUT.get())
+
+    def test_failed_statements(self):
+        """It should not keep the timing of statements that fail"""
+        with db.engine.connect() as connection:
+            self.assertRaises(DBAPIError, connection.execute, db.text("SELECT 1/0"))
+            connection.rollback()
+            before = metrics.DB_QUERIES.get(operation="SELECT")
+            connection.execute(db.text("SELECT 1"))
+            self.assertEqual(metrics.DB_QUERIES.get(operation="SELECT"), before + 1)
+            self.assertNotIn("statement_timing_start", connection.info)
+
+    def test_metrics_endpoint(self):
+        """It should serve the metrics as Prometheus text"""
+        self.client.get("/health")
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, metrics.CONTENT_TYPE)
+        text = resp.get_data(as_text=True)
+        self.assertIn('shopcarts_http_requests_total{resource="health_check",method="GET",status="200"}', text)
+        self.assertIn('shopcarts_db_pool_connections{state="checked_out"}', text)
+
+    def test_metrics_endpoint_multiprocess(self):
+        """It should report the snapshots of every worker"""
+        with tempfile.TemporaryDirectory() as directory:
+            app.config["PROMETHEUS_MULTIPROC_DIR"] = directory
+            metrics._flush_state["last"] = 0.0  # pylint: disable=protected-access
+            self.client.get("/health")
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertTrue(re.match(rf"metrics-{os.getpid()}-[0-9a-f]+\.json$", os.listdir(directory)[0]))
+            resp = self.client.get("/metrics")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("shopcarts_http_requests_total", resp.get_data(as_text=True))
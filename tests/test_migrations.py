@@ -0,0 +1,93 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the schema migrations
+"""
+
+# pylint: disable=duplicate-code
+import logging
+from unittest import TestCase
+from sqlalchemy import create_engine
+from wsgi import app
+from service.models import db, upgrade, current_version
+from service.models.migrations import _create_from_models, head, schema_version
+
+
+######################################################################
+#        M I G R A T I O N   T E S T   C A S E S
+######################################################################
+class TestMigrations(TestCase):
+    """Schema Migration Test Cases"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    @classmethod
+    def tearDownClass(cls):
+        """This runs once after the entire test suite"""
+        upgrade()
+        db.session.close()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_upgrade_from_empty_database(self):
+        """It should build the whole schema from an empty database"""
+        db.drop_all()
+        self.assertEqual(current_version(), 0)
+        applied = upgrade()
+        self.assertEqual(applied[-1], head())
+        self.assertEqual(current_version(), head())
+        inspector = db.inspect(db.engine)
+        self.assertTrue(inspector.has_table("shopcart"))
+        self.assertTrue(inspector.has_table("item"))
+
+    def test_upgrade_is_idempotent(self):
+        """It should not apply a migration twice"""
+        upgrade()
+        self.assertEqual(upgrade(), [])
+        self.assertEqual(current_version(), head())
+
+    def test_upgrade_to_target(self):
+        """It should stop at the target version"""
+        db.drop_all()
+        self.assertEqual(upgrade(target=0), [])
+        self.assertEqual(current_version(), 0)
+
+    def test_adopt_existing_schema(self):
+        """It should adopt tables created before migrations existed"""
+        db.drop_all()
+        db.create_all()
+        self.assertEqual(current_version(), 0)
+        upgrade()
+        self.assertEqual(current_version(), head())
+
+    def test_other_databases_use_the_models(self):
+        """It should build a SQLite schema from the models and record it"""
+        engine = create_engine("sqlite://")
+        with engine.begin() as conn:
+            schema_version.create(conn)
+            self.assertEqual(_create_from_models(conn, head()), list(range(1, head() + 1)))
+            self.assertEqual(current_version(conn), head())
+            self.assertTrue(db.inspect(conn).has_table("item"))
+            self.assertEqual(_create_from_models(conn, head()), [])
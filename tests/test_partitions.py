@@ -0,0 +1,238 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the table partitioning
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import os
+from datetime import datetime, timezone
+from unittest import TestCase
+from unittest.mock import patch
+from click.testing import CliRunner
+from sqlalchemy import create_engine, text
+from wsgi import app
+from service.common import partitions
+from service.common.cli_commands import (
+    partition_tables, list_partitions, roll_partitions, drop_partitions
+)
+from service.models import db, Shopcart, Item, upgrade
+from tests.factories import ShopcartFactory, ItemFactory
+
+BASE_URL = "/api/shopcarts"
+LAST_MONTH = datetime(2024, 1, 15, tzinfo=timezone.utc)
+THIS_MONTH = datetime(2024, 2, 15, tzinfo=timezone.utc)
+
+
+def make_carts(count: int) -> list:
+    """Creates carts with an item each and returns their ids"""
+    ids = []
+    for _ in range(count):
+        shopcart = ShopcartFactory()
+        shopcart.items = [ItemFactory(shopcart=None)]
+        shopcart.create()
+        ids.append(shopcart.id)
+    return ids
+
+
+######################################################################
+#        P A R T I T I O N   T E S T   C A S E S
+######################################################################
+class TestPartitions(TestCase):
+    """Table Partitioning Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Item).delete()
+        db.session.query(Shopcart).delete()
+        db.session.commit()
+        db.session.remove()
+
+    def tearDown(self):
+        """Puts the plain tables back after each test"""
+        db.session.remove()
+        with db.engine.connect() as connection:
+            if partitions.current_layout(connection) != "none":
+                connection.rollback()
+                partitions.convert(connection, "none")
+
+    def indexes(self, connection) -> set:
+        """Returns the names of the indexes on shopcart and item"""
+        return set(connection.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename IN ('shopcart', 'item')"
+        )).scalars())
+
+    def test_month_layout(self):
+        """It should keep the rows, keys, indexes and triggers when partitioning by month"""
+        ids = make_carts(3)
+        db.session.remove()
+        with db.engine.connect() as connection:
+            before = self.indexes(connection)
+            connection.rollback()
+            partitions.convert(connection, "month", capacity=1000, now=LAST_MONTH)
+            self.assertEqual(partitions.current_layout(connection), "month")
+            self.assertEqual(self.indexes(connection), before)
+            found = partitions.list_partitions(connection)
+        self.assertEqual([(p.name, p.month, p.start, p.end is None) for p in found], [
+            ("shopcart_pdefault", None, None, True), ("shopcart_p2024_01", "2024-01", None, False),
+        ])
+        self.assertEqual(sorted(s.id for s in Shopcart.all()), ids)
+        resp = self.client.post(BASE_URL, json={"name": "routed", "items": []})
+        self.assertEqual(resp.status_code, 201)
+        shopcart_id = resp.get_json()["id"]
+        item = ItemFactory(shopcart=None, shopcart_id=shopcart_id).serialize()
+        resp = self.client.post(f"{BASE_URL}/{shopcart_id}/items", json=item)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{shopcart_id}").get_json()["items"][0]["item_id"],
+                         str(item["item_id"]))
+        self.assertEqual(self.client.delete(f"{BASE_URL}/{ids[0]}").status_code, 204)
+        with db.engine.connect() as connection:
+            with self.assertRaises(partitions.PartitionError):
+                partitions.convert(connection, "month")
+            self.assertRaises(partitions.PartitionError, partitions.convert, connection, "list")
+
+    def test_roll_and_drop(self):
+        """It should open a partition for a new month and drop the old ones"""
+        old = make_carts(2)
+        db.session.remove()
+        with db.engine.connect() as connection:
+            partitions.convert(connection, "month", capacity=1000, now=LAST_MONTH)
+            self.assertIsNone(partitions.roll_partition(connection, 1000, now=LAST_MONTH))
+            self.assertEqual(partitions.roll_partition(connection, 500, now=THIS_MONTH), "shopcart_p2024_02")
+            self.assertEqual(partitions.roll_partition(connection, 500, headroom=1.0, now=THIS_MONTH),
+                             "shopcart_p2024_02_2")
+            newest = partitions.list_partitions(connection)[-1]
+            self.assertEqual(partitions.next_id(connection), newest.start)
+            connection.rollback()
+        new = make_carts(2)
+        self.assertTrue(all(newest.start <= shopcart_id < newest.end for shopcart_id in new))
+        db.session.remove()
+        with db.engine.connect() as connection:
+            removed = partitions.drop_partitions(connection, "2024-02")
+            self.assertEqual(removed, ["shopcart_p2024_01"])
+            self.assertEqual(len(partitions.list_partitions(connection)), 3)
+        self.assertEqual(sorted(s.id for s in Shopcart.all()), new)
+        self.assertEqual(Item.query.count(), 2)
+        self.assertNotIn(old[0], [s.id for s in Shopcart.all()])
+
+    def test_overflow(self):
+        """It should keep carts past the newest range in the DEFAULT partition until the next roll"""
+        make_carts(1)
+        db.session.remove()
+        with db.engine.connect() as connection:
+            partitions.convert(connection, "month", capacity=2, now=LAST_MONTH)
+            first = partitions.list_partitions(connection)[-1]
+            connection.rollback()
+        overflow = make_carts(5)
+        db.session.remove()
+        self.assertGreaterEqual(overflow[-1], first.end)
+        with db.engine.connect() as connection:
+            with self.assertLogs("flask.app", "WARNING") as logs:
+                name = partitions.roll_partition(connection, 2, now=LAST_MONTH)
+            self.assertEqual(name, "shopcart_p2024_01_2")
+            self.assertIn(f"up to id {overflow[-1]}", logs.output[0])
+            newest = partitions.list_partitions(connection)[-1]
+            self.assertEqual((newest.start, newest.end), (first.end, overflow[-1] + 1))
+            self.assertEqual(partitions.next_id(connection), overflow[-1] + 1)
+            self.assertEqual(connection.execute(text("SELECT count(*) FROM shopcart_pdefault")).scalar(), 0)
+            counts = dict(connection.execute(text(
+                "SELECT tableoid::regclass::text, count(*) FROM item WHERE shopcart_id >= :start GROUP BY 1"
+            ), {"start": first.end}).all())
+            connection.rollback()
+        self.assertEqual(counts, {"item_p2024_01_2": sum(1 for cart in overflow if cart >= first.end)})
+        new = make_carts(1)
+        self.assertEqual(self.client.get(f"{BASE_URL}/{overflow[-1]}").status_code, 200)
+        self.assertGreater(new[0], overflow[-1])
+
+    def test_drop_needs_a_month(self):
+        """It should only drop partitions before a month written as YYYY-MM"""
+        with db.engine.connect() as connection:
+            partitions.convert(connection, "month", capacity=1000, now=LAST_MONTH)
+            for before in ("2024", "2024-13", "2024-1-1", "June"):
+                self.assertRaises(partitions.PartitionError, partitions.drop_partitions, connection, before)
+            self.assertEqual(partitions.drop_partitions(connection, "2999-1"), [])
+
+    def test_hash_layout(self):
+        """It should spread carts and their items over hash partitions"""
+        ids = make_carts(8)
+        db.session.remove()
+        with db.engine.connect() as connection:
+            partitions.convert(connection, "hash", count=4)
+            self.assertEqual(partitions.current_layout(connection), "hash")
+            found = partitions.list_partitions(connection)
+            self.assertEqual([p.remainder for p in found], [0, 1, 2, 3])
+            connection.rollback()
+            with self.assertRaises(partitions.PartitionError):
+                partitions.roll_partition(connection)
+            connection.rollback()
+            counts = connection.execute(text(
+                "SELECT tableoid::regclass::text, count(*) FROM item GROUP BY 1"
+            )).all()
+        self.assertEqual(sum(count for _, count in counts), 8)
+        self.assertTrue(all(name.startswith("item_h") for name, _ in counts))
+        self.assertEqual(sorted(s.id for s in Shopcart.all()), ids)
+
+    def test_needs_postgres(self):
+        """It should refuse to partition other databases"""
+        with create_engine("sqlite://").connect() as connection:
+            self.assertRaises(partitions.PartitionError, partitions.current_layout, connection)
+
+    def test_partition_commands(self):
+        """It should manage partitions from the command line"""
+        make_carts(1)
+        db.session.remove()
+        runner = CliRunner()
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = runner.invoke(drop_partitions, ["--before", "2024-01"])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn("do not have the month layout", result.output)
+            result = runner.invoke(partition_tables, ["--layout", "month", "--capacity", "1000"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            result = runner.invoke(partition_tables, ["--layout", "month"])
+            self.assertIn("already have the month layout", result.output)
+            result = runner.invoke(roll_partitions, ["--headroom", "1"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Opened partition", result.output)
+            result = runner.invoke(roll_partitions, [])
+            self.assertIn("The newest partition is current", result.output)
+            result = runner.invoke(list_partitions, [])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Layout: month", result.output)
+            self.assertIn("ids MINVALUE to", result.output)
+            self.assertIn("shopcart_pdefault  ids past the newest range", result.output)
+            result = runner.invoke(drop_partitions, ["--before", "2999-01", "--detach-only"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Detached 1 partitions: shopcart_p", result.output)
+            detached = result.output.split(": ")[1].strip()
+            with db.engine.begin() as connection:
+                connection.execute(text(f"DROP TABLE {detached.replace('shopcart', 'item')}, {detached}"))
+            result = runner.invoke(partition_tables, ["--layout", "hash", "--count", "2"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            result = runner.invoke(list_partitions, [])
+            self.assertIn("Layout: hash", result.output)
+            self.assertIn("shopcart_h1  remainder 1", result.output)
@@ -0,0 +1,201 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for request profiling
+"""
+
+# pylint: disable=duplicate-code
+import json
+import logging
+import os
+import pstats
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+import service
+from service import create_app
+from service.common.profiling import ProfilerMiddleware, SpeedscopeProfiler
+from service.models import db, upgrade
+from wsgi import app
+
+ADMIN_HEADERS = {"Authorization": "Bearer admin-secret"}
+
+
+######################################################################
+#        P R O F I L I N G   T E S T   C A S E S
+######################################################################
+class TestProfiling(TestCase):
+    """Request Profiling Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.middleware = ProfilerMiddleware(app.wsgi_app, self.directory.name, token="secret")
+        self.client = Client(self.middleware, Response)
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.directory.cleanup()
+        db.session.remove()
+
+    def test_profile_with_token(self):
+        """It should save a pstats profile when the request sends the token"""
+        resp = self.client.get("/api/shopcarts", headers={"X-Profile": "secret"})
+        self.assertEqual(resp.status_code, 200)
+        name = resp.headers["X-Profile-File"]
+        self.assertTrue(name.endswith("-GET-api.shopcarts.prof"))
+        stats = pstats.Stats(os.path.join(self.directory.name, name))
+        functions = [function for _, _, function in stats.stats]
+        self.assertIn("get", functions)
+
+    def test_profile_speedscope(self):
+        """It should save a speedscope profile when asked for one"""
+        resp = self.client.get("/health", headers={"X-Profile": "secret", "X-Profile-Format": "speedscope"})
+        self.assertEqual(resp.get_json()["message"], "Healthy")
+        with open(os.path.join(self.directory.name, resp.headers["X-Profile-File"]), encoding="utf-8") as file:
+            document = json.load(file)
+        profile = document["profiles"][0]
+        self.assertEqual(profile["type"], "evented")
+        names = [frame["name"] for frame in document["shared"]["frames"]]
+        self.assertIn("health_check", names)
+        opened = sum(1 for event in profile["events"] if event["type"] == "O")
+        self.assertEqual(opened * 2, len(profile["events"]))
+
+    def test_unknown_format_uses_default(self):
+        """It should fall back to the default format"""
+        resp = self.client.get("/health", headers={"X-Profile": "secret", "X-Profile-Format": "bogus"})
+        self.assertTrue(resp.headers["X-Profile-File"].endswith(".prof"))
+
+    def test_wrong_token(self):
+        """It should not profile requests without the right token"""
+        resp = self.client.get("/health", headers={"X-Profile": "wrong"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("X-Profile-File", resp.headers)
+        self.assertEqual(os.listdir(self.directory.name), [])
+        self.middleware.token = None
+        self.assertFalse(self.middleware.should_profile({"HTTP_X_PROFILE": ""}))
+
+    def test_sampling(self):
+        """It should profile a sample of the requests"""
+        self.middleware.sample_rate = 1.0
+        resp = self.client.get("/")
+        self.assertTrue(resp.headers["X-Profile-File"].endswith("-GET-root.prof"))
+        self.middleware.sample_rate = 0.0
+        self.assertNotIn("X-Profile-File", self.client.get("/").headers)
+
+    def test_event_streams_are_not_profiled(self):
+        """It should never profile an event stream, which does not end"""
+        self.middleware.sample_rate = 1.0
+        self.assertFalse(self.middleware.should_profile({"PATH_INFO": "/api/shopcarts/1/stream"}))
+
+    def test_streamed_responses(self):
+        """It should pass a streamed body through and save its profile when it is closed"""
+
+        def endless():
+            while True:
+                yield b"{}\n"
+
+        def streaming_app(environ, start_response):  # pylint: disable=unused-argument
+            start_response("200 OK", [("Content-Type", "application/x-ndjson")])
+            return endless()
+
+        self.middleware.wsgi_app = streaming_app
+        resp = self.client.get("/admin/export", headers={"X-Profile": "secret"})
+        chunks = resp.iter_encoded()
+        self.assertEqual([next(chunks) for _ in range(3)], [b"{}\n"] * 3)
+        self.assertEqual(os.listdir(self.directory.name), [])
+        self.assertTrue(self.middleware.lock.locked())
+        resp.close()
+        self.assertEqual(os.listdir(self.directory.name), [resp.headers["X-Profile-File"]])
+        self.assertFalse(self.middleware.lock.locked())
+
+    def test_one_profile_at_a_time(self):
+        """It should serve requests without a profile while another request is profiled"""
+        with self.middleware.lock:
+            resp = self.client.get("/health", headers={"X-Profile": "secret"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("X-Profile-File", resp.headers)
+        self.assertIn("X-Profile-Skipped", resp.headers)
+        self.assertEqual(os.listdir(self.directory.name), [])
+        self.assertIn("X-Profile-File", self.client.get("/health", headers={"X-Profile": "secret"}).headers)
+        self.assertFalse(self.middleware.lock.locked())
+
+    def test_failed_requests_release_the_profiler(self):
+        """It should let the next request be profiled after one that raised"""
+
+        def failing_app(environ, start_response):  # pylint: disable=unused-argument
+            raise RuntimeError("boom")
+
+        self.middleware.wsgi_app = failing_app
+        self.assertRaises(RuntimeError, self.client.get, "/", headers={"X-Profile": "secret"})
+        self.assertFalse(self.middleware.lock.locked())
+
+    def test_download_profiles(self):
+        """It should list and serve the saved profiles to admins"""
+        name = self.client.get("/health", headers={"X-Profile": "secret"}).headers["X-Profile-File"]
+        client = app.test_client()
+        with patch.dict(app.config, {"ADMIN_TOKEN": "admin-secret", "PROFILE_DIR": self.directory.name}):
+            self.assertEqual(client.get("/admin/profiles").status_code, 401)
+            self.assertEqual(client.get("/admin/profiles", headers=ADMIN_HEADERS).get_json(), {"profiles": [name]})
+            resp = client.get(f"/admin/profiles/{name}", headers=ADMIN_HEADERS)
+            self.assertEqual(resp.status_code, 200)
+            with open(os.path.join(self.directory.name, name), "rb") as profile_file:
+                self.assertEqual(resp.data, profile_file.read())
+            resp.close()
+            self.assertEqual(client.get("/admin/profiles/missing.prof", headers=ADMIN_HEADERS).status_code, 404)
+            self.assertEqual(client.get("/admin/profiles/..%2Fsecret", headers=ADMIN_HEADERS).status_code, 404)
+            app.config["PROFILE_DIR"] = os.path.join(self.directory.name, "none")
+            self.assertEqual(client.get("/admin/profiles", headers=ADMIN_HEADERS).get_json(), {"profiles": []})
+
+    def test_speedscope_closes_open_frames(self):
+        """It should close the frames still open when it stops"""
+        profiler = SpeedscopeProfiler()
+        profiler.enable()
+        len([])
+        profiler.disable()
+        self.assertEqual(profiler.events[-1]["type"], "C")
+        self.assertEqual(profiler.stack, [])
+
+    def test_create_app_installs_middleware(self):
+        """It should only wrap the app when profiling is configured"""
+        real_api = service.api
+        try:
+            # leave admission control out so the profiler is the outermost layer
+            patch.multiple("service.config", ADMISSION_MAX_IN_FLIGHT=0, ADMISSION_MAX_READS=0,
+                           ADMISSION_MAX_WRITES=0).start()
+            self.assertNotIsInstance(create_app().wsgi_app, ProfilerMiddleware)
+            with patch("service.config.PROFILE_TOKEN", "secret"):
+                self.assertIsInstance(create_app().wsgi_app, ProfilerMiddleware)
+        finally:
+            patch.stopall()
+            service.api = real_api
@@ -0,0 +1,185 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the abandoned cart purge
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import patch
+from click.testing import CliRunner
+from sqlalchemy import create_engine, event, func, select, update
+from wsgi import app
+from service.common import purge
+from service.common.cli_commands import purge_carts as purge_command
+from service.models import db, Shopcart, Item, upgrade
+from tests.factories import ShopcartFactory, ItemFactory
+
+BASE_URL = "/api/shopcarts"
+
+
+def make_carts(count: int, items: int = 2) -> list:
+    """Creates carts with items and returns their ids"""
+    ids = []
+    for _ in range(count):
+        shopcart = ShopcartFactory()
+        shopcart.items = [ItemFactory(shopcart=None) for _ in range(items)]
+        shopcart.create()
+        ids.append(shopcart.id)
+    return ids
+
+
+def age(ids: list, days: float):
+    """Moves the last update of carts days into the past"""
+    db.session.execute(
+        update(Shopcart).where(Shopcart.id.in_(ids)).values(updated_at=func.now() - timedelta(days=days))
+    )
+    db.session.commit()
+
+
+######################################################################
+#        P U R G E   T E S T   C A S E S
+######################################################################
+class TestPurge(TestCase):
+    """Abandoned Cart Purge Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Item).delete()
+        db.session.query(Shopcart).delete()
+        db.session.execute(purge.shopcart_archive.delete())
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def updated_at(self, shopcart_id: int) -> datetime:
+        """Returns when a cart was last updated"""
+        return db.session.scalar(select(Shopcart.updated_at).where(Shopcart.id == shopcart_id))
+
+    def test_timestamps(self):
+        """It should stamp new carts and touch them whenever they or their items change"""
+        shopcart_id = make_carts(1)[0]
+        shopcart = db.session.get(Shopcart, shopcart_id)
+        self.assertIsNotNone(shopcart.created_at)
+        self.assertEqual(shopcart.created_at, shopcart.updated_at)
+        age([shopcart_id], 1)
+        item = ItemFactory(shopcart=None, shopcart_id=shopcart_id).serialize()
+        resp = self.client.post(f"{BASE_URL}/{shopcart_id}/items", json=item)
+        self.assertEqual(resp.status_code, 201)
+        self.assertGreater(self.updated_at(shopcart_id), datetime.now(timezone.utc) - timedelta(minutes=1))
+        age([shopcart_id], 1)
+        self.client.delete(f"{BASE_URL}/{shopcart_id}/items/{resp.get_json()['id']}")
+        self.assertGreater(self.updated_at(shopcart_id), datetime.now(timezone.utc) - timedelta(minutes=1))
+        age([shopcart_id], 1)
+        self.client.put(f"{BASE_URL}/{shopcart_id}", json={"name": "renamed", "items": []})
+        self.assertGreater(self.updated_at(shopcart_id), datetime.now(timezone.utc) - timedelta(minutes=1))
+
+    def test_purge_in_batches(self):
+        """It should archive and delete abandoned carts a batch at a time"""
+        stale, fresh = make_carts(5), make_carts(2)
+        age(stale, 40)
+        age(fresh[:1], 10)
+        progress = []
+        with db.engine.connect() as connection:
+            cutoff = purge.cutoff_for(30)
+            self.assertEqual(purge.count_stale(connection, cutoff), 5)
+            connection.rollback()
+            totals = purge.purge_carts(connection, cutoff, batch_size=2, progress=progress.append)
+        self.assertEqual((totals["shopcarts"], totals["items"], totals["batches"]), (5, 10, 3))
+        self.assertEqual(len(progress), 3)
+        self.assertEqual(sorted(db.session.scalars(select(Shopcart.id))), fresh)
+        archived = db.session.execute(select(purge.shopcart_archive).order_by(purge.shopcart_archive.c.id)).all()
+        self.assertEqual([row.id for row in archived], stale)
+        self.assertEqual(len(archived[0].items), 2)
+        self.assertEqual(set(archived[0].items[0]), {"id", "item_id", "description", "quantity", "price"})
+        self.assertLess(archived[0].updated_at, cutoff)
+
+    def test_purge_does_not_touch_carts(self):
+        """It should not touch the carts whose items it deletes"""
+        stale = make_carts(2)
+        age(stale, 40)
+        with db.engine.connect() as connection:
+            transaction = connection.begin()
+            connection.execute(db.text("SET LOCAL shopcarts.purging = on"))
+            connection.execute(Item.__table__.delete().where(Item.shopcart_id == stale[0]))
+            touched = connection.scalar(select(Shopcart.updated_at).where(Shopcart.id == stale[0]))
+            transaction.rollback()
+            self.assertLess(touched, purge.cutoff_for(30))
+            statements = []
+            event.listen(connection, "before_cursor_execute", lambda *args: statements.append(args[2]))
+            purge.purge_carts(connection, purge.cutoff_for(30))
+        purging = statements.index("SET LOCAL shopcarts.purging = on")
+        self.assertTrue(statements[purging + 1].startswith("DELETE FROM item"))
+        self.assertEqual(Shopcart.query.count(), 0)
+
+    def test_purge_is_resumable(self):
+        """It should stop after max_batches and carry on in the next run"""
+        age(make_carts(5, items=1), 40)
+        cutoff = purge.cutoff_for(30)
+        with db.engine.connect() as connection:
+            first = purge.purge_carts(connection, cutoff, batch_size=2, max_batches=1, pause=0.001)
+            second = purge.purge_carts(connection, cutoff, batch_size=2, archive=False)
+        self.assertEqual((first["shopcarts"], second["shopcarts"], second["batches"]), (2, 3, 2))
+        self.assertEqual(Shopcart.query.count(), 0)
+        self.assertEqual(db.session.scalar(select(func.count()).select_from(purge.shopcart_archive)), 2)
+
+    def test_purge_sqlite(self):
+        """It should purge databases without row locking"""
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine, tables=[Shopcart.__table__, Item.__table__, purge.shopcart_archive])
+        old = datetime.now(timezone.utc) - timedelta(days=40)
+        with engine.begin() as connection:
+            connection.execute(Shopcart.__table__.insert(), [{"name": "old", "created_at": old, "updated_at": old}])
+            connection.execute(Shopcart.__table__.insert(), [{"name": "new"}])
+            connection.execute(Item.__table__.insert(), [
+                {"shopcart_id": 1, "item_id": "a", "description": "apple", "quantity": 1, "price": 3}
+            ])
+        with engine.connect() as connection:
+            totals = purge.purge_carts(connection, purge.cutoff_for(30))
+            self.assertEqual((totals["shopcarts"], totals["items"]), (1, 1))
+            self.assertEqual(connection.execute(select(Shopcart.name)).scalars().all(), ["new"])
+            items = connection.execute(select(purge.shopcart_archive.c["items"])).scalar()
+            self.assertEqual(items[0]["item_id"], "a")
+
+    def test_purge_command(self):
+        """It should purge from the command line"""
+        age(make_carts(3), 10)
+        runner = CliRunner()
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = runner.invoke(purge_command, ["--dry-run"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("0 shopcarts were last updated", result.output)
+            result = runner.invoke(purge_command, ["--ttl-days", "7", "--batch-size", "2", "--no-archive"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Purged 3 shopcarts and 6 items", result.output)
+        self.assertEqual(Shopcart.query.count(), 0)
+        self.assertEqual(db.session.scalar(select(func.count()).select_from(purge.shopcart_archive)), 0)
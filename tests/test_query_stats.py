@@ -0,0 +1,161 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the per-request query statistics
+"""
+
+# pylint: disable=duplicate-code
+import logging
+from unittest import TestCase
+import pytest
+from sqlalchemy.exc import DBAPIError
+from wsgi import app
+from service.common.query_stats import QueryRecorder, statement_shape
+from service.models import db, Shopcart, upgrade
+from tests.factories import ShopcartFactory, ItemFactory
+
+BASE_URL = "/api/shopcarts"
+
+
+######################################################################
+#        Q U E R Y   S T A T S   T E S T   C A S E S
+######################################################################
+class TestQueryStats(TestCase):
+    """Query Statistics Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+
+    @pytest.fixture(autouse=True)
+    def _max_queries(self, max_queries):
+        """Makes the max_queries fixture available to the tests"""
+        self.max_queries = max_queries  # pylint: disable=attribute-defined-outside-init
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Shopcart).delete()  # clean up the last tests
+        db.session.commit()
+        shopcart = ShopcartFactory()
+        shopcart.items = [ItemFactory(shopcart=None) for _ in range(3)]
+        shopcart.create()
+        self.shopcart_id = shopcart.id
+        self.item_id = shopcart.items[0].id
+        db.session.remove()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_recorder(self):
+        """It should count statements and group them by shape"""
+        with QueryRecorder() as outer:
+            with QueryRecorder() as inner:
+                Shopcart.find(self.shopcart_id)
+            Shopcart.find(self.shopcart_id)
+        self.assertEqual(inner.count, 1)
+        self.assertEqual(outer.count, 2)
+        self.assertGreater(outer.duration, 0)
+        self.assertEqual(outer.repeated(1)[0][1], 2)
+        self.assertEqual(outer.repeated(2), [])
+        self.assertEqual(statement_shape(" SELECT 1\n  FROM  x "), "SELECT 1 FROM x")
+
+    def test_savepoints_are_not_queries(self):
+        """It should not count savepoints as queries"""
+        with QueryRecorder() as recorder:
+            with db.session.begin_nested():
+                Shopcart.find(self.shopcart_id)
+        self.assertEqual(recorder.count, 1)
+        db.session.rollback()
+
+    def test_failed_statements(self):
+        """It should only count the statements that complete"""
+        with QueryRecorder() as recorder, db.engine.connect() as connection:
+            self.assertRaises(DBAPIError, connection.execute, db.text("SELECT 1/0"))
+            connection.rollback()
+            connection.execute(db.text("SELECT 1"))
+            self.assertNotIn("statement_timing_start", connection.info)
+        self.assertEqual(recorder.count, 1)
+
+    def test_response_headers(self):
+        """It should report the query count and time in headers"""
+        resp = self.client.get(f"{BASE_URL}/{self.shopcart_id}")
+        self.assertEqual(resp.headers["X-Query-Count"], "2")
+        self.assertRegex(resp.headers["Server-Timing"], r'^db;dur=[0-9.]+;desc="2 queries"$')
+
+    def test_no_headers_in_production(self):
+        """It should not send the headers outside debug and testing mode"""
+        app.config["TESTING"] = False
+        try:
+            resp = self.client.get(f"{BASE_URL}/{self.shopcart_id}")
+        finally:
+            app.config["TESTING"] = True
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("X-Query-Count", resp.headers)
+
+    def test_repeated_statement_warning(self):
+        """It should warn when a statement repeats more than the threshold"""
+        app.config["QUERY_REPEAT_THRESHOLD"] = 2
+        try:
+            with self.assertLogs("flask.app", level="WARNING") as logs:
+                self.client.put(f"{BASE_URL}/{self.shopcart_id}/clear")
+        finally:
+            app.config["QUERY_REPEAT_THRESHOLD"] = 5
+        self.assertIn("Possible N+1", logs.output[0])
+
+    def test_read_query_budgets(self):
+        """It should read carts and items with a fixed number of queries"""
+        with self.max_queries(2):
+            self.client.get(f"{BASE_URL}/{self.shopcart_id}")
+        with self.max_queries(2):
+            self.client.get(BASE_URL)
+        with self.max_queries(2):
+            self.client.get(f"{BASE_URL}/{self.shopcart_id}/items")
+        with self.max_queries(1):
+            self.client.get(f"{BASE_URL}/{self.shopcart_id}/items/{self.item_id}")
+
+    def test_write_query_budgets(self):
+        """It should write carts and items with a fixed number of queries"""
+        # each write also inserts its outbox events with one statement
+        item = ItemFactory(shopcart=None, shopcart_id=self.shopcart_id).serialize()
+        with self.max_queries(5):
+            resp = self.client.post(f"{BASE_URL}/{self.shopcart_id}/items", json=item)
+        item_id = resp.get_json()["id"]
+        item["quantity"] = 9
+        with self.max_queries(4):
+            self.client.put(f"{BASE_URL}/{self.shopcart_id}/items/{item_id}", json=item)
+        with self.max_queries(4):
+            self.client.delete(f"{BASE_URL}/{self.shopcart_id}/items/{item_id}")
+        with self.max_queries(3):
+            self.client.delete(f"{BASE_URL}/{self.shopcart_id}")
+
+    def test_budget_failure(self):
+        """It should fail when a block runs more queries than allowed"""
+        with self.assertRaises(AssertionError):
+            with self.max_queries(1):
+                self.client.get(f"{BASE_URL}/{self.shopcart_id}")
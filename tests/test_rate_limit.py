@@ -0,0 +1,236 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for rate limiting
+"""
+
+# pylint: disable=duplicate-code
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from service import config
+from service.common import status
+from service.common.rate_limit import (
+    DatabaseStore, Limit, MemoryStore, RATE_LIMITED, RateLimiter,
+    init_rate_limit, parse_limit, rate_limit_bucket,
+)
+from service.models import db, upgrade
+from wsgi import app
+
+
+def make_app(**settings):
+    """Builds a bare Flask app with one rate limited endpoint"""
+    limited = Flask(__name__)
+    limited.config.from_object(config)
+    limited.config.update(TESTING=True, RATE_LIMITS={"ping": "2/minute"}, **settings)
+
+    @limited.route("/ping")
+    def ping():  # pylint: disable=unused-variable
+        return {"pong": True}
+
+    @limited.route("/other")
+    def other():  # pylint: disable=unused-variable
+        return {"other": True}
+
+    @limited.route("/livez")
+    def livez():  # pylint: disable=unused-variable
+        return {"status": "OK"}
+
+    init_rate_limit(limited)
+    return limited
+
+
+######################################################################
+#        R A T E   L I M I T   T E S T   C A S E S
+######################################################################
+class TestRateLimit(TestCase):
+    """Rate Limiting Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    def setUp(self):
+        """Runs before each test"""
+        db.session.execute(rate_limit_bucket.delete())
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    ######################################################################
+    #  P A R S I N G
+    ######################################################################
+
+    def test_parse_limit(self):
+        """It should parse limits with named and numeric periods"""
+        self.assertEqual(parse_limit("100/minute"), Limit(100, 60.0))
+        self.assertEqual(parse_limit("5/seconds"), Limit(5, 1.0))
+        self.assertEqual(parse_limit("10/30"), Limit(10, 30.0))
+        self.assertEqual(parse_limit("3"), Limit(3, 1.0))
+        for text in ("many/minute", "10/fortnight", "0/minute", "10/-1"):
+            with self.assertRaises(ValueError):
+                parse_limit(text)
+
+    ######################################################################
+    #  S T O R E S
+    ######################################################################
+
+    def assert_token_bucket(self, store):
+        """Checks that store empties and refills a bucket"""
+        self.assertEqual(store.consume("k", 2, 1.0, 100.0), (True, 1.0))
+        self.assertEqual(store.consume("k", 2, 1.0, 100.0), (True, 0.0))
+        self.assertEqual(store.consume("k", 2, 1.0, 100.0), (False, 0.0))
+        # half a second refills half a token, which is not enough
+        self.assertEqual(store.consume("k", 2, 1.0, 100.5), (False, 0.5))
+        self.assertEqual(store.consume("k", 2, 1.0, 101.0), (True, 0.0))
+        # a clock that went backwards refills nothing
+        self.assertEqual(store.consume("k", 2, 1.0, 99.0), (False, 0.0))
+        # refills stop at the capacity
+        self.assertEqual(store.consume("k", 2, 1.0, 500.0), (True, 1.0))
+        # other keys have their own buckets
+        self.assertEqual(store.consume("other", 2, 1.0, 101.0), (True, 1.0))
+
+    def test_memory_store(self):
+        """It should keep token buckets in memory"""
+        self.assert_token_bucket(MemoryStore())
+
+    def test_memory_store_prunes_full_buckets(self):
+        """It should drop refilled buckets when it holds too many"""
+        store = MemoryStore(max_keys=2)
+        store.consume("a", 2, 1.0, 0.0)
+        store.consume("b", 2, 1.0, 9.5)
+        store.consume("c", 2, 1.0, 10.0)
+        self.assertEqual(sorted(store.buckets), ["b", "c"])
+
+    def test_database_store(self):
+        """It should share token buckets through PostgreSQL"""
+        self.assert_token_bucket(DatabaseStore())
+
+    def test_database_store_sqlite_stand_in(self):
+        """It should work on SQLite as a local stand-in"""
+        engine = create_engine("sqlite://")
+        rate_limit_bucket.create(engine)
+        self.assert_token_bucket(DatabaseStore(engine))
+
+    def test_database_store_prunes_idle_buckets(self):
+        """It should delete buckets that have been idle too long"""
+        store = DatabaseStore(idle_seconds=60, prune_interval=10)
+        store.pruned_at = 0.0
+        store.consume("old", 2, 1.0, 0.0)
+        store.consume("new", 2, 1.0, 100.0)
+        keys = db.session.execute(db.select(rate_limit_bucket.c.key)).scalars().all()
+        self.assertEqual(keys, ["new"])
+
+    ######################################################################
+    #  L I M I T E R
+    ######################################################################
+
+    def test_limiter_decision(self):
+        """It should report the limit, remaining tokens and reset times"""
+        limiter = RateLimiter(MemoryStore(), {"ping": Limit(2, 60)})
+        self.assertIsNone(limiter.hit("pong", "ip:1", now=0))
+        decision = limiter.hit("ping", "ip:1", now=0)
+        self.assertEqual((decision.allowed, decision.limit, decision.remaining, decision.reset), (True, 2, 1, 30))
+        limiter.hit("ping", "ip:1", now=0)
+        decision = limiter.hit("ping", "ip:1", now=0)
+        self.assertFalse(decision.allowed)
+        self.assertEqual((decision.retry_after, decision.reset), (30, 60))
+
+    def test_limiter_fails_open(self):
+        """It should let requests through when the store is down"""
+        store = DatabaseStore()
+        limiter = RateLimiter(store, {}, Limit(1, 1))
+        with patch.object(store, "consume", side_effect=OperationalError("SELECT", {}, Exception("down"))):
+            self.assertIsNone(limiter.hit("ping", "ip:1"))
+
+    ######################################################################
+    #  F L A S K   I N T E G R A T I O N
+    ######################################################################
+
+    def test_rate_limit_responses(self):
+        """It should answer 429 with RateLimit headers once the bucket is empty"""
+        client = make_app().test_client()
+        resp = client.get("/ping")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["RateLimit-Limit"], "2")
+        self.assertEqual(resp.headers["RateLimit-Remaining"], "1")
+        self.assertEqual(resp.headers["RateLimit-Policy"], "2;w=60")
+        client.get("/ping")
+        limited = RATE_LIMITED.get(resource="ping") or 0
+        resp = client.get("/ping")
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(resp.get_json()["error"], "Too Many Requests")
+        self.assertEqual(resp.headers["RateLimit-Remaining"], "0")
+        self.assertIn(resp.headers["Retry-After"], ("29", "30"))
+        self.assertEqual(RATE_LIMITED.get(resource="ping"), limited + 1)
+        # unlimited endpoints are untouched
+        resp = client.get("/other")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn("RateLimit-Limit", resp.headers)
+
+    def test_clients_have_separate_buckets(self):
+        """It should key buckets by client header or address"""
+        client = make_app(RATE_LIMIT_CLIENT_HEADER="X-Client-Id", RATE_LIMIT_PROXY_COUNT=1).test_client()
+        for _ in range(2):
+            client.get("/ping", headers={"X-Client-Id": "alice"})
+        self.assertEqual(client.get("/ping", headers={"X-Client-Id": "alice"}).status_code, 429)
+        self.assertEqual(client.get("/ping", headers={"X-Client-Id": "bob"}).status_code, 200)
+        # behind one proxy the client is the last forwarded address
+        forwarded = {"X-Forwarded-For": "6.6.6.6, 10.0.0.1"}
+        self.assertEqual(client.get("/ping", headers=forwarded).status_code, 200)
+        self.assertEqual(client.get("/ping", headers=forwarded).status_code, 200)
+        self.assertEqual(client.get("/ping", headers=forwarded).status_code, 429)
+        self.assertEqual(client.get("/ping").status_code, 200)
+
+    def test_database_store_app(self):
+        """It should rate limit through the database store"""
+        limited = make_app(RATE_LIMIT_STORE="database", RATE_LIMIT_DEFAULT="1/hour")
+        db.init_app(limited)
+        client = limited.test_client()
+        self.assertEqual(client.get("/other").status_code, status.HTTP_200_OK)
+        self.assertEqual(client.get("/other").status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_probes_are_not_limited(self):
+        """It should never limit the exempt paths"""
+        client = make_app(RATE_LIMIT_DEFAULT="1/hour").test_client()
+        for _ in range(3):
+            resp = client.get("/livez")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertNotIn("RateLimit-Limit", resp.headers)
+        self.assertEqual(client.get("/other").status_code, status.HTTP_200_OK)
+        self.assertEqual(client.get("/other").status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_init_without_limits(self):
+        """It should not install the limiter when no limit is set"""
+        limited = Flask(__name__)
+        limited.config.from_object(config)
+        init_rate_limit(limited)
+        self.assertNotIn("rate_limit", limited.extensions)
+        limited.config["RATE_LIMIT_DEFAULT"] = "1/second"
+        limited.config["RATE_LIMIT_STORE"] = "redis"
+        with self.assertRaises(ValueError):
+            init_rate_limit(limited)
@@ -0,0 +1,135 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Shopcart and Item read models
+"""
+
+# pylint: disable=duplicate-code
+import logging
+from unittest import TestCase
+from wsgi import app
+from service.models import Shopcart, Item, ShopcartView, ItemView, db, upgrade
+from tests.factories import ShopcartFactory, ItemFactory
+
+
+######################################################################
+#        R E A D   M O D E L   T E S T   C A S E S
+######################################################################
+class TestReadModels(TestCase):
+    """Read Model Test Cases"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    @classmethod
+    def tearDownClass(cls):
+        """This runs once after the entire test suite"""
+        db.session.close()
+
+    def setUp(self):
+        """This runs before each test"""
+        db.session.query(Shopcart).delete()  # clean up the last tests
+        db.session.query(Item).delete()  # clean up the last tests
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def _create_shopcart(self, item_count=2, name=None):
+        """Creates a Shopcart with items through the ORM"""
+        shopcart = ShopcartFactory(name=name) if name else ShopcartFactory()
+        shopcart.items = [ItemFactory(shopcart=None) for _ in range(item_count)]
+        shopcart.create()
+        return shopcart
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    def test_find_shopcart(self):
+        """It should read a Shopcart and its items like the ORM model"""
+        shopcart = self._create_shopcart(3)
+        expected = Shopcart.find(shopcart.id).serialize()
+        db.session.expire_all()
+        view = ShopcartView.find(shopcart.id)
+        self.assertEqual(view.serialize(), expected)
+        self.assertEqual(len(view.items), 3)
+        self.assertIn(f"id=[{shopcart.id}]", repr(view))
+        self.assertIn(f"shopcart[{shopcart.id}]", repr(view.items[0]))
+
+    def test_find_shopcart_not_found(self):
+        """It should return None for a missing Shopcart"""
+        self.assertIsNone(ShopcartView.find(0))
+        self.assertFalse(ShopcartView.exists(0))
+
+    def test_views_do_not_use_identity_map(self):
+        """It should not add ORM objects to the session"""
+        shopcart_id = self._create_shopcart(2).id
+        db.session.expunge_all()
+        ShopcartView.find(shopcart_id)
+        ItemView.all()
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_all_shopcarts(self):
+        """It should read all Shopcarts with their own items"""
+        first = self._create_shopcart(1)
+        second = self._create_shopcart(2)
+        self._create_shopcart(0)
+        views = ShopcartView.all()
+        self.assertEqual([view.id for view in views], sorted([first.id, second.id, views[2].id]))
+        self.assertEqual(len(views[0].items), 1)
+        self.assertEqual(len(views[1].items), 2)
+        self.assertEqual(views[2].items, [])
+        for view in views:
+            for item in view.items:
+                self.assertEqual(item.shopcart_id, view.id)
+
+    def test_find_by_name(self):
+        """It should read the Shopcarts with a name"""
+        shopcart = self._create_shopcart(2, name="wanted")
+        self._create_shopcart(1, name="other")
+        views = ShopcartView.find_by_name("wanted")
+        self.assertEqual(len(views), 1)
+        self.assertEqual(views[0].id, shopcart.id)
+        self.assertEqual(len(views[0].items), 2)
+        self.assertEqual(ShopcartView.find_by_name("missing"), [])
+
+    def test_total_price(self):
+        """It should total the price of the items"""
+        shopcart = self._create_shopcart(3)
+        view = ShopcartView.find(shopcart.id)
+        self.assertEqual(view.total_price, Shopcart.calculate_total_price(shopcart.id))
+        self.assertTrue(ShopcartView.exists(shopcart.id))
+
+    def test_find_items(self):
+        """It should read Items like the ORM model"""
+        shopcart = self._create_shopcart(3)
+        item = shopcart.items[0]
+        view = ItemView.find(item.id)
+        self.assertEqual(view.serialize(), item.serialize())
+        self.assertIsNone(ItemView.find(0))
+        self.assertEqual(len(ItemView.all()), 3)
+        self.assertIn(item.id, [found.id for found in ItemView.find_by_item_id(item.item_id)])
+        self.assertIn(item.id, [found.id for found in ItemView.find_by_quantity(item.quantity)])
+        self.assertIn(item.id, [found.id for found in ItemView.find_by_price(item.price)])
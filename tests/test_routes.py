@@ -22,9 +22,10 @@ TestYourResourceModel API Service Test Suite
 import os
 import logging
 from unittest import TestCase
+import pytest
 from wsgi import app
 from service.common import status
-from service.models import db, Shopcart
+from service.models import db, Shopcart, upgrade
 from tests.factories import ShopcartFactory, ItemFactory
 
 DATABASE_URI = os.getenv(
@@ -38,6 +39,8 @@ BASE_URL = "/api/shopcarts"
 #  T E S T   C A S E S
 ######################################################################
 # pylint: disable=too-many-public-methods
+@pytest.mark.sqlite
+@pytest.mark.usefixtures("db_transaction")
 class TestShopcartService(TestCase):
     """REST API Server Tests"""
 
@@ -50,6 +53,10 @@ class TestShopcartService(TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
         app.app_context().push()
+        upgrade()
+        # each test is rolled back, so only other suites leave rows behind
+        db.session.query(Shopcart).delete()
+        db.session.commit()
 
     @classmethod
     def tearDownClass(cls):
@@ -59,8 +66,6 @@ class TestShopcartService(TestCase):
     def setUp(self):
         """Runs before each test"""
         self.client = app.test_client()
-        db.session.query(Shopcart).delete()  # clean up the last tests
-        db.session.commit()
 
     def tearDown(self):
         """This runs after each test"""
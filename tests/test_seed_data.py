@@ -0,0 +1,127 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the synthetic data generator
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import os
+from collections import Counter
+from unittest import TestCase
+from unittest.mock import patch
+from click.testing import CliRunner
+from sqlalchemy import create_engine, func, select
+from wsgi import app
+from service.common.cli_commands import seed_data as seed_data_command
+from service.common.seed_data import DataGenerator, cumulative_weights, seed_data, truncate
+from service.models import db, Shopcart, Item, upgrade
+
+
+######################################################################
+#        S E E D   D A T A   T E S T   C A S E S
+######################################################################
+class TestSeedData(TestCase):
+    """Synthetic Data Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    def setUp(self):
+        """Runs before each test"""
+        db.session.query(Item).delete()
+        db.session.query(Shopcart).delete()
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def cart_sizes(self, connection) -> dict:
+        """Returns the number of items of each cart by name"""
+        rows = connection.execute(
+            select(Shopcart.name, func.count(Item.id)).outerjoin(Item).group_by(Shopcart.name)
+        )
+        return dict(rows.all())
+
+    def test_cumulative_weights(self):
+        """It should build Zipf and uniform cumulative weights"""
+        self.assertEqual(cumulative_weights(3, 0), [1, 2, 3])
+        self.assertEqual(cumulative_weights(2, 1), [1, 1.5])
+
+    def test_generator_is_deterministic(self):
+        """It should generate the same data for the same seed"""
+        first, second = DataGenerator(seed=7), DataGenerator(seed=7)
+        self.assertEqual(first.cart_sizes(100), second.cart_sizes(100))
+        self.assertEqual(first.items(20), second.items(20))
+        self.assertNotEqual(DataGenerator(seed=8).cart_sizes(100), DataGenerator(seed=7).cart_sizes(100))
+
+    def test_generator_is_skewed(self):
+        """It should favour small carts and hot products"""
+        generator = DataGenerator(seed=1, max_items=20, products=100)
+        sizes = Counter(generator.cart_sizes(5000))
+        self.assertEqual(sizes.most_common(1)[0][0], 1)
+        self.assertLessEqual(max(sizes), 20)
+        products = Counter(item_id for item_id, _, _, _ in generator.items(5000))
+        self.assertEqual(products.most_common(1)[0][0], "1")
+        uniform = Counter(DataGenerator(seed=1, max_items=4, distribution="uniform").cart_sizes(4000))
+        self.assertGreater(min(uniform.values()), 800)
+        with self.assertRaises(ValueError):
+            DataGenerator(distribution="normal")
+
+    def test_seed_postgres_with_copy(self):
+        """It should COPY the carts into PostgreSQL whatever the batch size"""
+        progress = []
+        with db.engine.connect() as connection:
+            totals = seed_data(connection, DataGenerator(seed=3, max_items=10), 25, batch_size=10,
+                               progress=progress.append)
+            self.assertEqual(totals["shopcarts"], 25)
+            self.assertEqual(len(progress), 3)
+            first = self.cart_sizes(connection)
+            self.assertEqual(sum(first.values()), totals["items"])
+            truncate(connection)
+            seed_data(connection, DataGenerator(seed=3, max_items=10), 25, batch_size=25)
+            self.assertEqual(self.cart_sizes(connection), first)
+
+    def test_seed_with_inserts(self):
+        """It should load other databases with multi-row INSERTs"""
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine, tables=[Shopcart.__table__, Item.__table__])
+        with engine.connect() as connection:
+            totals = seed_data(connection, DataGenerator(seed=3, max_items=10), 25, batch_size=10)
+            self.assertEqual(sum(self.cart_sizes(connection).values()), totals["items"])
+            truncate(connection)
+            self.assertEqual(self.cart_sizes(connection), {})
+        with db.engine.connect() as connection:
+            seed_data(connection, DataGenerator(seed=3, max_items=10), 25, batch_size=10)
+            # the same seed loads the same carts through COPY
+            self.assertEqual(sum(self.cart_sizes(connection).values()), totals["items"])
+
+    def test_seed_data_command(self):
+        """It should seed the database from the command line"""
+        runner = CliRunner()
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = runner.invoke(seed_data_command, ["--carts", "30", "--max-items", "5", "--truncate"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Seeded 30 shopcarts", result.output)
+        self.assertEqual(Shopcart.query.count(), 30)
@@ -6,8 +6,10 @@ import logging
 import os
 from unittest import TestCase
 from unittest.mock import patch
+import pytest
 from wsgi import app
-from service.models import Shopcart, Item, DataValidationError, db
+from service.models import Shopcart, Item, DataValidationError, db, upgrade
+from service.common.query_stats import QueryRecorder
 from tests.factories import ShopcartFactory, ItemFactory
 
 DATABASE_URI = os.getenv(
@@ -21,6 +23,8 @@ DATABASE_URI = os.getenv(
 
 
 # pylint: disable=too-many-public-methods
+@pytest.mark.sqlite
+@pytest.mark.usefixtures("db_transaction")
 class TestShopcart(TestCase):
     """Shopcart Model Test Cases"""
 
@@ -32,18 +36,17 @@ class TestShopcart(TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
         app.app_context().push()
+        upgrade()
+        # each test is rolled back, so only other suites leave rows behind
+        db.session.query(Shopcart).delete()
+        db.session.query(Item).delete()
+        db.session.commit()
 
     @classmethod
     def tearDownClass(cls):
         """This runs once after the entire test suite"""
         db.session.close()
 
-    def setUp(self):
-        """This runs before each test"""
-        db.session.query(Shopcart).delete()  # clean up the last tests
-        db.session.query(Item).delete()  # clean up the last tests
-        db.session.commit()
-
     def tearDown(self):
         """This runs after each test"""
         db.session.remove()
@@ -140,6 +143,23 @@ class TestShopcart(TestCase):
         shopcart = ShopcartFactory()
         self.assertRaises(DataValidationError, shopcart.delete)
 
+    def test_write_logs_do_not_load_attributes(self):
+        """It should log writes by class and id without loading the record"""
+        shopcart = ShopcartFactory()
+        with self.assertLogs("flask.app", level="INFO") as logs:
+            shopcart.create()
+        self.assertIn("Creating Shopcart", logs.output[0])
+        # the commit expired the attributes, logging the id must not reload them
+        with QueryRecorder() as recorder:
+            self.assertEqual(shopcart._log_id(), shopcart.id)
+        self.assertEqual(recorder.count, 1)  # only shopcart.id loads
+        with self.assertLogs("flask.app", level="INFO") as logs:
+            shopcart.update()
+        self.assertIn(f"Updating Shopcart id={shopcart.id}", logs.output[0])
+        with self.assertLogs("flask.app", level="INFO") as logs:
+            shopcart.delete()
+        self.assertIn("Deleting Shopcart id=", logs.output[0])
+
     def test_list_all_shopcarts(self):
         """It should List all Shopcarts in the database"""
         shopcarts = Shopcart.all()
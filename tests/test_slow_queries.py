@@ -0,0 +1,198 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the slow query log
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import queue
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy.exc import DBAPIError
+from wsgi import app
+from service.common import slow_queries, statement_timing
+from service.common.slow_queries import RateLimiter, parameter_shape
+from service.models import db, Shopcart, upgrade
+from tests.factories import ShopcartFactory
+
+
+######################################################################
+#        S L O W   Q U E R Y   T E S T   C A S E S
+######################################################################
+class TestSlowQueries(TestCase):
+    """Slow Query Log Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Shopcart).delete()  # clean up the last tests
+        db.session.commit()
+        slow_queries._explained.clear()  # pylint: disable=protected-access
+        self.settings = patch.dict(slow_queries.settings, threshold=0.0, explain=True)
+        self.settings.start()
+        self.limiter = patch.object(slow_queries, "_log_limiter", RateLimiter(100))
+        self.limiter.start()
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.limiter.stop()
+        self.settings.stop()
+        db.session.remove()
+
+    def test_log_slow_select_with_plan(self):
+        """It should log a slow SELECT with its route, caller and analyzed plan"""
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        with self.assertLogs("flask.app", level="WARNING") as logs:
+            self.client.get(f"/api/shopcarts/{shopcart.id}")
+            slow_queries._explain_queue.join()  # pylint: disable=protected-access
+        output = "\n".join(logs.output)
+        self.assertIn("Slow query", output)
+        self.assertIn("GET /api/shopcarts/<int:shopcart_id>", output)
+        self.assertIn("from read_models:_fetch", output)
+        self.assertIn("params={id: int}", output)
+        self.assertIn("actual time=", output)
+
+    def test_log_slow_write_without_analyze(self):
+        """It should explain writes without running them again"""
+        with self.assertLogs("flask.app", level="WARNING") as logs:
+            ShopcartFactory().create()
+            slow_queries._explain_queue.join()  # pylint: disable=protected-access
+        output = "\n".join(logs.output)
+        self.assertIn("no request", output)
+        self.assertIn("from persistent_base:create", output)
+        self.assertIn("Insert on shopcart", output)
+        self.assertNotIn("actual time=", output)
+        self.assertEqual(len(Shopcart.all()), 1)
+
+    def test_explain_without_side_effects(self):
+        """It should not run row-locking or volatile SELECTs again to explain them"""
+        shopcart = ShopcartFactory()
+        shopcart.create()
+        statements = {
+            "SELECT * FROM shopcart WHERE id = %(id)s FOR UPDATE": False,
+            "SELECT id FROM shopcart WHERE id = %(id)s FOR NO KEY UPDATE SKIP LOCKED": False,
+            "select * from shopcart where id = %(id)s for share": False,
+            "SELECT nextval(pg_get_serial_sequence('shopcart', 'id')) WHERE %(id)s > 0": False,
+            "SELECT RANDOM() FROM shopcart WHERE id = %(id)s": False,
+            "SELECT count(*), max(name) FROM shopcart WHERE id = %(id)s": True,
+            "SELECT name AS formatted FROM shopcart WHERE id = %(id)s": True,
+        }
+        sequence = db.session.execute(db.text("SELECT pg_get_serial_sequence('shopcart', 'id')")).scalar()
+        next_id = db.session.execute(db.text(f"SELECT last_value FROM {sequence}")).scalar()
+        for statement, analyzed in statements.items():
+            plan = slow_queries.explain(db.engine, statement, {"id": shopcart.id})
+            self.assertEqual("actual time=" in plan, analyzed, statement)
+        self.assertEqual(db.session.execute(db.text(f"SELECT last_value FROM {sequence}")).scalar(), next_id)
+
+    def test_explain_rate_limit(self):
+        """It should explain a statement once per interval"""
+        with self.assertLogs("flask.app", level="WARNING") as logs:
+            Shopcart.all()
+            Shopcart.all()
+            slow_queries._explain_queue.join()  # pylint: disable=protected-access
+        plans = [line for line in logs.output if "actual time=" in line]
+        self.assertEqual(len(plans), 1)
+
+    def test_explain_failure(self):
+        """It should log the statement even when EXPLAIN fails"""
+        with patch.object(slow_queries, "explain", side_effect=RuntimeError("boom")):
+            with self.assertLogs("flask.app", level="WARNING") as logs:
+                Shopcart.all()
+                slow_queries._explain_queue.join()  # pylint: disable=protected-access
+        self.assertIn("Slow query", logs.output[0])
+        self.assertIn("EXPLAIN failed: boom", logs.output[1])
+
+    def test_explain_timeout(self):
+        """It should give up on plans that take too long"""
+        with patch.dict(slow_queries.settings, explain_timeout=0.01):
+            self.assertRaisesRegex(db.engine.dialect.dbapi.Error, "statement timeout", slow_queries.explain, db.engine,
+                                   "SELECT count(*) FROM generate_series(1, %(rows)s)", {"rows": 10**9})
+
+    def test_explain_backlog(self):
+        """It should remember a bounded number of statements and drop plans past the queue"""
+        with patch.object(slow_queries, "EXPLAIN_CACHE_SIZE", 2):
+            for number in range(3):
+                self.assertTrue(slow_queries._explain_due(f"SELECT {number}"))  # pylint: disable=protected-access
+            self.assertEqual(len(slow_queries._explained), 2)  # pylint: disable=protected-access
+            self.assertTrue(slow_queries._explain_due("SELECT 0"))  # pylint: disable=protected-access
+            self.assertFalse(slow_queries._explain_due("SELECT 2"))  # pylint: disable=protected-access
+        explain_queue = slow_queries._explain_queue  # pylint: disable=protected-access
+        with patch.object(explain_queue, "put_nowait", side_effect=queue.Full):
+            self.assertFalse(slow_queries.submit_explain(db.engine, "SELECT 1", {}, "test"))
+
+    def test_log_rate_limit(self):
+        """It should limit the log lines and report the ones it dropped"""
+        limiter = RateLimiter(1, period=3600)
+        slow_queries.settings["explain"] = False
+        with patch.object(slow_queries, "_log_limiter", limiter):
+            with self.assertLogs("flask.app", level="WARNING") as logs:
+                Shopcart.all()
+                Shopcart.all()
+            self.assertEqual(len(logs.output), 1)
+            self.assertEqual(limiter.suppressed, 1)
+            limiter.window_start -= 3600
+            with self.assertLogs("flask.app", level="WARNING") as logs:
+                Shopcart.all()
+        self.assertIn("1 more slow queries were not logged", logs.output[0])
+
+    def test_fast_queries_are_not_logged(self):
+        """It should ignore statements under the threshold"""
+        slow_queries.settings["threshold"] = 60.0
+        with self.assertNoLogs("flask.app", level="WARNING"):
+            Shopcart.all()
+
+    def test_failed_statements(self):
+        """It should not keep the timing of statements that fail"""
+        with db.engine.connect() as connection:
+            self.assertRaises(DBAPIError, connection.execute, db.text("SELECT 1/0"))
+            self.assertNotIn("statement_timing_start", connection.info)
+
+    def test_parameter_shape(self):
+        """It should describe parameters without their values"""
+        self.assertEqual(parameter_shape({"id": 1, "name": "x"}), "{id: int, name: str}")
+        self.assertEqual(parameter_shape((1, "x")), "(int, str)")
+        self.assertEqual(parameter_shape([{"id": 1}, {"id": 2}], executemany=True), "2 x {id: int}")
+        self.assertEqual(parameter_shape([], executemany=True), "0 x ()")
+        self.assertEqual(parameter_shape(None), "NoneType")
+
+    def test_init_turns_log_off(self):
+        """It should stop checking statements when disabled"""
+        callback = slow_queries._check_statement  # pylint: disable=protected-access
+        app.config["SLOW_QUERY_LOG_ENABLED"] = False
+        try:
+            slow_queries.init_slow_query_log(app)
+            self.assertFalse(statement_timing.has_callback(callback))
+        finally:
+            app.config["SLOW_QUERY_LOG_ENABLED"] = True
+            slow_queries.init_slow_query_log(app)
+        self.assertTrue(statement_timing.has_callback(callback))
@@ -0,0 +1,85 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for application startup
+"""
+
+# pylint: disable=duplicate-code
+import json
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+import service
+from service import create_app
+from service.common.startup import StartupTimer
+from wsgi import app
+
+
+######################################################################
+#        S T A R T U P   T E S T   C A S E S
+######################################################################
+class TestStartup(TestCase):
+    """Application Startup Tests"""
+
+    def setUp(self):
+        self.api = service.api
+
+    def tearDown(self):
+        # create_app() replaces the module level api, put the real one back
+        service.api = self.api
+
+    def test_timer_records_phases(self):
+        """It should record a timing for each phase"""
+        timer = StartupTimer()
+        with timer.phase("one"):
+            pass
+        with timer.phase("two"):
+            pass
+        self.assertEqual(list(timer.phases), ["one", "two"])
+        self.assertAlmostEqual(timer.total, sum(timer.phases.values()))
+        report = timer.report()
+        self.assertTrue(report.startswith("Startup timings: one="))
+        self.assertIn("total=", report)
+
+    def test_app_keeps_startup_timings(self):
+        """It should keep the startup timings on the app"""
+        timer = app.extensions["startup_timer"]
+        for phase in ["flask", "database", "api", "routes", "logging"]:
+            self.assertIn(phase, timer.phases)
+
+    def test_api_docs_disabled(self):
+        """It should not register the Swagger docs when disabled"""
+        with patch("service.config.API_DOCS_ENABLED", False):
+            new_app = create_app()
+        client = new_app.test_client()
+        self.assertEqual(client.get("/apidocs/").status_code, 404)
+        self.assertEqual(client.get("/api/swagger.json").status_code, 404)
+
+    def test_prebuilt_openapi_spec(self):
+        """It should serve a prebuilt OpenAPI spec"""
+        spec = {"swagger": "2.0", "info": {"title": "prebuilt"}, "paths": {}}
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as spec_file:
+            json.dump(spec, spec_file)
+            spec_file.flush()
+            with patch("service.config.OPENAPI_SPEC_FILE", spec_file.name):
+                new_app = create_app()
+        self.assertIn("openapi", new_app.extensions["startup_timer"].phases)
+        self.assertEqual(service.api.__schema__, spec)
+        self.assertEqual(new_app.test_client().get("/api/swagger.json").get_json(), spec)
+        service.api.spec = None
+        with new_app.test_request_context():
+            self.assertEqual(service.api.__schema__["info"]["title"], "Shopcarts RESTX API Service")
@@ -0,0 +1,95 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the shared statement timing hooks
+"""
+
+# pylint: disable=duplicate-code
+import logging
+from unittest import TestCase
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from wsgi import app
+from service.common import metrics, query_stats, slow_queries, statement_timing, tracing
+from service.models import db
+
+
+######################################################################
+#        S T A T E M E N T   T I M I N G   T E S T   C A S E S
+######################################################################
+class TestStatementTiming(TestCase):
+    """Statement Timing Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.statements = []
+        self.errors = []
+        statement_timing.add_callbacks(self.after, self.error)
+
+    def tearDown(self):
+        """This runs after each test"""
+        statement_timing.remove_callbacks(self.after, self.error)
+        db.session.remove()
+
+    def after(self, conn, statement, parameters, context, executemany, elapsed):
+        """Records a statement that has run"""
+        # pylint: disable=unused-argument, too-many-arguments
+        self.statements.append((statement, elapsed))
+
+    def error(self, conn, statement, error, elapsed):
+        """Records a statement that failed"""
+        # pylint: disable=unused-argument
+        self.errors.append((statement, type(error).__name__, elapsed))
+
+    def test_one_set_of_hooks(self):
+        """It should time each statement once for every feature"""
+        # pylint: disable=protected-access
+        features = [metrics._record_statement, query_stats._record_statement, slow_queries._check_statement,
+                    tracing._trace_statement]
+        self.assertTrue(all(statement_timing.has_callback(callback) for callback in features))
+        statement_timing.add_callbacks(self.after, self.error)
+        self.assertEqual(statement_timing._callbacks["after"].count(self.after), 1)
+        self.assertTrue(event.contains(Engine, "before_cursor_execute", statement_timing._before_cursor_execute))
+        with db.engine.connect() as connection:
+            connection.execute(db.text("SELECT 1"))
+        self.assertEqual([statement for statement, _ in self.statements], ["SELECT 1"])
+        self.assertGreaterEqual(self.statements[0][1], 0)
+
+    def test_failed_statements(self):
+        """It should pass failed statements to the error callbacks and leave nothing on the connection"""
+        with db.engine.connect() as connection:
+            self.assertRaises(DBAPIError, connection.execute, db.text("SELECT 1/0"))
+            self.assertNotIn("statement_timing_start", connection.info)
+        self.assertEqual(self.statements, [])
+        self.assertEqual([(statement, name) for statement, name, _ in self.errors], [("SELECT 1/0", "DivisionByZero")])
+
+    def test_remove_callbacks(self):
+        """It should stop calling removed callbacks"""
+        statement_timing.remove_callbacks(self.after, self.error)
+        self.assertFalse(statement_timing.has_callback(self.after))
+        with db.engine.connect() as connection:
+            connection.execute(db.text("SELECT 1"))
+        self.assertEqual(self.statements, [])
@@ -0,0 +1,246 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for distributed tracing
+"""
+
+# pylint: disable=duplicate-code
+import json
+import logging
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+from flask import g
+from wsgi import app
+from service.common import statement_timing, tracing
+from service.common.tracing import (
+    tracer, parse_traceparent, BatchProcessor, InMemoryExporter, FileExporter, OtlpHttpExporter, NOOP_SPAN,
+)
+from service.models import db, Shopcart, upgrade
+from tests.factories import ShopcartFactory, ItemFactory
+
+BASE_URL = "/api/shopcarts"
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+######################################################################
+#        T R A C I N G   T E S T   C A S E S
+######################################################################
+class TestTracing(TestCase):
+    """Distributed Tracing Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+        upgrade()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Run once after all tests"""
+        db.session.close()
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        db.session.query(Shopcart).delete()  # clean up the last tests
+        db.session.commit()
+        self.exporter = InMemoryExporter()
+        tracer.processor = BatchProcessor(self.exporter, {"service.name": "test"})
+
+    def tearDown(self):
+        """This runs after each test"""
+        tracer.processor = None
+        db.session.remove()
+
+    def _spans(self) -> dict:
+        tracer.flush()
+        return {span.name: span for span in self.exporter.spans}
+
+    def test_request_spans(self):
+        """It should trace a request, its model calls, encoding and SQL"""
+        shopcart = ShopcartFactory()
+        shopcart.items = [ItemFactory(shopcart=None)]
+        shopcart.create()
+        tracer.flush()
+        self.exporter.spans.clear()
+
+        headers = {"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"}
+        resp = self.client.get(f"{BASE_URL}/{shopcart.id}", headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        spans = self._spans()
+        server = spans["ShopcartResource.get"]
+        self.assertEqual(server.kind, "SERVER")
+        self.assertEqual(server.trace_id, TRACE_ID)
+        self.assertEqual(server.parent_id, PARENT_ID)
+        self.assertEqual(server.attributes["http.response.status_code"], 200)
+        self.assertEqual(server.attributes["http.route"], "/api/shopcarts/<int:shopcart_id>")
+
+        model = spans["ShopcartView.find"]
+        self.assertEqual(model.parent_id, server.span_id)
+        self.assertEqual(spans["serialize"].parent_id, server.span_id)
+        select = spans["SELECT"]
+        self.assertEqual(select.kind, "CLIENT")
+        self.assertEqual(select.parent_id, model.span_id)
+        self.assertEqual(select.attributes["db.system"], "postgresql")
+        self.assertTrue(all(span.trace_id == TRACE_ID for span in spans.values()))
+        self.assertIsNone(tracing.current_span())
+
+    def test_write_spans(self):
+        """It should trace the CRUD calls of the models"""
+        resp = self.client.post(BASE_URL, json={"name": "traced", "items": []})
+        self.assertEqual(resp.status_code, 201)
+        spans = self._spans()
+        self.assertIn("ShopcartCollection.post", spans)
+        self.assertEqual(spans["Shopcart.create"].parent_id, spans["ShopcartCollection.post"].span_id)
+        self.assertIn("INSERT", spans)
+        self.assertIsNone(spans["ShopcartCollection.post"].parent_id)
+
+    def test_unsampled_trace(self):
+        """It should not export traces the caller did not sample"""
+        self.client.get(BASE_URL, headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-00"})
+        self.client.get("/no/such/page")
+        spans = self._spans()
+        self.assertNotIn("ShopcartCollection.get", spans)
+        self.assertNotIn("SELECT", spans)
+        self.assertEqual(spans["GET unmatched"].attributes["http.response.status_code"], 404)
+
+    def test_error_spans(self):
+        """It should mark failed spans with an error status"""
+        with self.assertRaises(ValueError):
+            with tracer.span("failing", answer=42):
+                raise ValueError("boom")
+        with patch.object(Shopcart, "deserialize", side_effect=RuntimeError("broken")):
+            with self.assertRaises(RuntimeError):
+                self.client.post(BASE_URL, json={"name": "x", "items": []})
+        with app.test_request_context("/"):
+            span = g.trace_span = tracer.start_span("manual")
+            tracing._record_status(MagicMock(status_code=503))  # pylint: disable=protected-access
+            g.pop("trace_span")
+        self.assertEqual(span.error, "HTTP 503")
+        with self.assertRaises(Exception):
+            db.session.execute(db.text("SELECT * FROM no_such_table"))
+        db.session.rollback()
+        spans = self._spans()
+        failing = spans["failing"].to_otlp()
+        self.assertEqual(failing["status"], {"code": 2, "message": "ValueError: boom"})
+        self.assertEqual(failing["attributes"], [{"key": "answer", "value": {"intValue": "42"}}])
+        self.assertEqual(spans["ShopcartCollection.post"].error, "RuntimeError: broken")
+        self.assertIn("UndefinedTable", spans["SELECT"].error)
+
+    def test_unfinished_statements(self):
+        """It should leave nothing behind for a statement that never finishes"""
+        with db.engine.connect() as connection:
+            context = MagicMock(spec=[])
+            statement_timing._before_cursor_execute(  # pylint: disable=protected-access
+                connection, None, "SELECT 1", {}, context, False
+            )
+            self.assertIsNone(tracing.current_span())
+            self.assertNotIn("trace_spans", connection.info)
+            with tracer.span("next") as span:
+                connection.execute(db.text("SELECT 2"))
+        select = self._spans()["SELECT"]
+        self.assertEqual(select.parent_id, span.span_id)
+        self.assertEqual(select.attributes["db.statement"], "SELECT 2")
+
+    def test_tracing_off(self):
+        """It should hand out a no-op span while tracing is off"""
+        tracer.processor = None
+        with tracer.span("ignored") as span:
+            span.set_attribute("key", "value")
+            span.record_error(ValueError())
+        span.end()
+        self.assertIs(span, NOOP_SPAN)
+        tracer.flush()
+        self.assertEqual(self.client.get(BASE_URL).status_code, 200)
+        self.assertEqual(self.exporter.spans, [])
+
+    def test_parse_traceparent(self):
+        """It should only accept valid traceparent headers"""
+        self.assertEqual(parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01"), (TRACE_ID, PARENT_ID, True))
+        self.assertIsNone(parse_traceparent(None))
+        self.assertIsNone(parse_traceparent("garbage"))
+        self.assertIsNone(parse_traceparent(f"00-{'0' * 32}-{PARENT_ID}-01"))
+        with tracer.span("root") as span:
+            self.assertEqual(parse_traceparent(span.traceparent), (span.trace_id, span.span_id, True))
+
+    def test_file_exporter(self):
+        """It should write spans as OTLP/JSON lines"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "traces.jsonl")
+            tracer.processor = BatchProcessor(FileExporter(path), {"service.name": "test"}, interval=60)
+            with tracer.span("outer", flag=True, ratio=0.5, label="x"):
+                with tracer.span("inner"):
+                    pass
+            tracer.flush()
+            with open(path, encoding="utf-8") as trace_file:
+                lines = [json.loads(line) for line in trace_file]
+        self.assertEqual([line["span"]["name"] for line in lines], ["inner", "outer"])
+        self.assertEqual(lines[0]["span"]["parentSpanId"], lines[1]["span"]["spanId"])
+        self.assertEqual(lines[0]["resource"], {"service.name": "test"})
+        values = [attribute["value"] for attribute in lines[1]["span"]["attributes"]]
+        self.assertEqual(values, [{"boolValue": True}, {"doubleValue": 0.5}, {"stringValue": "x"}])
+
+    def test_otlp_exporter(self):
+        """It should post spans to the collector and survive failures"""
+        exporter = OtlpHttpExporter("http://collector:4318/v1/traces")
+        tracer.processor = BatchProcessor(exporter, {"service.name": "test"}, max_batch=1)
+        with patch("urllib.request.urlopen", return_value=MagicMock()) as urlopen:
+            with tracer.span("sent"):
+                pass
+            tracer.flush()
+        post = urlopen.call_args[0][0]
+        self.assertEqual(post.full_url, "http://collector:4318/v1/traces")
+        body = json.loads(post.data)
+        self.assertEqual(body["resourceSpans"][0]["scopeSpans"][0]["spans"][0]["name"], "sent")
+        with patch("urllib.request.urlopen", side_effect=OSError("down")):
+            with self.assertLogs("flask.app", level="WARNING") as logs:
+                with tracer.span("lost"):
+                    pass
+                tracer.flush()
+        self.assertIn("Dropped 1 spans", logs.output[0])
+
+    def test_export_queue_limit(self):
+        """It should drop the oldest spans when the export queue is full"""
+        tracer.processor = BatchProcessor(self.exporter, {"service.name": "test"}, max_batch=2, max_queue_size=3)
+        tracer.processor.thread = MagicMock()  # keep the spans queued
+        for number in range(5):
+            with tracer.span(f"span {number}"):
+                pass
+        self.assertEqual(tracer.processor.dropped, 2)
+        with self.assertLogs("flask.app", level="WARNING") as logs:
+            tracer.flush()
+        self.assertIn("Dropped 2 spans, the export queue was full", logs.output[0])
+        self.assertEqual([span.name for span in self.exporter.spans], ["span 2", "span 3", "span 4"])
+
+    def test_build_exporter(self):
+        """It should pick the exporter from the configuration"""
+        config = {"TRACING_EXPORTER": "otlp", "TRACING_OTLP_ENDPOINT": "http://x", "TRACING_FILE": "/tmp/t"}
+        fake_app = MagicMock(config=config)
+        self.assertIsInstance(tracing.build_exporter(fake_app), OtlpHttpExporter)
+        config["TRACING_EXPORTER"] = "file"
+        self.assertIsInstance(tracing.build_exporter(fake_app), FileExporter)
+        config["TRACING_EXPORTER"] = "none"
+        self.assertIsNone(tracing.build_exporter(fake_app))
+        with patch.dict(app.config, {"TRACING_EXPORTER": "file", "TRACING_SERVICE_NAME": "svc"}):
+            tracing.init_tracing(app)
+        self.assertEqual(tracer.processor.resource, {"service.name": "svc"})